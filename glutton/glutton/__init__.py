@@ -1,12 +1,19 @@
 import logging
 import asyncio
+from concurrent.futures import ThreadPoolExecutor
 
 import aiohttp.web
 
 import api_hour
+from rdflib import URIRef
 
-from .engines import rdf
+from .engines import rdf, invalidation
 from . import endpoints
+from .services.data import forget_ldpr, existence_filter_load
+from .utils.bloom import BloomFilter
+from .utils.singleflight import SingleFlight
+from .utils.cache import LRUCache, Generations
+from .utils import metrics, negotiation, nodeids, serializers
 
 LOG = logging.getLogger(__name__)
 
@@ -17,13 +24,73 @@ class Container(api_hour.Container):
         if self.config is None: # Remove this line if you don't want to use API-Hour config file
             raise ValueError('An API-Hour config dir is needed.')
 
+        ## Caches
+        caches_config = self.config.get('caches', {})
+        self.caches = {
+            'ldpr_metadata': LRUCache(max_size=caches_config.get('ldpr_metadata', {}).get('size', 10000)),
+            # Serialized LDPRs, keyed by (ldpr_ref, content type, etag) and bounded in bytes
+            'representations': LRUCache(max_size=caches_config.get('representations', {}).get('max_bytes', 64 * 1024 * 1024)),
+            # Next slug number per (LDPC, suggested slug), see services.slugs
+            'slug_allocations': LRUCache(max_size=caches_config.get('slug_allocations', {}).get('size', 10000)),
+        }
+
+        # Invalidations per LDPR, so that a load racing a write does not
+        # cache what it read before it, see services.data.forget_ldpr
+        self.generations = Generations(max_size=caches_config.get('generations', {}).get('size', 100000))
+
+        # IRIs with triples in the store (live or deleted LDPRs), to answer
+        # 404s without a backend query, see services.data.ldpr_may_exist.
+        # It learns the writes of other workers from the invalidation bus,
+        # and is reloaded periodically for those it can't hear of: only
+        # safe when every writer runs on this host.
+        existence_config = caches_config.get('existence', {})
+        self.existence = None
+        if existence_config.get('enabled', False):
+            if 'invalidation' in self.config['engines']:
+                self.existence = BloomFilter(capacity=existence_config.get('capacity', 1000000),
+                                             false_positive_rate=existence_config.get('false_positive_rate', 0.01))
+            else:
+                LOG.warning("The existence filter needs the invalidation engine, it is disabled")
+        # IRIs written while a new filter is being loaded
+        self.existence_writes = None
+        self._existence_stale = asyncio.Event(loop=kwargs['loop'])
+        self._existence_loader = None
+
+        # Concurrent GETs of a LDPR share one backend fetch and serialization
+        coalescing_config = self.config.get('coalescing', {})
+        self.reads = SingleFlight(timeout=coalescing_config.get('timeout', 30),
+                                  enabled=coalescing_config.get('enabled', True),
+                                  loop=kwargs['loop'])
+
+        # Threads parsing request bodies (PUT, POST), apart from the default executor
+        self.parsers = ThreadPoolExecutor(max_workers=self.config.get('uploads', {}).get('parsers', 4))
+
+        ## Serialization
+        negotiation.configure(self.config.get('formats', {}))
+        serializers.configure(self.config.get('serializers', {}))
+
+        ## Node ids (paging cursors)
+        nodeids.configure(self.config.get('node_ids', {}))
+
         ## Servers
         # You can define several servers, to listen HTTP and SSH for example.
         # If you do that, you need to listen on two ports with api_hour --bind command line.
-        self.servers['http'] = aiohttp.web.Application(loop=kwargs['loop'])
+        self.servers['http'] = aiohttp.web.Application(loop=kwargs['loop'],
+                                                       middlewares=[metrics.middleware])
         self.servers['http']['ah_container'] = self # keep a reference to Container
         # routes
 
+        # Before the catch-all LDPR routes
+        metrics_routes = endpoints.metrics.MetricsView()
+        self.servers['http'].router.add_route('GET',
+                                              r'/metrics',
+                                              metrics_routes.get)
+
+        bulk_routes = endpoints.bulk.BulkImportView()
+        self.servers['http'].router.add_route('POST',
+                                              r'/_import/{path:.*}',
+                                              bulk_routes.post)
+
         ldprRDF_routes = endpoints.index.LDPRDFSourceResourceView()
         self.servers['http'].router.add_route('GET',
                                               r'/{path:.*}',
@@ -64,6 +131,45 @@ class Container(api_hour.Container):
                                                   access_log=self.worker.log.access_log,
                                                   access_log_format=self.worker.cfg.access_log_format)]
 
+    def forget_ldprs(self, ldpr_refs):
+        """
+        Invalidation bus handler: another worker modified ldpr_refs
+        """
+        ldpr_refs = [URIRef(ldpr_ref) for ldpr_ref in ldpr_refs]
+        forget_ldpr(self, *ldpr_refs)
+
+        # Replicas may lag behind that write too, read them from the primary for a while
+        engine = self.engines.get('triplestore')
+        if engine is not None and engine.done() and not engine.exception():
+            engine.result().wrote(*ldpr_refs)
+
+    def forget_everything(self):
+        """
+        Invalidation bus handler: invalidations of another worker were lost
+        """
+        LOG.warning("Dropping the caches, they may be outdated")
+        for cache in self.caches.values():
+            cache.clear()
+
+        # Unsure until reloaded
+        if self.existence is not None:
+            self.existence.ready = False
+            self._existence_stale.set()
+
+    @asyncio.coroutine
+    def load_existence_filter(self, interval=None):
+        """
+        Load the existence filter, then again every interval seconds or
+        as soon as it may be outdated
+        """
+        while True:
+            self._existence_stale.clear()
+            yield from existence_filter_load(self)
+            try:
+                yield from asyncio.wait_for(self._existence_stale.wait(), interval, loop=self.loop)
+            except asyncio.TimeoutError:
+                pass
+
     @asyncio.coroutine
     def start(self):
         yield from super().start()
@@ -71,10 +177,38 @@ class Container(api_hour.Container):
 
         if 'triplestore' in self.config['engines']:
             ts_config = self.config['engines']['triplestore']
+            pool_config = ts_config.get('pool', {})
+            replicas_config = ts_config.get('replicas', {})
             self.engines['triplestore'] = self.loop.create_task(rdf.connect(driver=ts_config['driver'],
-                                                                            uri=ts_config['uri'])) # FIXME: A pool should be created
-
-        yield from asyncio.wait([self.engines['triplestore']], return_when=asyncio.ALL_COMPLETED)
+                                                                            uri=ts_config['uri'],
+                                                                            pool_size=pool_config.get('size', 16),
+                                                                            max_waiters=pool_config.get('max_waiters', 1024),
+                                                                            timeout=pool_config.get('timeout', None),
+                                                                            keepalive=pool_config.get('keepalive', True),
+                                                                            replicas=replicas_config.get('query', []),
+                                                                            balancing=replicas_config.get('balancing', 'round-robin'),
+                                                                            health_check_interval=replicas_config.get('health_check_interval', 5),
+                                                                            read_your_writes=replicas_config.get('read_your_writes', 5),
+                                                                            layout=ts_config.get('layout', 'default'),
+                                                                            loop=self.loop))
+
+        if 'invalidation' in self.config['engines']:
+            bus_config = self.config['engines']['invalidation']
+            self.engines['invalidation'] = self.loop.create_task(invalidation.connect(directory=bus_config['directory'],
+                                                                                       loop=self.loop))
+
+        yield from asyncio.wait(list(self.engines.values()), return_when=asyncio.ALL_COMPLETED)
+
+        # Drop what other workers modified from our caches
+        if 'invalidation' in self.engines:
+            bus = yield from self.engines['invalidation']
+            bus.subscribe(self.forget_ldprs)
+            bus.subscribe_losses(self.forget_everything)
+
+        # Filled in the background, the filter answers "maybe" until then
+        if self.existence is not None and 'triplestore' in self.engines:
+            interval = self.config['caches']['existence'].get('reload_interval', 60) or None
+            self._existence_loader = self.loop.create_task(self.load_existence_filter(interval))
 
         LOG.info('All engines ready !')
 
@@ -83,7 +217,18 @@ class Container(api_hour.Container):
     def stop(self):
         LOG.info('Stopping engines...')
 
-        # FIXME : Should stop the triplestore here
+        if self._existence_loader is not None:
+            self._existence_loader.cancel()
+
+        if 'triplestore' in self.engines:
+            store = yield from self.engines['triplestore']
+            yield from store.close()
+
+        if 'invalidation' in self.engines:
+            bus = yield from self.engines['invalidation']
+            bus.close()
+
+        self.parsers.shutdown(wait=False)
 
         LOG.info('All engines stopped !')
         yield from super().stop()
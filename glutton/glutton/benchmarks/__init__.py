@@ -0,0 +1,3 @@
+"""
+Micro-benchmarks, run with e.g. `python -m glutton.benchmarks.nodeids`
+"""
@@ -0,0 +1,236 @@
+"""
+Throughput of a Glutton worker, without a Fuseki
+
+Boots a glutton.Container in this process against a SPARQL stand-in (see
+benchmarks.sparql) with injected latency, seeds LDPCs of various sizes,
+then drives a scripted mix of LDP requests through HTTP and reports
+requests per second, p50/p99 latencies, triplestore round trips per
+request and peak RSS (stand-in and client included).
+
+    python -m glutton.benchmarks.ldp --config-dir etc/glutton --sizes 10,10000,100000 --mix mixed
+"""
+import argparse
+import asyncio
+import copy
+from datetime import datetime
+import logging
+import random
+import resource
+import time
+
+import aiohttp
+from api_hour.config import get_config
+from rdflib import URIRef, Literal
+from rdflib.namespace import RDF, DCTERMS
+
+from .. import Container
+from ..services.data import forget_ldpr
+from ..utils.namespace import LDP
+from .sparql import SPARQLStandIn
+
+LOG = logging.getLogger(__name__)
+
+# Operation weights
+MIXES = {
+    'read': {'get': 70, 'head': 15, 'options': 10, 'page': 5},
+    'write': {'post': 40, 'put': 40, 'delete': 20},
+    'mixed': {'get': 50, 'head': 10, 'options': 5, 'page': 5, 'post': 12, 'put': 12, 'delete': 6},
+}
+
+BODY = b'<> <http://purl.org/dc/terms/title> "Benchmark" .\n'
+
+def seed(graph, ldpc_ref, size):
+    """
+    Add a LDPC of size members to graph, as POST would have
+    """
+    now = Literal(datetime.now())
+    for rdftype in (LDP.Container, LDP.BasicContainer, LDP.RDFSource):
+        graph.add((ldpc_ref, RDF.type, rdftype))
+    graph.add((ldpc_ref, DCTERMS.modified, now))
+
+    members = []
+    for index in range(size):
+        member_ref = URIRef("{0}/member-{1}".format(ldpc_ref, index))
+        graph.add((member_ref, RDF.type, LDP.RDFSource))
+        graph.add((member_ref, DCTERMS.created, now))
+        graph.add((member_ref, DCTERMS.modified, now))
+        graph.add((member_ref, DCTERMS.title, Literal("Member {0}".format(index))))
+        graph.add((ldpc_ref, LDP.contains, member_ref))
+        members.append(member_ref)
+    return members
+
+def percentile(latencies, fraction):
+    if not latencies:
+        return 0.0
+    return latencies[int(round(fraction * (len(latencies) - 1)))]
+
+class Driver(object):
+    """
+    Run `requests` LDP requests against one LDPC, `concurrency` at a time
+    """
+    def __init__(self, ldpc_ref, members, mix, connector, loop, seed=0):
+        self.ldpc_ref = ldpc_ref
+        self.members = members
+        self.created = []
+        self.connector = connector
+        self.loop = loop
+
+        self._random = random.Random(seed)
+        self._operations = list(mix.keys())
+        self._weights = [mix[operation] for operation in self._operations]
+
+        self.latencies = dict((operation, []) for operation in self._operations)
+        self.errors = dict((operation, 0) for operation in self._operations)
+
+    def pick(self):
+        point = self._random.uniform(0, sum(self._weights))
+        for operation, weight in zip(self._operations, self._weights):
+            point -= weight
+            if point <= 0:
+                break
+
+        if operation == 'delete' and not self.created:
+            # Only delete what the benchmark created, so the LDPC keeps its size
+            operation = 'post'
+        return operation
+
+    def prepare(self, operation):
+        """
+        Return (method, url, headers, body) for operation
+        """
+        member = self._random.choice(self.members)
+        if operation == 'get':
+            return 'GET', member, {'Accept': 'text/turtle'}, None
+        if operation == 'head':
+            return 'HEAD', member, {'Accept': 'text/turtle'}, None
+        if operation == 'options':
+            return 'OPTIONS', member, {}, None
+        if operation == 'page':
+            return 'GET', self.ldpc_ref, {'Accept': 'text/turtle', 'Prefer': 'return=representation; max-member-count=50'}, None
+        if operation == 'post':
+            return 'POST', self.ldpc_ref, {'Content-type': 'text/turtle', 'Slug': 'bench'}, BODY
+        if operation == 'put':
+            return 'PUT', member, {'Content-type': 'text/turtle', 'If-Match': '*'}, BODY
+        if operation == 'delete':
+            return 'DELETE', self.created.pop(self._random.randrange(len(self.created))), {}, None
+        raise ValueError("Unknown operation {0}".format(operation))
+
+    @asyncio.coroutine
+    def request(self, operation):
+        method, url, headers, body = self.prepare(operation)
+        started = time.perf_counter()
+        try:
+            response = yield from aiohttp.request(method, url, headers=headers, data=body,
+                                                  connector=self.connector, loop=self.loop)
+            yield from response.read()
+        except Exception:
+            LOG.exception("{0} {1} failed".format(method, url))
+            self.errors[operation] += 1
+            return
+
+        self.latencies[operation].append(time.perf_counter() - started)
+        if response.status >= 400:
+            self.errors[operation] += 1
+        elif operation == 'post':
+            self.created.append(response.headers.get('Location'))
+
+    @asyncio.coroutine
+    def run(self, requests, concurrency):
+        remaining = [requests]
+
+        @asyncio.coroutine
+        def worker():
+            while remaining[0] > 0:
+                remaining[0] -= 1
+                yield from self.request(self.pick())
+
+        started = time.perf_counter()
+        yield from asyncio.gather(*[worker() for i in range(concurrency)], loop=self.loop)
+        return time.perf_counter() - started
+
+@asyncio.coroutine
+def benchmark(args, config, loop):
+    stand_in = SPARQLStandIn(latency=args.latency)
+    stand_in.start()
+
+    config = copy.deepcopy(config)
+    config['engines'] = {
+        'triplestore': {
+            'driver': 'SPARQLUpdateStore',
+            'uri': [stand_in.query_endpoint, stand_in.update_endpoint],
+            'pool': config.get('engines', {}).get('triplestore', {}).get('pool', {}),
+        }
+    }
+
+    container = Container(config=config, worker=None, loop=loop)
+    yield from container.start()
+    server = yield from loop.create_server(container.servers['http'].make_handler(), '127.0.0.1', args.port)
+    base = "http://127.0.0.1:{0}".format(server.sockets[0].getsockname()[1])
+
+    connector = aiohttp.TCPConnector(loop=loop)
+    try:
+        print("{0:>7} {1:>8} {2:>8} {3:>9} {4:>9} {5:>7} {6:>11} {7:>10}".format(
+            "members", "op", "count", "p50 ms", "p99 ms", "errors", "round trips", "backend ms"))
+
+        for size in args.sizes:
+            ldpc_ref = URIRef("{0}/bench-{1}".format(base, size))
+            # Nothing runs against the stand-in in between
+            members = seed(stand_in.graph, ldpc_ref, size)
+            # Written behind the worker's back, as another worker would
+            forget_ldpr(container, ldpc_ref, *members)
+
+            driver = Driver(ldpc_ref, members, MIXES[args.mix], connector, loop, seed=size)
+            if args.warmup:
+                yield from driver.run(args.warmup, args.concurrency)
+                driver.latencies = dict((operation, []) for operation in driver.latencies)
+                driver.errors = dict((operation, 0) for operation in driver.errors)
+
+            round_trips, busy_time = stand_in.round_trips, stand_in.busy_time
+            elapsed = yield from driver.run(args.requests, args.concurrency)
+            round_trips, busy_time = stand_in.round_trips - round_trips, stand_in.busy_time - busy_time
+
+            for operation, latencies in sorted(driver.latencies.items()):
+                if not latencies and not driver.errors[operation]:
+                    continue
+                latencies.sort()
+                print("{0:>7} {1:>8} {2:>8} {3:>9.2f} {4:>9.2f} {5:>7}".format(
+                    size, operation, len(latencies),
+                    percentile(latencies, 0.5) * 1000, percentile(latencies, 0.99) * 1000,
+                    driver.errors[operation]))
+
+            latencies = sorted(latency for operation_latencies in driver.latencies.values() for latency in operation_latencies)
+            print("{0:>7} {1:>8} {2:>8} {3:>9.2f} {4:>9.2f} {5:>7} {6:>11.2f} {7:>10.2f}".format(
+                size, "all", len(latencies),
+                percentile(latencies, 0.5) * 1000, percentile(latencies, 0.99) * 1000,
+                sum(driver.errors.values()),
+                round_trips / args.requests, busy_time / args.requests * 1000))
+            print("{0:>7} {1:.1f} req/s, peak RSS {2:.1f} MB".format(
+                size, args.requests / elapsed,
+                resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024))
+    finally:
+        connector.close()
+        server.close()
+        yield from container.stop()
+        stand_in.stop()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='glutton.benchmarks.ldp')
+    parser.add_argument('--config-dir', default='etc/glutton', help="API-Hour config dir (caches, pool, serializers...)")
+    parser.add_argument('--sizes', default='10,10000,100000', type=lambda sizes: [int(size) for size in sizes.split(',')],
+                        help="Members of the benchmarked LDPCs")
+    parser.add_argument('--mix', default='mixed', choices=sorted(MIXES))
+    parser.add_argument('--requests', type=int, default=2000, help="Requests per LDPC")
+    parser.add_argument('--warmup', type=int, default=100, help="Requests per LDPC before measuring")
+    parser.add_argument('--concurrency', type=int, default=32, help="Requests in flight")
+    parser.add_argument('--latency', type=float, default=0.002, help="Seconds added to each triplestore round trip")
+    parser.add_argument('--port', type=int, default=0, help="Port of the benchmarked server")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.WARNING)
+
+    config = get_config({'config_dir': args.config_dir})
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(benchmark(args, config, loop))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,57 @@
+"""
+Compare the former node id encoding (a new Hashids per call, one number
+per URI byte) to NodeIdCodec, without and with its caches.
+
+    python -m glutton.benchmarks.nodeids [--number 2000]
+"""
+import argparse
+import timeit
+
+from hashids import Hashids
+from rdflib.term import URIRef
+
+from ..utils.nodeids import NodeIdCodec
+
+# Realistic LDPR references
+NODES = [
+    URIRef("http://localhost:8008/comments/comment-12"),
+    URIRef("http://localhost:8008/projects/7f3c2a10-9d4e-4b8e-a1c3-2f5d6e7a8b9c"),
+    URIRef("http://data.example.org/organizations/unisson/members/jean-dupont/contributions/2015-06-01"),
+    URIRef("http://localhost:8008/tags/%C3%A9nergie-renouvelable-et-%C3%A9conomie-circulaire"),
+]
+
+def legacy_encode(node):
+    hashids = Hashids(salt="xx")
+    return hashids.encode(*list(bytearray(node, 'utf-8')))
+
+def legacy_decode(hashid):
+    hashids = Hashids(salt="xx")
+    return URIRef(bytes(hashids.decode(hashid)).decode('utf-8'))
+
+def measure(name, encode, decode, number):
+    hashids = [encode(node) for node in NODES]
+    for node, hashid in zip(NODES, hashids):
+        assert decode(hashid) == node
+
+    encoding = timeit.timeit(lambda: [encode(node) for node in NODES], number=number)
+    decoding = timeit.timeit(lambda: [decode(hashid) for hashid in hashids], number=number)
+    calls = number * len(NODES)
+    print("{0:<16} encode {1:8.1f}us  decode {2:8.1f}us  id length {3:5.1f}".format(
+        name, encoding / calls * 1e6, decoding / calls * 1e6,
+        sum(len(hashid) for hashid in hashids) / len(hashids)))
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='glutton.benchmarks.nodeids')
+    parser.add_argument('--number', type=int, default=2000, help="Rounds over the sample URIs")
+    args = parser.parse_args(argv)
+
+    print("{0} URIs, {1:.1f} bytes long on average".format(len(NODES), sum(len(node) for node in NODES) / len(NODES)))
+
+    measure("legacy", legacy_encode, legacy_decode, args.number)
+    uncached = NodeIdCodec(cache_size=0)
+    measure("codec", uncached.encode, uncached.decode, args.number)
+    cached = NodeIdCodec()
+    measure("codec + LRU", cached.encode, cached.decode, args.number)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,113 @@
+"""
+A SPARQL 1.1 Query/Update HTTP endpoint over an in-memory rdflib graph,
+standing in for Fuseki in benchmarks.
+
+Each request waits `latency` seconds, as a network round trip and a
+remote store would, then is run against the graph under a lock. Glutton
+talks to it through SPARQLUpdateStore, like to any other triplestore.
+"""
+from http.server import BaseHTTPRequestHandler, HTTPServer
+import logging
+from socketserver import ThreadingMixIn
+import threading
+import time
+from urllib.parse import urlsplit, parse_qs
+
+from rdflib import Graph
+
+LOG = logging.getLogger(__name__)
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+class SPARQLStandIn(object):
+    def __init__(self, latency=0.0, host='127.0.0.1', port=0):
+        self.graph = Graph()
+        self.latency = latency
+
+        self.round_trips = 0
+        self.busy_time = 0.0
+        self._lock = threading.Lock()
+
+        self._server = _ThreadingHTTPServer((host, port), self._handler_class())
+        self._thread = None
+
+    @property
+    def query_endpoint(self):
+        return "http://{0}:{1}/query".format(*self._server.server_address)
+
+    @property
+    def update_endpoint(self):
+        return "http://{0}:{1}/update".format(*self._server.server_address)
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, name='sparql-stand-in', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def execute(self, operation, text):
+        """
+        Run a query or an update, return (content type, body)
+        """
+        if self.latency:
+            time.sleep(self.latency)
+
+        with self._lock:
+            started = time.perf_counter()
+            try:
+                self.round_trips += 1
+                if operation == 'update':
+                    self.graph.update(text)
+                    return 'text/plain', b''
+
+                result = self.graph.query(text)
+                if result.type in ('CONSTRUCT', 'DESCRIBE'):
+                    return 'application/rdf+xml', result.serialize(format='xml')
+                return 'application/sparql-results+xml', result.serialize(format='xml')
+            finally:
+                self.busy_time += time.perf_counter() - started
+
+    def _handler_class(self):
+        stand_in = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                url = urlsplit(self.path)
+                self.answer(url.path, parse_qs(url.query))
+
+            def do_POST(self):
+                url = urlsplit(self.path)
+                body = self.rfile.read(int(self.headers.get('Content-Length', 0))).decode('utf-8')
+                content_type = self.headers.get('Content-Type', '')
+                if content_type.startswith('application/x-www-form-urlencoded'):
+                    parameters = parse_qs(body)
+                else:
+                    # Sent directly, as application/sparql-query or application/sparql-update
+                    parameters = {'query': [body], 'update': [body]}
+                self.answer(url.path, parameters)
+
+            def answer(self, path, parameters):
+                operation = path.strip('/')
+                try:
+                    if operation not in ('query', 'update') or operation not in parameters:
+                        raise ValueError("Expected a {0} on /query or /update".format(operation))
+                    content_type, body = stand_in.execute(operation, parameters[operation][0])
+                    status = 200
+                except Exception as e:
+                    content_type, body, status = 'text/plain', str(e).encode('utf-8'), 400
+
+                self.send_response(status)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                LOG.debug(format, *args)
+
+        return Handler
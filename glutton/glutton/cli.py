@@ -0,0 +1,112 @@
+"""
+Glutton maintenance commands, run next to the API-Hour workers:
+
+    python -m glutton.cli import --config-dir etc/glutton http://localhost:8008/dump dump.nt
+    python -m glutton.cli migrate-layout --config-dir etc/glutton
+    python -m glutton.cli index-containment --config-dir etc/glutton
+"""
+import argparse
+import asyncio
+import copy
+import logging
+import os
+
+from api_hour.config import get_config
+from rdflib.term import URIRef
+
+from . import Container
+from .utils import negotiation
+from .services.bulk import bulk_import, import_formats
+from .services.migration import migrate_to_named_graphs, index_containment
+
+LOG = logging.getLogger(__name__)
+
+# Content type guessed from the file extension
+EXTENSION_CONTENT_TYPES = {
+    '.nt': 'application/n-triples',
+    '.nq': 'application/n-quads',
+    '.ttl': 'text/turtle',
+    '.jsonld': 'application/ld+json',
+}
+
+def run_container(config, coroutine_factory):
+    """
+    Start a Container (engines only, no server), run coroutine_factory(container)
+    then stop it.
+    """
+    loop = asyncio.get_event_loop()
+
+    # No request to answer, don't load the existence filter
+    config = copy.deepcopy(config)
+    config.setdefault('caches', {}).setdefault('existence', {})['enabled'] = False
+    container = Container(config=config, worker=None, loop=loop)
+
+    loop.run_until_complete(container.start())
+    try:
+        return loop.run_until_complete(coroutine_factory(container))
+    finally:
+        loop.run_until_complete(container.stop())
+
+def import_command(args, config):
+    negotiation.configure(config.get('formats', {}))
+    formats = import_formats()
+
+    rdflib_format = args.format or formats.get(EXTENSION_CONTENT_TYPES.get(os.path.splitext(args.file)[1]))
+    if rdflib_format is None:
+        raise SystemExit("Can't guess the format of {0}, use --format".format(args.file))
+    if rdflib_format not in formats.values():
+        raise SystemExit("Unknown format {0}, use one of: {1}".format(rdflib_format, ", ".join(sorted(set(formats.values())))))
+
+    bulk_config = config.get('bulk', {})
+    with open(args.file, 'rb') as source:
+        stats = run_container(config, lambda container: bulk_import(container, URIRef(args.ldpc.rstrip("/")), source, rdflib_format,
+                                                                    batch_size=args.batch_size or bulk_config.get('batch_size', 10000),
+                                                                    concurrency=args.concurrency or bulk_config.get('concurrency', 4),
+                                                                    base=args.base,
+                                                                    loop=container.loop))
+
+    print("Imported {triples} triples in {batches} batches, {seconds}s ({triples_per_second} triples/s)".format(**stats.as_dict()))
+
+def migrate_layout_command(args, config):
+    subjects, triples = run_container(config, lambda container: migrate_to_named_graphs(container, batch_size=args.batch_size))
+
+    print("Moved {0} subjects ({1} triples) to their named graph".format(subjects, triples))
+    if config['engines']['triplestore'].get('layout', 'default') != 'named-graphs':
+        print("Set engines.triplestore.layout to named-graphs before restarting the workers")
+
+def index_containment_command(args, config):
+    count = run_container(config, index_containment)
+
+    print("{0} LDPRs know their LDPC, restart the workers to drop their cached metadata".format(count))
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='glutton')
+    parser.add_argument('--config-dir', default='etc/glutton', help="API-Hour config dir")
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+
+    import_parser = subparsers.add_parser('import', help="Bulk import an RDF dump into a LDPC")
+    import_parser.add_argument('ldpc', help="LDPC URI, e.g. http://localhost:8008/dump")
+    import_parser.add_argument('file', help="RDF dump")
+    import_parser.add_argument('--format',
+                               help="rdflib format, one of the configured formats (or nquads), guessed from the file extension by default")
+    import_parser.add_argument('--batch-size', type=int, help="Triples per SPARQL update")
+    import_parser.add_argument('--concurrency', type=int, help="SPARQL updates in flight")
+    import_parser.add_argument('--base', help="Base IRI of the dump, its IRIs are moved under the LDPC")
+    import_parser.set_defaults(func=import_command)
+
+    migrate_parser = subparsers.add_parser('migrate-layout', help="Move LDPRs from the default graph to their own named graph")
+    migrate_parser.add_argument('--batch-size', type=int, default=1000, help="Subjects moved per SPARQL update")
+    migrate_parser.set_defaults(func=migrate_layout_command)
+
+    index_parser = subparsers.add_parser('index-containment', help="Index the LDPC of LDPRs created by older versions")
+    index_parser.set_defaults(func=index_containment_command)
+
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO)
+
+    config = get_config({'config_dir': args.config_dir})
+    args.func(args, config)
+
+if __name__ == '__main__':
+    main()
@@ -1 +1,3 @@
-from . import index
\ No newline at end of file
+from . import index
+from . import bulk
+from . import metrics
@@ -0,0 +1,45 @@
+import asyncio
+import io
+import logging
+from urllib.parse import urljoin
+
+from aiohttp.web import Response, HTTPUnsupportedMediaType
+from rdflib.term import URIRef
+import ujson
+
+from ..services.bulk import bulk_import, import_formats
+from ..utils.streams import RequestBodyReader
+
+LOG = logging.getLogger(__name__)
+
+class BulkImportView(object):
+    @asyncio.coroutine
+    def post(self, request):
+        """
+        Import an RDF dump into the LDPC at /_import/{path}: every subject
+        becomes a LDPR of that LDPC. The ?base= parameter is the base IRI
+        of the dump, whose IRIs are moved under the LDPC.
+        """
+        container = request.app['ah_container']
+        ldpc_ref = URIRef(urljoin("http://" + request.host, request.match_info['path']).rstrip("/")) # HTTP Hardcoded, what about ssl?
+
+        content_type = request.headers.get('Content-type', '').split(';')[0].strip()
+        rdflib_format = import_formats().get(content_type)
+        if not rdflib_format:
+            raise HTTPUnsupportedMediaType(reason="Unknown file format: {0}. Check your Content-type header.".format(content_type))
+
+        bulk_config = container.config.get('bulk', {})
+        body = RequestBodyReader(timeout=container.config.get('uploads', {}).get('read_timeout', 60))
+        pump = container.loop.create_task(body.pump(request.content, container.loop))
+        try:
+            stats = yield from bulk_import(container, ldpc_ref, io.BufferedReader(body), rdflib_format,
+                                           batch_size=bulk_config.get('batch_size', 10000),
+                                           concurrency=bulk_config.get('concurrency', 4),
+                                           base=request.GET.get('base') or None,
+                                           loop=container.loop)
+        finally:
+            pump.cancel()
+            body.discard()
+
+        return Response(body=ujson.dumps(stats.as_dict()).encode('utf-8'),
+                        content_type='application/json')
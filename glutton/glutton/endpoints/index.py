@@ -4,56 +4,116 @@ import logging
 from urllib.parse import urljoin
 
 from aiohttp.multidict import CIMultiDict
-from aiohttp.web import Response
+from aiohttp.web import Response, StreamResponse
 from aiohttp.web import HTTPNotFound, HTTPMethodNotAllowed, HTTPCreated, HTTPNotAcceptable, HTTPNoContent
-from aiohttp.web import HTTPUnsupportedMediaType, HTTPInternalServerError, HTTPAccepted
-import hashlib
+from aiohttp.web import HTTPUnsupportedMediaType, HTTPInternalServerError, HTTPAccepted, HTTPBadRequest
 from rdflib import Graph
 from rdflib.namespace import RDF, DCTERMS
 from rdflib.term import URIRef
-from slugify import UniqueSlugify
-import uuid
 
-from ..services.data import ldpr_get, ldpr_new, ldpr_delete, ldpr_modification_date
-from ..services.data import node_exists, node_has_type, node_is_deleted, node_objects
+from ..services.data import ldpr_new, ldpr_delete, ldpr_triples_page
+from ..services.data import ldpc_page, ldpc_previous_page_start, WriteBatch
+from ..services.patch import parse_patch, ldpr_patch, InvalidPatch, ForbiddenPatch, UnprocessablePatch, ConcurrentPatch
+from ..services.slugs import slug_reserve, slug_claim, slug_release
 from ..utils.decorators import method_capabilities_headers, check_weak_etag, ldpr_exists_or_404
-from ..utils.exceptions import HTTPPreconditionRequired, LDPHTTPConflict
+from ..utils.exceptions import HTTPPreconditionRequired, HTTPUnprocessableEntity, LDPHTTPConflict, LDPHTTPConditionFailed
 from ..utils.misc import (get_hashid_for_node, get_node_by_hashid,
                           resolve_accept_header_to_rdflib_format,
-                          get_ldpr_from_request, feed_graph_from_request)
+                          get_ldpr_from_request, feed_graph_from_request, read_body_from_request,
+                          get_ldpr_state, forget_ldpr_state, get_page_request, get_etag, coalesce)
+from ..utils import negotiation
 from ..utils.namespace import LDP
+from ..utils.serializers import serialize, client_triples, STREAM_WRITERS
 
 LOG = logging.getLogger(__name__)
 
-class RDFGraphResponse(Response):
+def ldpr_type_links(state):
+    """
+    "Link:" headers advertising the LDP interaction model of a LDPR
+    """
+    links = ["<http://www.w3.org/ns/ldp#Resource>; rel=\"type\""]
+
+    if state.has_type(LDP.BasicContainer):
+        links.append("<http://www.w3.org/ns/ldp#BasicContainer>; rel=\"type\"")
+
+    return links
+
+class LDPRResponseMixin(object):
+    @asyncio.coroutine
+    def compute_etag(self, request):
+        """
+        Compute etag based on the modification date of the LDPR
+        (and the page, if one was requested) and add the "Etag:" header
+        to the Response.
+        """
+        state = yield from get_ldpr_state(request)
+        etag = get_etag(request, state)
+
+        if etag:
+            self.headers.add('Etag', etag)
+
+class RDFGraphResponse(LDPRResponseMixin, Response):
     """
     Serialize graph to required format
+
+    With no graph, only the headers are computed (e.g. for HEAD). An
+    already serialized body can be given to skip serialization.
     """
-    def __init__(self, graph, accept_header='text/turtle', status=200, reason=None, headers=None):
+    def __init__(self, graph, accept_header='text/turtle', status=200, reason=None, headers=None, body=None):
         selected_content_type, selected_format = resolve_accept_header_to_rdflib_format(accept_header)
         headers.add('Content-type', selected_content_type)
 
-        body = graph.serialize(format=selected_format) # FIXME: Should use uJSON
+        if body is None and graph is not None:
+            body = serialize(graph, selected_content_type, selected_format)
 
         super().__init__(body=body, status=status, reason=reason,
                          headers=headers, content_type=selected_content_type)
 
+class RDFStreamResponse(LDPRResponseMixin, StreamResponse):
+    """
+    Stream the triples of a LDPR, page by page, as chunked content
+
+    Pages are fetched once the headers are sent (in write_eof, which the
+    request handler calls last), so memory stays bounded by the page size.
+    """
+    def __init__(self, container, ldpr_ref, content_type, page_size=5000, status=200, reason=None, headers=None):
+        super().__init__(status=status, reason=reason)
+        if headers is not None:
+            self.headers.extend(headers)
+        self.content_type = content_type
+        self.enable_chunked_encoding()
+
+        self._container = container
+        self._ldpr_ref = ldpr_ref
+        self._page_size = page_size
+
     @asyncio.coroutine
-    def compute_etag(self, request):
-        """
-        Compute etag based on the modification date of the LDPR
-        and add the "Etag:" header to the Response.
-        """
-        ldpr_ref = get_ldpr_from_request(request)
-        modification_date = yield from ldpr_modification_date(request.app['ah_container'], ldpr_ref)
-        etag = 'W/"{0}"'.format(hashlib.md5(modification_date).hexdigest())
+    def write_eof(self):
+        writer = STREAM_WRITERS[self.content_type]()
+
+        offset = 0
+        while True:
+            triples = yield from ldpr_triples_page(self._container, self._ldpr_ref,
+                                                   self._page_size, offset)
+            self.write(writer.feed(client_triples(triples)))
+            yield from self.drain()
+
+            if len(triples) < self._page_size:
+                break
+            offset += self._page_size
 
-        self.headers.add('Etag', etag)
+        self.write(writer.close())
+        yield from super().write_eof()
 
 
 class LDPRDFSourceResourceView(object):
     allowed_methods = ('POST', 'PATCH', 'PUT', 'GET', 'OPTIONS', 'HEAD')
-    accepted_post_formats = ('text/turtle', 'application/ld+json')
+    accepted_patch_formats = ('application/sparql-update',)
+
+    @property
+    def accepted_post_formats(self):
+        # Whatever the "formats" configuration offers
+        return negotiation.content_types()
 
     @asyncio.coroutine
     @ldpr_exists_or_404
@@ -65,12 +125,6 @@ class LDPRDFSourceResourceView(object):
 
         ldpr_ref = get_ldpr_from_request(request)
 
-        # Check if current node exist
-        exists = yield from node_exists(container, ldpr_ref)
-        deleted = yield from node_is_deleted(container, ldpr_ref)
-        if not exists or deleted:
-            return HTTPNotFound(reason='There is no such resource')
-
         res = yield from ldpr_delete(container, ldpr_ref) # FIXME: Make sure everything is ok
 
         LOG.debug("delete done")
@@ -88,9 +142,47 @@ class LDPRDFSourceResourceView(object):
 
     @asyncio.coroutine
     @ldpr_exists_or_404
+    @check_weak_etag
     def patch(self, request):
-        yield
-        return Response()
+        """
+        Apply a SPARQL update restricted to the LDPR, writing only the
+        triples it changes
+        """
+        container = request.app['ah_container']
+
+        ldpr_ref = get_ldpr_from_request(request)
+
+        # If-match is required to prevent collisions
+        if not request.headers.get("If-match"):
+            raise HTTPPreconditionRequired(reason="Missing If-match header")
+
+        content_type = request.headers.get('Content-type', '').split(';')[0].strip()
+        if content_type not in self.accepted_patch_formats:
+            raise HTTPUnsupportedMediaType(reason="Use one of: {0}".format(", ".join(self.accepted_patch_formats)))
+
+        # Checked against If-match by the decorators, the write is conditioned on it
+        state = yield from get_ldpr_state(request)
+
+        body = yield from read_body_from_request(request)
+        try:
+            update, predicates = parse_patch(body.decode('utf-8'), ldpr_ref)
+            yield from ldpr_patch(container, ldpr_ref, update, predicates, modification_date=state.modification_date)
+        except ConcurrentPatch as e:
+            raise LDPHTTPConditionFailed(reason=str(e))
+        except ForbiddenPatch as e:
+            raise LDPHTTPConflict(reason=str(e))
+        except UnprocessablePatch as e:
+            raise HTTPUnprocessableEntity(reason=str(e))
+        except (InvalidPatch, UnicodeDecodeError) as e:
+            raise HTTPBadRequest(reason=str(e))
+
+        forget_ldpr_state(request)
+        state = yield from get_ldpr_state(request, metadata_only=True)
+
+        headers = CIMultiDict()
+        if state.etag:
+            headers.add('Etag', state.etag)
+        return HTTPNoContent(headers=headers)
 
     @asyncio.coroutine
     @check_weak_etag
@@ -103,12 +195,11 @@ class LDPRDFSourceResourceView(object):
         ldpr_ref = get_ldpr_from_request(request)
 
         # Check if current node exist
-        deleted = yield from node_is_deleted(container, ldpr_ref)
-        if deleted:
-            raise HTTPConflict(reason="Can't reuse old URIs.")
+        state = yield from get_ldpr_state(request)
+        if state.deleted:
+            raise LDPHTTPConflict(reason="Can't reuse old URIs.")
 
-        exists = yield from node_exists(container, ldpr_ref)
-        if not exists: # Creation
+        if not state.exists: # Creation
             # raise HTTPMethodNotAllowed(method='PUT', reason='use POST to create resource', allowed_methods=('POST',))
             response = yield from self.post(request)
             return response
@@ -122,22 +213,24 @@ class LDPRDFSourceResourceView(object):
             client_graph = yield from feed_graph_from_request(ldpr_ref, client_graph, request)
 
             # Check if containement triple were modified (forbidden by spec)
-            old_containement = yield from node_objects(container, ldpr_ref, LDP.contains)
+            old_containement = set(state.graph.objects(ldpr_ref, LDP.contains))
             new_containement = set()
-            for obj in client_graph.objects((ldpr_ref, LDP.contains)):
+            for obj in client_graph.objects(ldpr_ref, LDP.contains):
                 new_containement.add(obj)
 
             if old_containement != new_containement:
                 raise LDPHTTPConflict(reason="You are not allowed to update an LPDC's containement triples.")
 
-            # FIXME Should be transactional
-            yield from ldpr_delete(container, ldpr_ref, mark_deleted=False, remove_containement_triples=False)
-            yield from ldpr_new(container, ldpr_ref, client_graph, ldpc_ref=None)
+            # Replace the LDPR atomically
+            batch = WriteBatch()
+            yield from ldpr_delete(container, ldpr_ref, mark_deleted=False, remove_containement_triples=False, batch=batch)
+            yield from ldpr_new(container, ldpr_ref, client_graph, ldpc_ref=None, batch=batch)
+            yield from batch.commit(container)
 
         # Give the new LDPR graph back
-        response_graph = Graph()
-        for triple in ldpr_get(container, ldpr_ref):
-            response_graph.add(triple)
+        forget_ldpr_state(request)
+        state = yield from get_ldpr_state(request)
+        response_graph = state.graph
 
         headers = CIMultiDict([('Location', ldpr_ref)])
         content_type_header = request.headers.get('Content-type', None)
@@ -162,32 +255,24 @@ class LDPRDFSourceResourceView(object):
         # if not has_type:
         #     raise HTTPMethodNotAllowed(method='POST', allowed_methods=('GET', 'OPTIONS', 'HEAD')) # FIXME Hardcoded
 
-        # Compute a potentiel future slug for the newly created ldpr
+        # Reserve a free slug for the newly created ldpr, based on the suggestion if any
         suggested_slug = request.headers.get("Slug", None)
+        ldpr_ref, reservation = yield from slug_reserve(container, ldpc_ref, suggested_slug)
 
-        slugger = UniqueSlugify(to_lower=True)
-        if suggested_slug:
-            # Loop while we find a free slug based on the suggestion
-            # FIXME Processing time will grow with slug occupation
-            future_slug = None
-            while not future_slug:
-                possible_slug = slugger(suggested_slug)
-                possible_uriref = URIRef(ldpc_ref + "/" + possible_slug)
-                exists = yield from node_exists(container, possible_uriref)
-                deleted = yield from node_is_deleted(container, possible_uriref)
-                if not exists and not deleted:
-                    future_slug = possible_slug
-        else:
-            future_slug = str(uuid.uuid4())
-
-        ldpr_ref = ldpc_ref + "/" + future_slug
-
-        # Parse input file
-        client_graph = Graph()
-        client_graph = yield from feed_graph_from_request(ldpr_ref, client_graph, request)
-
-        # Now we have the file as a temporary graph, store it to the backstore
-        yield from ldpr_new(container, ldpr_ref, client_graph, ldpc_ref)
+        try:
+            # Parse input file
+            client_graph = Graph()
+            client_graph = yield from feed_graph_from_request(ldpr_ref, client_graph, request)
+
+            # Now we have the file as a temporary graph, store it to the backstore
+            batch = WriteBatch()
+            slug_claim(batch, ldpr_ref)
+            yield from ldpr_new(container, ldpr_ref, client_graph, ldpc_ref, batch=batch)
+            yield from batch.commit(container)
+        except:
+            # Failed or cancelled before being claimed (if claimed, there is nothing left to release)
+            yield from slug_release(container, ldpr_ref, reservation)
+            raise
 
         headers = CIMultiDict([('Location', ldpr_ref)])
         return HTTPCreated(headers=headers)
@@ -198,32 +283,15 @@ class LDPRDFSourceResourceView(object):
     @method_capabilities_headers
     def head(self, request):
         """
-        Output headers of GET
-
-        FIXME: This should not output the whole content but rather save
-        time by not loading all the data.
+        Output headers of GET, without loading nor serializing the triples
         """
-        container = request.app['ah_container']
-
-        ldpr_ref = get_ldpr_from_request(request)
+        # Loaded (and checked) by the decorators
+        state = yield from get_ldpr_state(request, metadata_only=True)
 
-        # Check if current node exist
-        exists = yield from node_exists(container, ldpr_ref)
-        deleted = yield from node_is_deleted(container, ldpr_ref)
-        if not exists or deleted:
-            raise HTTPNotFound(reason='There is no such resource')
-
-        response_graph = Graph()
-        for triple in ldpr_get(container, ldpr_ref):
-            response_graph.add(triple)
-
-        headers = CIMultiDict([('Link', "<http://www.w3.org/ns/ldp#Resource>; rel=\"type\"")])
-
-        if (ldpr_ref, RDF.type, LDP.BasicContainer) in response_graph:
-            headers.add('Link', "<http://www.w3.org/ns/ldp#BasicContainer>; rel=\"type\"")
+        headers = CIMultiDict([('Link', link) for link in ldpr_type_links(state)])
 
         accept_header = request.headers.get('Accept', None)
-        response = RDFGraphResponse(response_graph, accept_header, headers=headers)
+        response = RDFGraphResponse(None, accept_header, headers=headers)
         yield from response.compute_etag(request)
         return response
 
@@ -236,25 +304,120 @@ class LDPRDFSourceResourceView(object):
         Output a graph node (either LDPR or LDPRC) as RDF
         """
         container = request.app['ah_container']
+        representations = container.caches['representations']
 
-        ldpr_ref = get_ldpr_from_request(request)
+        # Checked by the decorators, may have been loaded as metadata only
+        state = yield from get_ldpr_state(request)
 
-        # Check if current node exist
-        exists = yield from node_exists(container, ldpr_ref)
-        deleted = yield from node_is_deleted(container, ldpr_ref)
-        if not exists or deleted:
-            raise HTTPNotFound(reason='There is no such resource')
+        headers = CIMultiDict([('Link', link) for link in ldpr_type_links(state)])
+        accept_header = request.headers.get('Accept', None)
+
+        # LDP Paging
+        if state.has_type(LDP.Container):
+            # Pages and the whole LDPC share the URI
+            headers.add('Vary', 'Prefer')
+            page = get_page_request(request, state)
+            if page is not None:
+                response = yield from self.get_page(request, state, page, headers)
+                return response
+
+        # Serve the cached representation for this version if any
+        content_type, rdflib_format = resolve_accept_header_to_rdflib_format(accept_header)
+        cache_key = (state.ref, content_type, state.etag)
+        body = None
+        if state.etag:
+            body = representations.get(cache_key)
+
+        if body is None:
+            # Concurrent GETs of this version share the fetch and serialization
+            state, body = yield from coalesce(request, ('representation',) + cache_key,
+                                              lambda: self.render(request, cache_key, rdflib_format))
+            if body is None:
+                response = yield from self.stream(request, state, content_type, headers)
+                return response
+
+        response = RDFGraphResponse(None, accept_header, headers=headers, body=body)
+
+        yield from response.compute_etag(request)
+        return response
+
+    @asyncio.coroutine
+    def render(self, request, cache_key, rdflib_format):
+        """
+        Load and serialize the requested LDPR, keeping the representation
+        for its version. Return (state, body), body being None for LDPRs
+        too big to be loaded at once.
+        """
+        container = request.app['ah_container']
+        content_type = cache_key[1]
+
+        state = yield from get_ldpr_state(request, metadata_only=False)
+        if state.truncated:
+            return state, None
+
+        body = serialize(state.graph, content_type, rdflib_format)
+        if state.etag:
+            container.caches['representations'].set(cache_key, body, size=len(body), tags=(state.ref,))
+
+        return state, body
 
-        response_graph = Graph()
-        for triple in ldpr_get(container, ldpr_ref):
-            response_graph.add(triple)
+    @asyncio.coroutine
+    def get_page(self, request, state, page, headers):
+        """
+        Output a page of a LDPC (W3C LDP Paging), given its (cursor, page
+        size)
 
-        headers = CIMultiDict([('Link', "<http://www.w3.org/ns/ldp#Resource>; rel=\"type\"")])
+        Pages are identified by their first member so that they stay stable
+        when members are added or removed elsewhere in the container.
+        """
+        container = request.app['ah_container']
 
-        if (ldpr_ref, RDF.type, LDP.BasicContainer) in response_graph:
-            headers.add('Link', "<http://www.w3.org/ns/ldp#BasicContainer>; rel=\"type\"")
+        cursor, page_size = page
+        start = None
+        if cursor:
+            try:
+                start = get_node_by_hashid(cursor)
+            except ValueError:
+                start = None
+            if not start:
+                raise HTTPBadRequest(reason="Invalid page")
+
+        page_graph, next_start = yield from ldpc_page(container, state.ref, page_size, start)
+
+        def page_link(member, rel):
+            page_ref = state.ref + "?page=" + (get_hashid_for_node(member) if member else "")
+            return "<{0}>; rel=\"{1}\"".format(page_ref, rel)
+
+        headers.add('Link', "<http://www.w3.org/ns/ldp#Page>; rel=\"type\"")
+        headers.add('Link', "<{0}>; rel=\"canonical\"".format(state.ref))
+        headers.add('Link', page_link(None, "first"))
+        if next_start is not None:
+            headers.add('Link', page_link(next_start, "next"))
+        if start is not None:
+            previous_start = yield from ldpc_previous_page_start(container, state.ref, page_size, start)
+            headers.add('Link', page_link(previous_start, "prev"))
+        headers.add('Preference-Applied', 'return=representation')
 
         accept_header = request.headers.get('Accept', None)
-        response = RDFGraphResponse(response_graph, accept_header, headers=headers)
+        response = RDFGraphResponse(page_graph, accept_header, headers=headers)
+        yield from response.compute_etag(request)
+        return response
+
+    @asyncio.coroutine
+    def stream(self, request, state, content_type, headers):
+        """
+        Output a LDPR too big to be loaded at once
+        """
+        container = request.app['ah_container']
+
+        # Loading it whole is what streaming avoids
+        if content_type not in STREAM_WRITERS:
+            raise HTTPNotAcceptable(reason="{0} is too big to be served as {1}, use one of: {2}".format(state.ref, content_type,
+                                                                                                   ", ".join(sorted(STREAM_WRITERS))))
+
+        page_size = container.config.get('streaming', {}).get('page_size', 5000)
+        response = RDFStreamResponse(container, state.ref, content_type,
+                                     page_size=page_size, headers=headers)
+
         yield from response.compute_etag(request)
         return response
@@ -0,0 +1,39 @@
+import asyncio
+import logging
+
+from aiohttp.web import Response
+
+from ..utils import metrics
+
+LOG = logging.getLogger(__name__)
+
+class MetricsView(object):
+    @asyncio.coroutine
+    def get(self, request):
+        """
+        Output this worker's metrics in the Prometheus text format
+        """
+        container = request.app['ah_container']
+
+        gauges = list(metrics.cache_gauges(container.caches))
+
+        gauges.append(('glutton_coalesced_calls_in_flight', {}, len(container.reads)))
+
+        if container.existence is not None:
+            for stat, value in sorted(container.existence.stats().items()):
+                gauges.append(('glutton_existence_filter_' + stat, {}, value))
+
+        engine = container.engines.get('triplestore')
+        if engine is not None and engine.done() and not engine.exception():
+            store = engine.result()
+            pool = store.pool
+            gauges.append(('glutton_triplestore_pool_size', {}, pool.size))
+            gauges.append(('glutton_triplestore_pool_free', {}, pool.free))
+            gauges.append(('glutton_triplestore_pool_waiters', {}, pool.waiters))
+            for replica in store.replicas:
+                gauges.append(('glutton_triplestore_replica_healthy', {'replica': replica.uri}, int(replica.healthy)))
+            for replica in store.replicas:
+                gauges.append(('glutton_triplestore_replica_outstanding', {'replica': replica.uri}, replica.outstanding))
+
+        body = metrics.REGISTRY.render(gauges)
+        return Response(body=body.encode('utf-8'), content_type='text/plain; version=0.0.4')
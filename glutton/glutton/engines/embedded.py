@@ -0,0 +1,630 @@
+"""
+Embedded triple store: an rdflib Store persisted in a local directory
+
+Terms are interned as integers. Quads (subject, predicate, object, graph)
+are kept in four files of sorted, fixed size records, one per ordering
+(SPO, POS, OSP, and GSPO for named graphs). The files are memory-mapped
+and binary searched, so a lookup bound on any term costs a few page reads
+instead of an HTTP round trip. Writes go to an in-memory delta; on commit
+they are appended to a log, ended by a commit record, and the delta is
+merged into a new generation of index files once it grows big enough.
+Writes not committed yet can be rolled back.
+
+Select it in main.yaml with `driver: Embedded` and the directory as `uri`.
+SPARQL queries and updates are evaluated by rdflib over this store. Only
+one process may open a directory: it is locked while open.
+"""
+import fcntl
+import heapq
+import json
+import logging
+import mmap
+import os
+import struct
+import threading
+
+from rdflib.graph import Graph, ConjunctiveGraph, DATASET_DEFAULT_GRAPH_ID
+from rdflib.store import Store, VALID_STORE
+from rdflib.term import URIRef, BNode, Literal
+
+LOG = logging.getLogger(__name__)
+
+# Quads in the delta before it is merged into the index files
+MERGE_THRESHOLD = 100000
+
+# (s, p, o, g) term ids, big endian so that records sort like their bytes
+RECORD = struct.Struct('>QQQQ')
+# Operation (b'+' or b'-', b'C' ending a commit) and quad
+LOG_RECORD = struct.Struct('>cQQQQ')
+COMMIT_RECORD = LOG_RECORD.pack(b'C', 0, 0, 0, 0)
+
+# Positions of the quad terms in the records of each index
+ORDERINGS = {
+    'spo': (0, 1, 2, 3),
+    'pos': (1, 2, 0, 3),
+    'osp': (2, 0, 1, 3),
+    'gspo': (3, 0, 1, 2),
+}
+
+def _to_key(quad, ordering):
+    return tuple(quad[position] for position in ordering)
+
+def _to_quad(key, ordering):
+    quad = [0, 0, 0, 0]
+    for value, position in zip(key, ordering):
+        quad[position] = value
+    return tuple(quad)
+
+class _TermDictionary(object):
+    """
+    Terms to integer ids (from 1), kept in an append-only file of JSON lines
+    """
+    def __init__(self, path):
+        self._ids = {}
+        self._terms = [None]
+
+        self._file = open(path, 'a+b')
+        self._file.seek(0)
+        valid_size = 0
+        for line in self._file:
+            try:
+                if not line.endswith(b'\n'):
+                    raise ValueError("Incomplete line")
+                term = self._decode(json.loads(line.decode('utf-8')))
+            except ValueError:
+                LOG.warning("Dropping the truncated end of {0}".format(path))
+                break
+            self._ids[term] = len(self._terms)
+            self._terms.append(term)
+            valid_size += len(line)
+        self._file.truncate(valid_size)
+
+    def id(self, term):
+        return self._ids.get(term)
+
+    def intern(self, term):
+        term_id = self._ids.get(term)
+        if term_id is None:
+            term_id = self._ids[term] = len(self._terms)
+            self._terms.append(term)
+            self._file.write((json.dumps(self._encode(term), ensure_ascii=False) + '\n').encode('utf-8'))
+        return term_id
+
+    def term(self, term_id):
+        return self._terms[term_id]
+
+    def sync(self):
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def close(self):
+        self._file.close()
+
+    def _encode(self, term):
+        if isinstance(term, Literal):
+            return ['L', str(term), term.language, term.datatype and str(term.datatype)]
+        if isinstance(term, BNode):
+            return ['B', str(term)]
+        if isinstance(term, URIRef):
+            return ['U', str(term)]
+        raise TypeError("Can't store {0!r}".format(term))
+
+    def _decode(self, encoded):
+        if encoded[0] == 'L':
+            return Literal(encoded[1], lang=encoded[2], datatype=encoded[3] and URIRef(encoded[3]))
+        if encoded[0] == 'B':
+            return BNode(encoded[1])
+        return URIRef(encoded[1])
+
+class _Index(object):
+    """
+    A memory-mapped file of sorted records
+    """
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, 'rb')
+        size = os.fstat(self._file.fileno()).st_size
+        self._map = mmap.mmap(self._file.fileno(), size, access=mmap.ACCESS_READ) if size else b''
+        self.count = size // RECORD.size
+
+    def __iter__(self):
+        return self.range(0, self.count)
+
+    def __contains__(self, key):
+        record = RECORD.pack(*key)
+        index = self._bisect(record, strict=False)
+        return index < self.count and self._map[index * RECORD.size:(index + 1) * RECORD.size] == record
+
+    def prefix(self, prefix):
+        """
+        Iterate over the records starting with the prefix values
+        """
+        prefix = struct.pack('>' + 'Q' * len(prefix), *prefix)
+        return self.range(self._bisect(prefix, strict=False), self._bisect(prefix, strict=True))
+
+    def range(self, start, stop):
+        for index in range(start, stop):
+            yield RECORD.unpack_from(self._map, index * RECORD.size)
+
+    def distinct_first(self):
+        """
+        Iterate over the distinct first values of the records, skipping
+        over the records sharing one
+        """
+        index = 0
+        while index < self.count:
+            value = RECORD.unpack_from(self._map, index * RECORD.size)[0]
+            yield value
+            index = self._bisect(struct.pack('>Q', value), strict=True)
+
+    def close(self):
+        if self.count:
+            self._map.close()
+        self._file.close()
+
+    def _bisect(self, prefix, strict):
+        """
+        First record whose beginning is >= prefix (> if strict)
+        """
+        size = len(prefix)
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            start = middle * RECORD.size
+            key = self._map[start:start + size]
+            if key < prefix or (strict and key == prefix):
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+class _Database(object):
+    """
+    The files of a store directory, shared by every EmbeddedStore of the
+    process opened on it. Callers hold `lock` around every operation.
+    """
+    _opened = {}
+    _opened_lock = threading.Lock()
+
+    @classmethod
+    def acquire(cls, path):
+        path = os.path.abspath(path)
+        with cls._opened_lock:
+            database = cls._opened.get(path)
+            if database is None:
+                database = cls._opened[path] = cls(path)
+            database.users += 1
+        return database
+
+    @classmethod
+    def release(cls, database):
+        with cls._opened_lock:
+            database.users -= 1
+            if database.users == 0:
+                del cls._opened[database.path]
+                database.close()
+
+    def __init__(self, path):
+        self.path = path
+        self.users = 0
+        self.lock = threading.RLock()
+        self.namespaces = {}
+        self.graphs = set()
+
+        os.makedirs(path, exist_ok=True)
+        self._lock_file = open(os.path.join(path, 'LOCK'), 'w')
+        try:
+            fcntl.flock(self._lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            self._lock_file.close()
+            raise RuntimeError("Store {0} is used by another process".format(path))
+
+        self.terms = _TermDictionary(os.path.join(path, 'terms'))
+
+        try:
+            with open(os.path.join(path, 'CURRENT')) as current:
+                self._generation = int(current.read())
+        except FileNotFoundError:
+            self._generation = 0
+        self._indexes = self._open_indexes(self._generation)
+        self._remove_other_generations()
+
+        # Delta: quads added or removed since the last merge
+        self._added = set()
+        self._removed = set()
+        self._added_by_term = ({}, {}, {}, {})
+        # Writes since the last commit, in order, and the graphs before them
+        self._pending = []
+        self._pending_graphs = None
+
+        self._log_path = os.path.join(path, 'log')
+        self._replay_log()
+        self._log = open(self._log_path, 'ab')
+
+    # Reads
+    def match(self, pattern):
+        """
+        Iterate over the quads matching pattern, a quad of ids or None
+        """
+        s, p, o, g = pattern
+        if g is not None and (s is not None or (p is None and o is None)):
+            ordering = 'gspo'
+        elif s is not None:
+            ordering = 'osp' if p is None and o is not None else 'spo'
+        elif p is not None:
+            ordering = 'pos'
+        elif o is not None:
+            ordering = 'osp'
+        else:
+            ordering = 'spo'
+
+        positions = ORDERINGS[ordering]
+        prefix = []
+        for position in positions:
+            if pattern[position] is None:
+                break
+            prefix.append(pattern[position])
+
+        for key in self._indexes[ordering].prefix(prefix):
+            quad = _to_quad(key, positions)
+            if self._matches(quad, pattern) and quad not in self._removed:
+                yield quad
+
+        for quad in self._delta_candidates(pattern):
+            if self._matches(quad, pattern):
+                yield quad
+
+    def __contains__(self, quad):
+        return quad in self._added or (quad not in self._removed and quad in self._indexes['spo'])
+
+    def graph_ids(self):
+        """
+        Ids of the graphs holding quads, from the GSPO index and the delta
+        """
+        graph_ids = set(self._added_by_term[3])
+        for graph_id in self._indexes['gspo'].distinct_first():
+            if graph_id not in graph_ids and next(self.match((None, None, None, graph_id)), None) is not None:
+                graph_ids.add(graph_id)
+        return graph_ids
+
+    # Writes
+    def add(self, quad):
+        if self._add(quad):
+            self._pending.append((b'+', quad))
+
+    def remove(self, quad):
+        if self._remove(quad):
+            self._pending.append((b'-', quad))
+
+    def add_graph(self, identifier):
+        self._save_graphs()
+        self.graphs.add(identifier)
+
+    def remove_graph(self, identifier):
+        self._save_graphs()
+        self.graphs.discard(identifier)
+
+    def commit(self):
+        """
+        Make the writes durable, merge the delta if it grew big enough
+        """
+        self._pending_graphs = None
+        if not self._pending:
+            return
+
+        # Terms first: the log refers to them. Replayed only if the commit
+        # record made it to the disk
+        self.terms.sync()
+        self._log.write(b"".join(LOG_RECORD.pack(operation, *quad) for operation, quad in self._pending) + COMMIT_RECORD)
+        self._log.flush()
+        os.fsync(self._log.fileno())
+        self._pending = []
+
+        if len(self._added) + len(self._removed) >= MERGE_THRESHOLD:
+            self.merge()
+
+    def rollback(self):
+        """
+        Undo the writes since the last commit
+        """
+        for operation, quad in reversed(self._pending):
+            if operation == b'+':
+                self._remove(quad)
+            else:
+                self._add(quad)
+        self._pending = []
+
+        if self._pending_graphs is not None:
+            self.graphs, self._pending_graphs = self._pending_graphs, None
+
+    def merge(self):
+        """
+        Write the index files of a new generation: the current ones plus
+        the delta. Switch atomically to them, then drop the log.
+        """
+        generation = self._generation + 1
+        for name, ordering in ORDERINGS.items():
+            added = sorted(_to_key(quad, ordering) for quad in self._added)
+            with open(self._index_path(name, generation), 'wb') as index_file:
+                for key in heapq.merge(self._indexes[name], added):
+                    if _to_quad(key, ordering) not in self._removed:
+                        index_file.write(RECORD.pack(*key))
+                index_file.flush()
+                os.fsync(index_file.fileno())
+
+        current_path = os.path.join(self.path, 'CURRENT')
+        with open(current_path + '.tmp', 'w') as current:
+            current.write(str(generation))
+            current.flush()
+            os.fsync(current.fileno())
+        os.rename(current_path + '.tmp', current_path)
+
+        old_indexes = self._indexes
+        self._indexes, self._generation = self._open_indexes(generation), generation
+        for name, index in old_indexes.items():
+            index.close()
+            if os.path.exists(index.path):
+                os.unlink(index.path)
+
+        self._added, self._removed = set(), set()
+        self._added_by_term = ({}, {}, {}, {})
+        self._log.close()
+        self._log = open(self._log_path, 'wb')
+        LOG.info("Merged {0} into generation {1} ({2} quads)".format(self.path, generation, self._indexes['spo'].count))
+
+    def close(self):
+        self.commit()
+        self._log.close()
+        for index in self._indexes.values():
+            index.close()
+        self.terms.close()
+        fcntl.flock(self._lock_file.fileno(), fcntl.LOCK_UN)
+        self._lock_file.close()
+
+    def _add(self, quad):
+        """
+        Add quad to the delta, return False if it was already there
+        """
+        if quad in self._removed:
+            self._removed.discard(quad)
+        elif quad in self._added or quad in self._indexes['spo']:
+            return False
+        else:
+            self._added.add(quad)
+            for position, term_id in enumerate(quad):
+                self._added_by_term[position].setdefault(term_id, set()).add(quad)
+        return True
+
+    def _remove(self, quad):
+        """
+        Remove quad through the delta, return False if it was not there
+        """
+        if quad in self._added:
+            self._added.discard(quad)
+            for position, term_id in enumerate(quad):
+                quads = self._added_by_term[position][term_id]
+                quads.discard(quad)
+                if not quads:
+                    del self._added_by_term[position][term_id]
+        elif quad in self._indexes['spo'] and quad not in self._removed:
+            self._removed.add(quad)
+        else:
+            return False
+        return True
+
+    def _matches(self, quad, pattern):
+        for term_id, wanted in zip(quad, pattern):
+            if wanted is not None and term_id != wanted:
+                return False
+        return True
+
+    def _delta_candidates(self, pattern):
+        candidates = self._added
+        for position, term_id in enumerate(pattern):
+            if term_id is not None:
+                quads = self._added_by_term[position].get(term_id, ())
+                if len(quads) < len(candidates):
+                    candidates = quads
+        return list(candidates)
+
+    def _save_graphs(self):
+        if self._pending_graphs is None:
+            self._pending_graphs = set(self.graphs)
+
+    def _replay_log(self):
+        """
+        Apply the committed writes of the log; those of a commit cut by a
+        crash are dropped
+        """
+        try:
+            with open(self._log_path, 'rb') as log:
+                data = log.read()
+        except FileNotFoundError:
+            return
+
+        valid_size = 0
+        records = []
+        for offset in range(0, len(data) - len(data) % LOG_RECORD.size, LOG_RECORD.size):
+            record = LOG_RECORD.unpack_from(data, offset)
+            if record[0] != b'C':
+                records.append(record)
+                continue
+
+            for operation, *quad in records:
+                if operation == b'+':
+                    self._add(tuple(quad))
+                else:
+                    self._remove(tuple(quad))
+            records = []
+            valid_size = offset + LOG_RECORD.size
+
+        if valid_size != len(data):
+            LOG.warning("Dropping the uncommitted end of {0}".format(self._log_path))
+            with open(self._log_path, 'r+b') as log:
+                log.truncate(valid_size)
+
+    def _index_path(self, name, generation):
+        return os.path.join(self.path, '{0}.{1}'.format(name, generation))
+
+    def _remove_other_generations(self):
+        """
+        Drop index files left behind by a merge interrupted by a crash
+        """
+        current_paths = set(index.path for index in self._indexes.values())
+        for name in os.listdir(self.path):
+            path = os.path.join(self.path, name)
+            if name.split('.')[0] in ORDERINGS and path not in current_paths:
+                os.unlink(path)
+
+    def _open_indexes(self, generation):
+        indexes = {}
+        for name in ORDERINGS:
+            path = self._index_path(name, generation)
+            if not os.path.exists(path):
+                open(path, 'wb').close()
+            indexes[name] = _Index(path)
+        return indexes
+
+class EmbeddedStore(Store):
+    """
+    rdflib Store over a _Database. Context aware, so that it can back a
+    Dataset; the union of its graphs is the default graph.
+    """
+    context_aware = True
+    graph_aware = True
+
+    def __init__(self, configuration=None, identifier=None):
+        self._database = None
+        super().__init__(configuration, identifier)
+
+    @property
+    def lock(self):
+        return self._database.lock
+
+    def open(self, configuration, create=False):
+        self._database = _Database.acquire(configuration)
+        return VALID_STORE
+
+    def close(self, commit_pending_transaction=False):
+        if self._database is not None:
+            _Database.release(self._database)
+            self._database = None
+
+    def commit(self):
+        with self._database.lock:
+            self._database.commit()
+
+    def rollback(self):
+        with self._database.lock:
+            self._database.rollback()
+
+    def add(self, triple, context, quoted=False):
+        database = self._database
+        with database.lock:
+            quad = tuple(database.terms.intern(term) for term in triple) + (self._context_id(context, intern=True),)
+            database.add(quad)
+        super().add(triple, context, quoted)
+
+    def remove(self, triple, context=None):
+        database = self._database
+        with database.lock:
+            pattern = self._pattern(triple, context)
+            if pattern is not None:
+                for quad in list(database.match(pattern)):
+                    database.remove(quad)
+        super().remove(triple, context)
+
+    def triples(self, triple, context=None):
+        database = self._database
+        with database.lock:
+            pattern = self._pattern(triple, context)
+            if pattern is None:
+                return
+
+            # Snapshot, so that writes don't disturb the iteration
+            matches = {}
+            for quad in database.match(pattern):
+                matches.setdefault(quad[:3], []).append(quad[3])
+
+            terms = database.terms
+            results = [(tuple(terms.term(term_id) for term_id in ids), [terms.term(graph_id) for graph_id in graph_ids])
+                       for ids, graph_ids in matches.items()]
+
+        for triple, graph_ids in results:
+            yield triple, (Graph(store=self, identifier=graph_id) for graph_id in graph_ids)
+
+    def __len__(self, context=None):
+        return sum(1 for triple in self.triples((None, None, None), context))
+
+    def contexts(self, triple=None):
+        database = self._database
+        with database.lock:
+            if triple is None or triple == (None, None, None):
+                graph_ids = database.graph_ids()
+            else:
+                pattern = self._pattern(triple, None)
+                graph_ids = set(quad[3] for quad in database.match(pattern)) if pattern is not None else set()
+            identifiers = set(database.terms.term(graph_id) for graph_id in graph_ids)
+            if triple is None:
+                identifiers.update(database.graphs)
+
+        for identifier in identifiers:
+            yield Graph(store=self, identifier=identifier)
+
+    def add_graph(self, graph):
+        with self._database.lock:
+            self._database.add_graph(graph.identifier)
+
+    def remove_graph(self, graph):
+        self.remove((None, None, None), graph)
+        with self._database.lock:
+            self._database.remove_graph(graph.identifier)
+
+    def bind(self, prefix, namespace, override=True):
+        if override or prefix not in self._database.namespaces:
+            self._database.namespaces[prefix] = namespace
+
+    def namespace(self, prefix):
+        return self._database.namespaces.get(prefix)
+
+    def prefix(self, namespace):
+        for prefix, bound_namespace in self._database.namespaces.items():
+            if bound_namespace == namespace:
+                return prefix
+        return None
+
+    def namespaces(self):
+        return list(self._database.namespaces.items())
+
+    def _context_id(self, context, intern=False):
+        # Datasets (with default_union) write to their default graph through themselves
+        if isinstance(context, ConjunctiveGraph):
+            context = DATASET_DEFAULT_GRAPH_ID
+        identifier = getattr(context, 'identifier', context)
+        if intern:
+            return self._database.terms.intern(identifier)
+        return self._database.terms.id(identifier)
+
+    def _pattern(self, triple, context):
+        """
+        Quad pattern of ids, None if a term is not even known
+        """
+        pattern = []
+        for term in triple:
+            if term is None:
+                pattern.append(None)
+                continue
+            term_id = self._database.terms.id(term)
+            if term_id is None:
+                return None
+            pattern.append(term_id)
+
+        if context is None:
+            pattern.append(None)
+        else:
+            graph_id = self._context_id(context)
+            if graph_id is None:
+                return None
+            pattern.append(graph_id)
+
+        return tuple(pattern)
@@ -0,0 +1,135 @@
+import asyncio
+import errno
+import logging
+import os
+import socket
+
+LOG = logging.getLogger(__name__)
+
+# Keep datagrams well below the default socket buffer size
+MAX_DATAGRAM_SIZE = 8192
+# Room left for the header of a datagram
+HEADER_SIZE = 64
+
+class InvalidationBus(object):
+    """
+    Broadcast invalidated LDPRs to every worker running on this host.
+
+    Each worker binds a Unix datagram socket in a shared directory.
+    Publishing sends the invalidated references to every other socket found
+    there; received references are handed to the subscribers. Sockets left
+    behind by dead workers are removed on the way.
+
+    Datagrams can be lost (full queues): they are numbered per sender, so
+    that receivers notice gaps and tell their loss subscribers.
+    """
+    def __init__(self, directory, loop=None):
+        self.loop = loop or asyncio.get_event_loop()
+        self.directory = directory
+        self.path = os.path.join(directory, 'worker-{0}.sock'.format(os.getpid()))
+
+        self._subscribers = []
+        self._loss_subscribers = []
+        self._sequence = 0
+        self._received = {}
+
+        os.makedirs(directory, exist_ok=True)
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self._sock.setblocking(False)
+        self._sock.bind(self.path)
+        self.loop.add_reader(self._sock.fileno(), self._on_readable)
+
+    def subscribe(self, callback):
+        """
+        Call callback(ldpr_refs) whenever another worker invalidates LDPRs
+        """
+        self._subscribers.append(callback)
+
+    def subscribe_losses(self, callback):
+        """
+        Call callback() whenever invalidations of another worker were lost
+        """
+        self._loss_subscribers.append(callback)
+
+    def publish(self, ldpr_refs):
+        for datagram in self._datagrams(ldpr_refs):
+            # "#<sender> <sequence>" header; references are absolute IRIs, never starting with #
+            self._sequence += 1
+            datagram = "#{0} {1}\n".format(os.getpid(), self._sequence).encode('utf-8') + datagram
+            for name in os.listdir(self.directory):
+                peer = os.path.join(self.directory, name)
+                if peer == self.path:
+                    continue
+                self._send(datagram, peer)
+
+    def close(self):
+        self.loop.remove_reader(self._sock.fileno())
+        self._sock.close()
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+
+    def _datagrams(self, ldpr_refs):
+        datagram = b''
+        for ldpr_ref in ldpr_refs:
+            encoded_ref = str(ldpr_ref).encode('utf-8')
+            if datagram and len(datagram) + len(encoded_ref) + 1 > MAX_DATAGRAM_SIZE - HEADER_SIZE:
+                yield datagram
+                datagram = b''
+            datagram = datagram + b'\n' + encoded_ref if datagram else encoded_ref
+        if datagram:
+            yield datagram
+
+    def _send(self, datagram, peer):
+        try:
+            self._sock.sendto(datagram, peer)
+        except (ConnectionRefusedError, FileNotFoundError):
+            # Nobody listens there anymore
+            try:
+                os.unlink(peer)
+            except FileNotFoundError:
+                pass
+        except BlockingIOError:
+            LOG.warning("Dropped invalidation for {0}: its queue is full".format(peer))
+        except OSError as e:
+            if e.errno != errno.ENOTSOCK:
+                raise
+
+    def _on_readable(self):
+        while True:
+            try:
+                datagram = self._sock.recv(MAX_DATAGRAM_SIZE)
+            except BlockingIOError:
+                return
+
+            ldpr_refs = datagram.decode('utf-8').split('\n')
+            if ldpr_refs[0].startswith('#'):
+                sender, sequence = ldpr_refs.pop(0)[1:].split(' ')
+                self._check_sequence(sender, int(sequence))
+
+            for callback in self._subscribers:
+                try:
+                    callback(ldpr_refs)
+                except Exception:
+                    LOG.exception("Invalidation subscriber failed")
+
+    def _check_sequence(self, sender, sequence):
+        last_sequence = self._received.get(sender)
+        self._received[sender] = sequence
+        if last_sequence is None or sequence == last_sequence + 1:
+            return
+
+        LOG.warning("Lost {0} invalidations from worker {1}".format(sequence - last_sequence - 1, sender))
+        for callback in self._loss_subscribers:
+            try:
+                callback()
+            except Exception:
+                LOG.exception("Invalidation loss subscriber failed")
+
+@asyncio.coroutine
+def connect(directory, loop=None):
+    return InvalidationBus(directory, loop=loop)
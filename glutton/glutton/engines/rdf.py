@@ -1,11 +1,430 @@
 import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import http.client
+import logging
+from urllib.error import HTTPError
 
-from rdflib import Dataset
+from aiohttp.web import HTTPServiceUnavailable
+from rdflib import Dataset, URIRef, plugin
+from rdflib.store import Store
+from SPARQLWrapper.SPARQLExceptions import EndPointInternalError, EndPointNotFound
 
-@asyncio.coroutine
-def connect(driver, uri):
-    g = Dataset(driver)
+from ..utils import metrics
+
+LOG = logging.getLogger(__name__)
+
+# Local store, see engines.embedded
+plugin.register('Embedded', Store, 'glutton.engines.embedded', 'EmbeddedStore')
+
+# Storage layouts: every triple in the default graph, or each LDPR in its own named graph
+LAYOUTS = ('default', 'named-graphs')
+
+def ldpr_graph(node):
+    """
+    Named graph holding the triples about node in the named-graph layout:
+    the LDPR itself, or the document of a hash URI
+    """
+    return URIRef(str(node).split('#', 1)[0])
+
+def open_dataset(driver, uri, timeout=None, keepalive=True):
+    """
+    Open a (blocking) rdflib Dataset using the given store driver
+    """
+    # default_union makes rdflib talk to the store "default graph" instead
+    # of wrapping queries/updates into GRAPH <urn:x-rdflib:default>
+    g = Dataset(driver, default_union=True)
     if type(uri) == list:
         uri = tuple(uri)
     g.open(uri)
+
+    # SPARQL stores are SPARQLWrapper instances
+    if timeout and hasattr(g.store, 'setTimeout'):
+        g.store.setTimeout(timeout)
+    if keepalive and hasattr(g.store, 'setUseKeepAlive'):
+        g.store.setUseKeepAlive()
+
     return g
+
+def is_endpoint_failure(error):
+    """
+    Tell if error comes from the endpoint or the way to it (connection,
+    timeout, 5xx), rather than from the query itself
+    """
+    if isinstance(error, HTTPError):
+        return error.code >= 500
+    # URLError, socket errors and timeouts are OSErrors
+    return isinstance(error, (OSError, http.client.HTTPException, EndPointInternalError, EndPointNotFound))
+
+def call(func, connection, *args):
+    """
+    Call func(connection, *args). Stores exposing a lock (embedded ones)
+    run each call alone and commit its writes at once, or none of them if
+    it fails.
+    """
+    lock = getattr(connection.store, 'lock', None)
+    if lock is None:
+        return func(connection, *args)
+
+    with lock:
+        try:
+            result = func(connection, *args)
+        except:
+            connection.rollback()
+            raise
+        connection.commit()
+    return result
+
+class ConnectionPool(object):
+    """
+    A fixed size pool of Datasets (connections to the triplestore).
+
+    A connection is used by one thread at a time. When every connection is
+    busy, callers wait for one to be released; once `max_waiters` callers
+    are already waiting, new ones are rejected with a 503 instead of piling
+    up behind a slow backend.
+    """
+    def __init__(self, connections, max_waiters=1024, loop=None):
+        self.loop = loop or asyncio.get_event_loop()
+        self.size = len(connections)
+        self.max_waiters = max_waiters
+
+        self._connections = connections
+        self._free = asyncio.Queue(loop=self.loop)
+        for connection in connections:
+            self._free.put_nowait(connection)
+        self._waiters = 0
+
+    @asyncio.coroutine
+    def acquire(self):
+        if self._free.empty() and self._waiters >= self.max_waiters:
+            LOG.warning("Triplestore pool exhausted ({0} waiters)".format(self._waiters))
+            raise HTTPServiceUnavailable(reason="Triplestore is overloaded")
+
+        self._waiters += 1
+        try:
+            connection = yield from self._free.get()
+        finally:
+            self._waiters -= 1
+
+        return connection
+
+    @property
+    def free(self):
+        return self._free.qsize()
+
+    @property
+    def waiters(self):
+        return self._waiters
+
+    def release(self, connection):
+        self._free.put_nowait(connection)
+
+    def close(self):
+        for connection in self._connections:
+            connection.close()
+        self._connections = []
+
+class Replica(object):
+    """
+    A read-only query endpoint, with its own connections
+    """
+    def __init__(self, uri, pool):
+        self.uri = uri
+        self.pool = pool
+        self.healthy = True
+        # Reads in flight, for least-outstanding balancing
+        self.outstanding = 0
+
+class TripleStore(object):
+    """
+    Asynchronous facade to a pool of rdflib Datasets.
+
+    rdflib stores are blocking (SPARQLUpdateStore does one HTTP round trip
+    per call), so every operation borrows a connection from the pool, runs
+    in a worker thread and is awaited from the event loop.
+
+    With the named-graph layout, each LDPR lives in its own named graph
+    (see ldpr_graph) and triple patterns are looked up in the graph of
+    their subject.
+
+    Reads may be spread over replicas (see read). Replicas lag behind the
+    primary, so a worker reads what it wrote from the primary during the
+    `read_your_writes` seconds following the write.
+    """
+    def __init__(self, pool, replicas=(), balancing='round-robin', read_your_writes=0, layout='default', loop=None):
+        if layout not in LAYOUTS:
+            raise ValueError("Unknown triplestore layout {0}, expected one of {1}".format(layout, ", ".join(LAYOUTS)))
+
+        self.loop = loop or asyncio.get_event_loop()
+        self.pool = pool
+        self.named_graphs = layout == 'named-graphs'
+        self.replicas = list(replicas)
+        self.balancing = balancing
+        self.read_your_writes = read_your_writes
+
+        self._next_replica = 0
+        # ldpr_ref: loop time until which it is read from the primary
+        self._written = {}
+        self._health_task = None
+
+        self._executor = ThreadPoolExecutor(max_workers=pool.size + sum(replica.pool.size for replica in self.replicas))
+
+    def graph(self, dataset, subject):
+        """
+        Graph of dataset holding the triples about subject
+        """
+        if self.named_graphs and subject is not None:
+            return dataset.get_context(ldpr_graph(subject))
+        return dataset
+
+    def scoped(self, subject, pattern):
+        """
+        Restrict a SPARQL group graph pattern to the graph of subject
+        """
+        if self.named_graphs:
+            return "GRAPH {0} {{ {1} }}".format(ldpr_graph(subject).n3(), pattern)
+        return pattern
+
+    @asyncio.coroutine
+    def run(self, func, *args, pool=None):
+        """
+        Run func(dataset, *args) in a worker thread and return its result
+        """
+        pool = pool or self.pool
+        connection = yield from pool.acquire()
+        try:
+            future = self.loop.run_in_executor(self._executor, call, func, connection, *args)
+        except:
+            pool.release(connection)
+            raise
+
+        def release(future):
+            # The thread is done with the connection, even if the caller gave up
+            pool.release(connection)
+            if not future.cancelled():
+                future.exception()
+
+        future.add_done_callback(release)
+
+        # Cancelling the caller must not hand the connection back while in use
+        result = yield from asyncio.shield(future, loop=self.loop)
+        return result
+
+    @asyncio.coroutine
+    def read(self, func, *args, about=None, primary=False):
+        """
+        Like run, on a healthy replica when there are some. Reads about a
+        LDPR this worker wrote recently, or needing the primary, go to the
+        primary; so do reads failing on a replica because of the replica,
+        which is then left out until it passes a health check. Errors of
+        the query itself are raised as is.
+        """
+        replica = None if primary else self.pick_replica(about)
+        if replica is None:
+            return (yield from self.run(func, *args))
+
+        replica.outstanding += 1
+        try:
+            result = yield from self.run(func, *args, pool=replica.pool)
+        except HTTPServiceUnavailable:
+            # Its pool is full, not its fault
+            return (yield from self.run(func, *args))
+        except asyncio.CancelledError:
+            # An Exception before Python 3.8: the caller gave up, the replica is fine
+            raise
+        except Exception as e:
+            if not is_endpoint_failure(e):
+                raise
+            LOG.exception("Replica {0} failed, reading from the primary".format(replica.uri))
+            replica.healthy = False
+            return (yield from self.run(func, *args))
+        finally:
+            replica.outstanding -= 1
+
+        return result
+
+    def pick_replica(self, about=None):
+        if not self.replicas or (about is not None and self.recently_written(about)):
+            return None
+
+        healthy = [replica for replica in self.replicas if replica.healthy]
+        if not healthy:
+            return None
+
+        if self.balancing == 'least-outstanding':
+            return min(healthy, key=lambda replica: replica.outstanding)
+
+        self._next_replica = (self._next_replica + 1) % len(healthy)
+        return healthy[self._next_replica]
+
+    def wrote(self, *ldpr_refs):
+        """
+        Read ldpr_refs from the primary for the next read_your_writes seconds
+        """
+        if not self.replicas or not self.read_your_writes:
+            return
+
+        now = self.loop.time()
+        if len(self._written) > 10000:
+            self._written = dict((ldpr_ref, deadline) for ldpr_ref, deadline in self._written.items() if deadline > now)
+
+        deadline = now + self.read_your_writes
+        for ldpr_ref in ldpr_refs:
+            self._written[ldpr_ref] = deadline
+
+    def recently_written(self, ldpr_ref):
+        deadline = self._written.get(ldpr_ref)
+        if deadline is None:
+            return False
+        if deadline <= self.loop.time():
+            del self._written[ldpr_ref]
+            return False
+        return True
+
+    @asyncio.coroutine
+    def check_replicas(self, interval):
+        """
+        Probe every replica with an ASK query each interval seconds
+        """
+        while True:
+            for replica in self.replicas:
+                try:
+                    yield from self.run(lambda g: g.query("ASK {}").askAnswer, pool=replica.pool)
+                    healthy = True
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    LOG.debug("Health check of replica {0} failed: {1}".format(replica.uri, e))
+                    healthy = False
+
+                if healthy != replica.healthy:
+                    LOG.warning("Replica {0} is {1}".format(replica.uri, "back" if healthy else "down"))
+                replica.healthy = healthy
+
+            yield from asyncio.sleep(interval, loop=self.loop)
+
+    def start_health_checks(self, interval):
+        if self.replicas and interval:
+            self._health_task = self.loop.create_task(self.check_replicas(interval))
+
+    @metrics.timed('glutton_triplestore_call_duration_seconds')
+    @asyncio.coroutine
+    def contains(self, triple, about=None, primary=False):
+        result = yield from self.read(lambda g, t: t in self.graph(g, t[0]), triple,
+                                      about=about or triple[0], primary=primary)
+        return result
+
+    @metrics.timed('glutton_triplestore_call_duration_seconds')
+    @asyncio.coroutine
+    def triples(self, pattern, about=None, primary=False):
+        result = yield from self.read(lambda g, p: list(self.graph(g, p[0]).triples(p)), pattern,
+                                      about=about or pattern[0], primary=primary)
+        return result
+
+    @metrics.timed('glutton_triplestore_call_duration_seconds')
+    @asyncio.coroutine
+    def subjects(self, predicate, obj, about=None, primary=False):
+        result = yield from self.read(lambda g, p, o: list(g.subjects(p, o)), predicate, obj,
+                                      about=about, primary=primary)
+        return result
+
+    @metrics.timed('glutton_triplestore_call_duration_seconds')
+    @asyncio.coroutine
+    def objects(self, subject, predicate, about=None, primary=False):
+        result = yield from self.read(lambda g, s, p: list(self.graph(g, s).objects(s, p)), subject, predicate,
+                                      about=about or subject, primary=primary)
+        return result
+
+    @metrics.timed('glutton_triplestore_call_duration_seconds')
+    @asyncio.coroutine
+    def value(self, subject=None, predicate=None, obj=None, about=None, primary=False):
+        result = yield from self.read(lambda g, s, p, o: self.graph(g, s).value(s, p, o), subject, predicate, obj,
+                                      about=about or subject, primary=primary)
+        return result
+
+    @metrics.timed('glutton_triplestore_call_duration_seconds')
+    @asyncio.coroutine
+    def add(self, triple):
+        yield from self.run(lambda g, t: self.graph(g, t[0]).add(t), triple)
+        self.wrote(triple[0])
+
+    @metrics.timed('glutton_triplestore_call_duration_seconds')
+    @asyncio.coroutine
+    def remove(self, triple):
+        yield from self.run(lambda g, t: self.graph(g, t[0]).remove(t), triple)
+        if triple[0] is not None:
+            self.wrote(triple[0])
+
+    @metrics.timed('glutton_triplestore_call_duration_seconds')
+    @asyncio.coroutine
+    def query(self, sparql, about=None, primary=False):
+        """
+        Run a SPARQL query, return the result rows as a list
+        """
+        result = yield from self.read(lambda g, q: list(g.query(q)), sparql, about=about, primary=primary)
+        return result
+
+    @metrics.timed('glutton_triplestore_call_duration_seconds')
+    @asyncio.coroutine
+    def ask(self, sparql, about=None, primary=False):
+        """
+        Run a SPARQL ASK query, return its boolean answer
+        """
+        result = yield from self.read(lambda g, q: g.query(q).askAnswer, sparql, about=about, primary=primary)
+        return result
+
+    @metrics.timed('glutton_triplestore_call_duration_seconds')
+    @asyncio.coroutine
+    def update(self, sparql, touched=()):
+        """
+        Run a SPARQL update on the primary; touched are the LDPRs it
+        modifies, to be read back from the primary (see wrote)
+        """
+        yield from self.run(lambda g, q: g.update(q), sparql)
+        self.wrote(*touched)
+
+    @asyncio.coroutine
+    def close(self):
+        if self._health_task is not None:
+            self._health_task.cancel()
+
+        # Let in-flight calls finish before closing connections
+        yield from self.loop.run_in_executor(None, self._executor.shutdown)
+        self.pool.close()
+        for replica in self.replicas:
+            replica.pool.close()
+
+@asyncio.coroutine
+def open_pool(driver, uri, pool_size, max_waiters, timeout, keepalive, loop):
+    connections = []
+    for i in range(pool_size):
+        connection = yield from loop.run_in_executor(None, open_dataset, driver, uri, timeout, keepalive)
+        connections.append(connection)
+
+    LOG.debug("Opened {0} connections to {1}".format(pool_size, uri))
+
+    return ConnectionPool(connections, max_waiters=max_waiters, loop=loop)
+
+@asyncio.coroutine
+def connect(driver, uri, pool_size=16, max_waiters=1024, timeout=None, keepalive=True,
+            replicas=(), balancing='round-robin', health_check_interval=5, read_your_writes=5,
+            layout='default', loop=None):
+    """
+    Connect to the triplestore at uri and to its replicas, a list of
+    query endpoints used for reads. Each gets pool_size connections.
+    """
+    loop = loop or asyncio.get_event_loop()
+
+    pool = yield from open_pool(driver, uri, pool_size, max_waiters, timeout, keepalive, loop)
+
+    replica_list = []
+    for replica_uri in replicas or ():
+        # Replicas are never written to, but SPARQL stores want both endpoints
+        endpoints = [replica_uri, uri[1]] if type(uri) in (list, tuple) else replica_uri
+        replica_pool = yield from open_pool(driver, endpoints, pool_size, max_waiters, timeout, keepalive, loop)
+        replica_list.append(Replica(replica_uri, replica_pool))
+
+    store = TripleStore(pool, replicas=replica_list, balancing=balancing,
+                        read_your_writes=read_your_writes, layout=layout, loop=loop)
+    store.start_health_checks(health_check_interval)
+    return store
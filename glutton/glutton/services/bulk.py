@@ -0,0 +1,310 @@
+"""
+Bulk loading of RDF dumps into LDPCs
+
+Triples are parsed in a worker thread, grouped by subject into LDPRs of
+the target LDPC and written with large batched SPARQL updates, a few of
+them in flight at a time.
+
+Subjects are rebased under the LDPC: IRIs under `base` are moved there,
+other subjects get an IRI of the LDPC named after a hash of their
+document, linked to their original one with owl:sameAs. Hash URIs and
+skolemized blank nodes belong to the LDPR of their document and are not
+contained themselves.
+"""
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+import hashlib
+import logging
+import queue
+import threading
+import time
+import uuid
+
+from rdflib import Graph, URIRef, Literal
+from rdflib.namespace import RDF, DCTERMS, OWL
+from rdflib.plugins.parsers.ntriples import NTriplesParser, ParseError, r_tail, r_wspace
+from rdflib.term import BNode
+
+from ..engines.rdf import ldpr_graph
+from ..utils import negotiation
+from ..utils.namespace import LDP, GLUTTON
+from .data import WriteBatch, bump_modified, SERVER_MANAGED_PREDICATES
+
+LOG = logging.getLogger(__name__)
+
+# Importable on top of the formats offered to clients (see utils.negotiation)
+EXTRA_IMPORT_FORMATS = {
+    'application/n-quads': 'nquads',
+}
+
+def import_formats():
+    """
+    Map the importable content types to their rdflib format. N-Triples and
+    N-Quads are parsed as a stream, line by line; others whole.
+    """
+    formats = negotiation.formats()
+    formats.update(EXTRA_IMPORT_FORMATS)
+    return formats
+
+class ImportStats(object):
+    def __init__(self):
+        self.triples = 0
+        self.batches = 0
+        self.started = time.time()
+
+    @property
+    def elapsed(self):
+        return time.time() - self.started
+
+    @property
+    def rate(self):
+        """
+        Triples per second
+        """
+        elapsed = self.elapsed
+        return self.triples / elapsed if elapsed else 0.0
+
+    def as_dict(self):
+        return {'triples': self.triples,
+                'batches': self.batches,
+                'seconds': round(self.elapsed, 3),
+                'triples_per_second': round(self.rate, 1)}
+
+class ImportAborted(Exception):
+    """
+    The importer gave up, the parser must stop
+    """
+
+def foreign_slug(iri):
+    """
+    Path-safe name, under the LDPC, of an IRI from elsewhere: a hash of its
+    document, its fragment kept so that it stays a hash URI of that document
+    """
+    document, hash_sign, fragment = iri.partition('#')
+    return "ext-" + hashlib.sha1(document.encode('utf-8')).hexdigest() + hash_sign + fragment
+
+def _put(triples_queue, item, stop):
+    """
+    Put item in the bounded triples_queue, unless stop gets set meanwhile
+    """
+    while True:
+        if stop.is_set():
+            raise ImportAborted()
+        try:
+            triples_queue.put(item, timeout=1)
+            return
+        except queue.Full:
+            pass
+
+class _QueueSink(object):
+    """
+    Parser sink pushing triples, by chunks, to a bounded queue
+    """
+    def __init__(self, triples_queue, chunk_size, stop):
+        self._queue = triples_queue
+        self._chunk_size = chunk_size
+        self._stop = stop
+        self._chunk = []
+
+    def triple(self, s, p, o):
+        self._chunk.append((s, p, o))
+        if len(self._chunk) >= self._chunk_size:
+            self.flush()
+
+    def flush(self):
+        if self._chunk:
+            _put(self._queue, self._chunk, self._stop)
+            self._chunk = []
+
+class _NQuadsParser(NTriplesParser):
+    """
+    N-Quads parser dropping the graph name: LDPRs don't keep it
+    """
+    def parseline(self):
+        self.eat(r_wspace)
+        if (not self.line) or self.line.startswith('#'):
+            return  # The line is empty or a comment
+
+        subject = self.subject()
+        self.eat(r_wspace)
+
+        predicate = self.predicate()
+        self.eat(r_wspace)
+
+        obj = self.object()
+        self.eat(r_wspace)
+
+        self.uriref() or self.nodeid()
+        self.eat(r_tail)
+
+        if self.line:
+            raise ParseError("Trailing garbage")
+        self.sink.triple(subject, predicate, obj)
+
+def _parse(source, rdflib_format, triples_queue, chunk_size, stop, base):
+    """
+    Parse source (a binary file object) into triples_queue. Run in a thread,
+    until done or stop is set. The end of the stream is marked with None, a
+    failure with the exception.
+    """
+    try:
+        sink = _QueueSink(triples_queue, chunk_size, stop)
+        if rdflib_format == 'nt':
+            NTriplesParser(sink).parse(source)
+        elif rdflib_format == 'nquads':
+            _NQuadsParser(sink).parse(source)
+        else:
+            graph = Graph()
+            graph.parse(source, format=rdflib_format, publicID=base)
+            for triple in graph:
+                sink.triple(*triple)
+        sink.flush()
+        _put(triples_queue, None, stop)
+    except ImportAborted:
+        LOG.debug("Import aborted, parser stopped")
+    except Exception as e:
+        try:
+            _put(triples_queue, e, stop)
+        except ImportAborted:
+            pass
+
+def _get(triples_queue, stop):
+    """
+    Wait for the next chunk of triples_queue; give the thread back at once
+    once stop is set
+    """
+    while not stop.is_set():
+        try:
+            return triples_queue.get(timeout=1)
+        except queue.Empty:
+            pass
+    raise ImportAborted()
+
+@asyncio.coroutine
+def bulk_import(container, ldpc_ref, source, rdflib_format, batch_size=10000, concurrency=4,
+                base=None, report_every=10, loop=None):
+    """
+    Import the triples read from source (a blocking binary file object)
+    into the LDPC ldpc_ref.
+
+    Every IRI subject becomes a LDPR contained by ldpc_ref, rebased under
+    it (see above); `base` is the base IRI of the dump, relative IRIs are
+    resolved against the LDPC. Blank nodes are skolemized under the LDPC
+    so that they keep their identity across batches. Return an ImportStats.
+    """
+    loop = loop or asyncio.get_event_loop()
+    stats = ImportStats()
+
+    ldpr_prefix = ldpc_ref + "/"
+    # Same dates for all LDPRs, so they are idempotent across batches
+    now = Literal(datetime.now())
+    genid_prefix = ldpr_prefix + ".well-known/genid/" + uuid.uuid4().hex + "-"
+
+    def rebase(node):
+        if isinstance(node, BNode):
+            return URIRef(genid_prefix + node)
+        if base and isinstance(node, URIRef) and node.startswith(base):
+            return URIRef(ldpr_prefix + node[len(base):])
+        return node
+
+    def rebase_subject(subject):
+        """
+        Return the rebased subject and, if it had to be renamed, its
+        original IRI
+        """
+        subject = rebase(subject)
+        if subject.startswith(ldpr_prefix):
+            return subject, None
+        return URIRef(ldpr_prefix + foreign_slug(subject)), subject
+
+    # Make ldpc_ref a LDPC
+    batch = WriteBatch()
+    batch.add((ldpc_ref, RDF.type, LDP.Container))
+    batch.add((ldpc_ref, RDF.type, LDP.RDFSource))
+    batch.add((ldpc_ref, RDF.type, LDP.BasicContainer))
+    batch.touch(ldpc_ref)
+    yield from batch.commit(container)
+
+    triples_queue = queue.Queue(maxsize=concurrency * 2)
+    stop = threading.Event()
+    parser = threading.Thread(target=_parse, args=(source, rdflib_format, triples_queue, batch_size, stop, ldpr_prefix),
+                              name='glutton-import', daemon=True)
+    parser.start()
+    # Waits for the parser, without holding threads of the default executor
+    executor = ThreadPoolExecutor(max_workers=1)
+
+    semaphore = asyncio.Semaphore(concurrency, loop=loop)
+    pending = set()
+
+    @asyncio.coroutine
+    def write(batch, triple_count):
+        try:
+            yield from batch.commit(container)
+        finally:
+            semaphore.release()
+        stats.triples += triple_count
+        stats.batches += 1
+
+    last_report = time.time()
+    try:
+        while True:
+            chunk = yield from loop.run_in_executor(executor, _get, triples_queue, stop)
+            if chunk is None:
+                break
+            if isinstance(chunk, Exception):
+                raise chunk
+
+            batch = WriteBatch()
+            subjects = set()
+            for s, p, o in chunk:
+                s, original = rebase_subject(s)
+                # The dump's dates and such would come along ours
+                if p in SERVER_MANAGED_PREDICATES and ldpr_graph(s) == s:
+                    continue
+                batch.add((s, p, rebase(o)))
+                if original is not None:
+                    batch.add((s, OWL.sameAs, original))
+                subjects.add(s)
+
+            # Hash URIs and blank nodes are part of the LDPR of their document
+            ldprs = set(ldpr_graph(subject) for subject in subjects if not subject.startswith(genid_prefix))
+            ldprs.discard(URIRef(ldpr_prefix))
+            batch.touch(*subjects)
+
+            for subject in ldprs:
+                batch.add((subject, RDF.type, LDP.RDFSource))
+                batch.add((subject, DCTERMS.created, now))
+                batch.add((subject, DCTERMS.modified, now))
+                batch.add((ldpc_ref, LDP.contains, subject))
+                batch.add((subject, GLUTTON.containedIn, ldpc_ref))
+            batch.touch(*ldprs)
+            bump_modified(batch, ldpc_ref, datetime.now())
+
+            # Bounded number of updates in flight
+            yield from semaphore.acquire()
+            pending.add(loop.create_task(write(batch, len(chunk))))
+
+            # Fail early
+            for task in [task for task in pending if task.done()]:
+                pending.discard(task)
+                task.result()
+
+            if time.time() - last_report >= report_every:
+                last_report = time.time()
+                LOG.info("Imported {triples} triples into {0} ({triples_per_second} triples/s)".format(ldpc_ref, **stats.as_dict()))
+
+        if pending:
+            yield from asyncio.gather(*pending, loop=loop)
+    except:
+        for task in pending:
+            task.cancel()
+        raise
+    finally:
+        # Let the parser thread go if it is still running
+        stop.set()
+        executor.shutdown(wait=False)
+
+    LOG.info("Imported {triples} triples into {0} in {seconds}s ({triples_per_second} triples/s)".format(ldpc_ref, **stats.as_dict()))
+
+    return stats
@@ -1,5 +1,7 @@
 import asyncio
+from collections import OrderedDict
 from datetime import datetime
+import hashlib
 import logging
 
 from random import randint
@@ -8,6 +10,9 @@ from rdflib import Graph
 from rdflib.namespace import RDF, FOAF, DCTERMS
 from rdflib import URIRef, Namespace, Literal
 
+from ..engines import rdf
+from ..utils import metrics
+from ..utils.bloom import BloomFilter
 from ..utils.namespace import LDP, GLUTTON
 
 LOG = logging.getLogger(__name__)
@@ -16,114 +21,628 @@ LOG = logging.getLogger(__name__)
 You can add your business logic here
 """
 
+# What ldpr_load_metadata() fetches. GLUTTON.containedIn is the
+# child -> parent index of ldp:contains, so that deletes know the LDPC
+METADATA_PREDICATES = (RDF.type, DCTERMS.modified, GLUTTON.deleted, GLUTTON.containedIn)
+
+# Written by the server only: what clients send for these is dropped
+SERVER_MANAGED_PREDICATES = (DCTERMS.created, DCTERMS.modified, GLUTTON.deleted,
+                             GLUTTON.reservedBy, GLUTTON.containedIn)
+
+def weak_etag(modification_date):
+    """
+    Build a weak etag from a modification date
+    """
+    return 'W/"{0}"'.format(hashlib.md5(str(modification_date).encode('utf-8')).hexdigest())
+
+class LDPRState(object):
+    """
+    Everything the backend knows about a LDPR: its triples, deletion
+    marker, types and modification date, fetched in a single query.
+
+    When not `complete`, graph only holds the metadata triples (types,
+    modification date and deletion marker). A `truncated` LDPR was too big
+    to be loaded at once and must be read with ldpr_triples_page().
+    """
+    def __init__(self, ldpr_ref, graph, complete=True, truncated=False):
+        self.ref = ldpr_ref
+        self.graph = graph
+        self.complete = complete
+        self.truncated = truncated
+
+    @property
+    def exists(self):
+        # A slug reservation alone (see services.slugs) is no LDPR yet
+        for predicate in self.graph.predicates(self.ref, None):
+            if predicate != GLUTTON.reservedBy:
+                return True
+        return False
+
+    @property
+    def deleted(self):
+        return (self.ref, GLUTTON.deleted, None) in self.graph
+
+    @property
+    def containers(self):
+        return set(self.graph.objects(self.ref, GLUTTON.containedIn))
+
+    @property
+    def types(self):
+        return set(self.graph.objects(self.ref, RDF.type))
+
+    def has_type(self, rdftype):
+        return (self.ref, RDF.type, rdftype) in self.graph
+
+    @property
+    def modification_date(self):
+        # There should be a single one; if not, the same one for every load
+        return max(self.graph.objects(self.ref, DCTERMS.modified), key=str, default=None)
+
+    @property
+    def etag(self):
+        """
+        Weak etag based on the modification date, None if there is none
+        """
+        modification_date = self.modification_date
+        if modification_date is None:
+            return None
+        return weak_etag(modification_date)
+
+    def metadata(self):
+        """
+        Return a state only holding the metadata triples of this one
+        """
+        if not self.complete:
+            return self
+
+        graph = Graph()
+        for predicate in METADATA_PREDICATES:
+            for obj in self.graph.objects(self.ref, predicate):
+                graph.add((self.ref, predicate, obj))
+
+        # Keep a triple so the LDPR still exists
+        if self.exists and not len(graph):
+            for triple in self.graph.triples((self.ref, None, None)):
+                graph.add(triple)
+                break
+
+        return LDPRState(self.ref, graph, complete=False)
+
+def forget_ldpr(container, *ldpr_refs):
+    """
+    Forget anything this worker cached about the given LDPRs
+    """
+    for ldpr_ref in ldpr_refs:
+        container.generations.bump(ldpr_ref)
+
+    for cache in container.caches.values():
+        for ldpr_ref in ldpr_refs:
+            cache.invalidate(ldpr_ref)
+
+    # Reads in flight may predate the change
+    for ldpr_ref in ldpr_refs:
+        container.reads.forget(ldpr_ref)
+
+    # They may exist now
+    if container.existence is not None:
+        for ldpr_ref in ldpr_refs:
+            container.existence.add(str(ldpr_ref))
+    # Also in the filter being loaded, if any
+    if container.existence_writes is not None:
+        container.existence_writes.update(str(ldpr_ref) for ldpr_ref in ldpr_refs)
+
+def ldpr_may_exist(container, ldpr_ref):
+    """
+    False if the LDPR certainly has no triple (neither live nor deleted),
+    according to the existence filter of this worker
+    """
+    return container.existence is None or str(ldpr_ref) in container.existence
+
+@metrics.timed('glutton_data_call_duration_seconds')
+@asyncio.coroutine
+def existence_filter_load(container):
+    """
+    Build a new existence filter from every IRI subject of the store and
+    swap it in. The subjects come from a single query, added to the filter
+    by the worker thread as they are read; writes made meanwhile are
+    added before the swap.
+    """
+    store = yield from container.engines['triplestore']
+
+    where = "?s ?p ?o FILTER(isIRI(?s))"
+    if store.named_graphs:
+        where = "GRAPH ?g {{ {0} }}".format(where)
+
+    existence = BloomFilter(capacity=container.existence.capacity,
+                            false_positive_rate=container.existence.false_positive_rate)
+
+    def fill(dataset, query):
+        # Nothing else touches the new filter until it is swapped in
+        count = 0
+        for row in dataset.query(query):
+            existence.add(str(row[0]))
+            count += 1
+        return count
+
+    container.existence_writes = set()
+    try:
+        count = yield from store.run(fill, "SELECT DISTINCT ?s WHERE {{ {0} }}".format(where))
+    except asyncio.CancelledError:
+        raise
+    except Exception:
+        LOG.exception("Could not load the existence filter, keeping the previous one")
+        return
+    finally:
+        writes, container.existence_writes = container.existence_writes, None
+
+    for ldpr_ref in writes:
+        existence.add(ldpr_ref)
+    existence.ready = True
+    container.existence = existence
+    LOG.info("Existence filter loaded with {0} IRIs".format(count))
+
+@metrics.timed('glutton_data_call_duration_seconds')
+@asyncio.coroutine
+def invalidate_ldpr(container, *ldpr_refs):
+    """
+    Forget anything cached about the given LDPRs, in every worker
+    """
+    forget_ldpr(container, *ldpr_refs)
+
+    if 'invalidation' in container.engines:
+        bus = yield from container.engines['invalidation']
+        bus.publish(ldpr_refs)
+
+class WriteBatch(object):
+    """
+    Unit of work collecting the writes of a request, sent to the
+    triplestore as one SPARQL update request, which the store applies
+    atomically.
+
+    Removed triples may contain None as a wildcard. Deletions are applied
+    before insertions, so a LDPR can be wiped then written again.
+
+    In the named-graph layout, triples go to the graph of their subject
+    unless another graph is given (e.g. for blank nodes of a LDPR).
+
+    A batch can be made conditional with a `where` graph pattern: it is
+    then sent as a single DELETE/INSERT, applied only if the pattern
+    matches, and can't hold wildcards nor drops (variables bound by the
+    pattern may be used instead).
+    """
+    def __init__(self):
+        self.inserts = []
+        self.deletes = []
+        self.delete_patterns = []
+        self.drops = []
+        self.touched = set()
+
+    def __len__(self):
+        return len(self.inserts) + len(self.deletes) + len(self.delete_patterns) + len(self.drops)
+
+    def add(self, triple, graph=None):
+        self.inserts.append((triple, graph))
+
+    def remove(self, triple, graph=None):
+        if None in triple:
+            self.delete_patterns.append((triple, graph))
+        else:
+            self.deletes.append((triple, graph))
+
+    def drop(self, ldpr_ref):
+        """
+        Remove every triple of a LDPR: its whole graph in the named-graph
+        layout, the triples it is the subject of otherwise
+        """
+        self.drops.append(ldpr_ref)
+
+    def touch(self, *ldpr_refs):
+        """
+        Mark LDPRs as modified by this batch, to invalidate their caches
+        """
+        self.touched.update(ldpr_refs)
+
+    def to_sparql(self, named_graphs=False, where=None):
+        if where is not None:
+            if self.delete_patterns or self.drops:
+                raise ValueError("A conditional batch can't remove patterns")
+            return "DELETE {{\n{0}\n}}\nINSERT {{\n{1}\n}}\nWHERE {{ {2} }}".format(_quads_to_sparql(self.deletes, named_graphs),
+                                                                                   _quads_to_sparql(self.inserts, named_graphs),
+                                                                                   where)
+
+        operations = []
+
+        delete_patterns = list(self.delete_patterns)
+        for ldpr_ref in self.drops:
+            if named_graphs:
+                operations.append("DROP SILENT GRAPH {0}".format(rdf.ldpr_graph(ldpr_ref).n3()))
+            else:
+                delete_patterns.append(((ldpr_ref, None, None), None))
+
+        for index, (pattern, graph) in enumerate(delete_patterns):
+            terms = [term.n3() if term is not None else "?{0}{1}".format(name, index)
+                     for name, term in zip("spo", pattern)]
+            where = " ".join(terms)
+            if named_graphs:
+                if graph is None and pattern[0] is not None:
+                    graph = rdf.ldpr_graph(pattern[0])
+                if graph is None:
+                    # Whichever graphs hold it
+                    where = "GRAPH ?g{0} {{ {1} }}".format(index, where)
+                    operations.append("DELETE {{ {0} }} WHERE {{ {0} }}".format(where))
+                    continue
+                where = "GRAPH {0} {{ {1} }}".format(graph.n3(), where)
+            operations.append("DELETE WHERE {{ {0} }}".format(where))
+
+        if self.deletes:
+            operations.append("DELETE DATA {{\n{0}\n}}".format(_quads_to_sparql(self.deletes, named_graphs)))
+
+        if self.inserts:
+            operations.append("INSERT DATA {{\n{0}\n}}".format(_quads_to_sparql(self.inserts, named_graphs)))
+
+        return " ;\n".join(operations)
+
+    @metrics.timed('glutton_data_call_duration_seconds')
+    @asyncio.coroutine
+    def commit(self, container, where=None):
+        if len(self):
+            store = yield from container.engines['triplestore']
+            yield from store.update(self.to_sparql(store.named_graphs, where), touched=self.touched)
+
+        if self.touched:
+            yield from invalidate_ldpr(container, *self.touched)
+
+def _triples_to_sparql(triples):
+    return "\n".join("{0} {1} {2} .".format(s.n3(), p.n3(), o.n3()) for s, p, o in triples)
+
+def _quads_to_sparql(quads, named_graphs):
+    """
+    (triple, graph) pairs as SPARQL quad data
+    """
+    if not named_graphs:
+        return _triples_to_sparql(triple for triple, graph in quads)
+
+    graphs = OrderedDict()
+    for triple, graph in quads:
+        graphs.setdefault(graph if graph is not None else rdf.ldpr_graph(triple[0]), []).append(triple)
+
+    return "\n".join("GRAPH {0} {{\n{1}\n}}".format(graph.n3(), _triples_to_sparql(triples))
+                     for graph, triples in graphs.items())
+
+@metrics.timed('glutton_data_call_duration_seconds')
 @asyncio.coroutine
 def node_has_type(container, subject, rdftype):
     store = yield from container.engines['triplestore']
 
     LOG.debug("checking if <{0}> is of type <{1}>...".format(subject, rdftype))
-    return (subject, RDF.type, rdftype) in store
+    has_type = yield from store.contains((subject, RDF.type, rdftype))
 
+    return has_type
+
+@metrics.timed('glutton_data_call_duration_seconds')
 @asyncio.coroutine
 def node_exists(container, subject):
     store = yield from container.engines['triplestore']
 
     LOG.debug("checking if {0} exists".format(subject))
-    exists = (subject, None, None) in store
+    exists = yield from store.contains((subject, None, None))
 
     return exists
 
+@metrics.timed('glutton_data_call_duration_seconds')
 @asyncio.coroutine
 def node_is_deleted(container, subject):
     store = yield from container.engines['triplestore']
 
     LOG.debug("checking if {0} is deleted".format(subject))
-    is_deleted = (subject, GLUTTON.deleted, None) in store
+    is_deleted = yield from store.contains((subject, GLUTTON.deleted, None))
 
     return is_deleted
 
+@metrics.timed('glutton_data_call_duration_seconds')
 @asyncio.coroutine
 def node_objects(container, subject, predicate):
     store = yield from container.engines['triplestore']
 
-    values = set()
-    for obj in store.objects(subject, predicate):
-        values.add(obj)
+    objects = yield from store.objects(subject, predicate)
+    values = set(objects)
 
     return values
 
+@metrics.timed('glutton_data_call_duration_seconds')
 @asyncio.coroutine
-def ldpr_modification_date(container, ldpr_ref):
+def ldpr_load(container, ldpr_ref, limit=None):
+    """
+    Fetch a LDPR with a single query
+
+    If it has more than `limit` triples, only its metadata is returned,
+    as a truncated state. In the named-graph layout, the LDPR comes with
+    the rest of its graph (hash URIs, blank nodes).
+    """
+    if not ldpr_may_exist(container, ldpr_ref):
+        return LDPRState(ldpr_ref, Graph())
+
     store = yield from container.engines['triplestore']
 
-    obj = store.value(None, DCTERMS.modified)
+    generation = container.generations.get(ldpr_ref)
+    if store.named_graphs:
+        query = "SELECT ?s ?p ?o WHERE {{ {0} }}".format(store.scoped(ldpr_ref, "?s ?p ?o"))
+    else:
+        query = "SELECT ?p ?o WHERE {{ {0} ?p ?o }}".format(ldpr_ref.n3())
+    if limit is not None:
+        query += " LIMIT {0}".format(limit + 1)
+    rows = yield from store.query(query, about=ldpr_ref)
+
+    if limit is not None and len(rows) > limit:
+        metadata = yield from ldpr_load_metadata(container, ldpr_ref)
+        return LDPRState(ldpr_ref, metadata.graph, complete=False, truncated=True)
 
-    return str(obj).encode('utf-8')
+    graph = Graph()
+    for row in rows:
+        graph.add(tuple(row) if len(row) == 3 else (ldpr_ref,) + tuple(row))
 
+    state = LDPRState(ldpr_ref, graph)
+    # Unless modified meanwhile, then what we read may predate it
+    if state.exists and container.generations.get(ldpr_ref) == generation:
+        container.caches['ldpr_metadata'].set(ldpr_ref, state.metadata())
+
+    return state
+
+@metrics.timed('glutton_data_call_duration_seconds')
 @asyncio.coroutine
-def ldpr_get(container, ldpr_ref):
+def ldpr_load_predicates(container, ldpr_ref, predicates=None, primary=False):
+    """
+    Fetch the triples of a LDPR with the given predicates (all of them
+    if None) into a graph
+    """
     store = yield from container.engines['triplestore']
 
-    results = yield from store.triples((ldpr_ref, None, None))
+    graph = Graph()
+    if predicates is not None and not predicates:
+        return graph
+
+    predicate_filter = ""
+    if predicates is not None:
+        predicate_filter = "FILTER(?p IN ({0}))".format(", ".join(p.n3() for p in sorted(predicates)))
+
+    query = "SELECT ?p ?o WHERE {{ {0} }}".format(store.scoped(ldpr_ref, "{0} ?p ?o {1}".format(ldpr_ref.n3(), predicate_filter)))
+    rows = yield from store.query(query, about=ldpr_ref, primary=primary)
 
-    return results
+    for predicate, obj in rows:
+        graph.add((ldpr_ref, predicate, obj))
 
+    return graph
+
+@metrics.timed('glutton_data_call_duration_seconds')
 @asyncio.coroutine
-def ldpr_new(container, ldpr_ref, ldpr_graph, ldpc_ref=None):
+def ldpr_triples_page(container, ldpr_ref, limit, offset=0):
+    """
+    Fetch a page of the triples of a LDPR, ordered so that pages are
+    stable. As with ldpr_load(), the LDPR comes with the rest of its graph
+    in the named-graph layout, triples grouped by subject.
+    """
+    store = yield from container.engines['triplestore']
+
+    if store.named_graphs:
+        query = """SELECT ?s ?p ?o WHERE {{ {where} }}
+                   ORDER BY ?s ?p ?o LIMIT {limit} OFFSET {offset}""".format(where=store.scoped(ldpr_ref, "?s ?p ?o"),
+                                                                            limit=limit,
+                                                                            offset=offset)
+        rows = yield from store.query(query, about=ldpr_ref)
+        return [tuple(row) for row in rows]
+
+    query = """SELECT ?p ?o WHERE {{ {where} }}
+               ORDER BY ?p ?o LIMIT {limit} OFFSET {offset}""".format(where="{0} ?p ?o".format(ldpr_ref.n3()),
+                                                                      limit=limit,
+                                                                      offset=offset)
+    rows = yield from store.query(query, about=ldpr_ref)
+
+    return [(ldpr_ref, predicate, obj) for predicate, obj in rows]
+
+@metrics.timed('glutton_data_call_duration_seconds')
+@asyncio.coroutine
+def ldpc_page(container, ldpc_ref, limit, start=None):
+    """
+    Fetch a page of a LDPC: its own triples but only `limit` of its
+    ldp:contains ones, starting at member `start` (in IRI order).
+
+    Return the page graph and the first member of the next page, if any.
+    """
+    store = yield from container.engines['triplestore']
+
+    start_filter = ""
+    if start is not None:
+        start_filter = "FILTER(STR(?o) >= {0})".format(Literal(str(start)).n3())
+
+    where = """{{ {ref} ?p ?o FILTER(?p != {contains}) }}
+               UNION
+               {{ SELECT ?p ?o WHERE {{
+                    {ref} {contains} ?o {start_filter}
+                    BIND({contains} AS ?p)
+                  }} ORDER BY STR(?o) LIMIT {limit} }}""".format(ref=ldpc_ref.n3(),
+                                                                contains=LDP.contains.n3(),
+                                                                start_filter=start_filter,
+                                                                limit=limit + 1)
+    query = "SELECT ?p ?o WHERE {{ {0} }}".format(store.scoped(ldpc_ref, where))
+    rows = yield from store.query(query, about=ldpc_ref)
+
+    graph = Graph()
+    members = []
+    for predicate, obj in rows:
+        if predicate == LDP.contains:
+            members.append(obj)
+        else:
+            graph.add((ldpc_ref, predicate, obj))
+
+    members.sort(key=str)
+    for member in members[:limit]:
+        graph.add((ldpc_ref, LDP.contains, member))
+
+    next_start = members[limit] if len(members) > limit else None
+
+    return graph, next_start
+
+@metrics.timed('glutton_data_call_duration_seconds')
+@asyncio.coroutine
+def ldpc_previous_page_start(container, ldpc_ref, limit, start):
+    """
+    Return the first member of the page before the one starting at `start`,
+    None when that previous page is the first one.
+    """
+    store = yield from container.engines['triplestore']
+
+    where = "{ref} {contains} ?o FILTER(STR(?o) < {start})".format(ref=ldpc_ref.n3(),
+                                                                   contains=LDP.contains.n3(),
+                                                                   start=Literal(str(start)).n3())
+    query = """SELECT ?o WHERE {{ {where} }}
+               ORDER BY DESC(STR(?o)) LIMIT {limit}""".format(where=store.scoped(ldpc_ref, where),
+                                                               limit=limit + 1)
+    rows = yield from store.query(query, about=ldpc_ref)
+
+    # One more member before this page: it is not the first one
+    if len(rows) > limit:
+        return rows[limit - 1][0]
+    return None
+
+@metrics.timed('glutton_data_call_duration_seconds')
+@asyncio.coroutine
+def ldpr_load_metadata(container, ldpr_ref):
+    """
+    Fetch only what is needed to answer HEAD, OPTIONS or a 304: types,
+    modification date and deletion marker. The second branch makes sure
+    a LDPR without any of these is still seen as existing.
+
+    Existing LDPRs are cached until modified, unless they were modified
+    while being fetched.
+    """
+    state = container.caches['ldpr_metadata'].get(ldpr_ref)
+    if state is not None:
+        return state
+
+    if not ldpr_may_exist(container, ldpr_ref):
+        return LDPRState(ldpr_ref, Graph(), complete=False)
+
+    store = yield from container.engines['triplestore']
+
+    generation = container.generations.get(ldpr_ref)
+    where = """{{ {ref} ?p ?o FILTER(?p IN ({predicates})) }}
+               UNION
+               {{ SELECT ?p ?o WHERE {{ {ref} ?p ?o }} LIMIT 1 }}""".format(ref=ldpr_ref.n3(),
+                                                                          predicates=", ".join(p.n3() for p in METADATA_PREDICATES))
+    query = "SELECT ?p ?o WHERE {{ {0} }}".format(store.scoped(ldpr_ref, where))
+    rows = yield from store.query(query, about=ldpr_ref)
+
+    graph = Graph()
+    for predicate, obj in rows:
+        graph.add((ldpr_ref, predicate, obj))
+
+    state = LDPRState(ldpr_ref, graph, complete=False)
+    if state.exists and container.generations.get(ldpr_ref) == generation:
+        container.caches['ldpr_metadata'].set(ldpr_ref, state)
+
+    return state
+
+def bump_modified(batch, ldpr_ref, now):
+    """
+    Set the modification date (hence the etag) of ldpr_ref as part of batch
+    """
+    batch.remove((ldpr_ref, DCTERMS.modified, None))
+    batch.add((ldpr_ref, DCTERMS.modified, Literal(now)))
+    batch.touch(ldpr_ref)
+
+@metrics.timed('glutton_data_call_duration_seconds')
+@asyncio.coroutine
+def ldpr_new(container, ldpr_ref, ldpr_graph, ldpc_ref=None, batch=None):
     """
     Add a new resource (graph) to a LDPC
+
+    Writes go to `batch` if given, the caller committing it; otherwise
+    they are sent at once in a single update.
     """
     store = yield from container.engines['triplestore']
 
+    own_batch = batch is None
+    if own_batch:
+        batch = WriteBatch()
+
     # Mark this new LDPR as a RDF Source
     ldpr_graph.add((ldpr_ref, RDF.type, LDP.RDFSource))
 
+    # Containment, dates and deletion are managed by the server
+    for predicate in SERVER_MANAGED_PREDICATES:
+        ldpr_graph.remove((ldpr_ref, predicate, None))
+
     # Mark this LDPR with current modification/creation date
     now = datetime.now()
     ldpr_graph.add((ldpr_ref, DCTERMS.modified, Literal(now)))
     ldpr_graph.add((ldpr_ref, DCTERMS.created, Literal(now)))
 
-    # Copy temp graph to datastore
-    for triple in ldpr_graph.triples((ldpr_ref, None, None)):
-        store.add(triple)
+    # Copy temp graph to datastore. In its own graph, the LDPR also keeps
+    # its hash URIs and blank nodes
+    if store.named_graphs:
+        for triple in ldpr_graph:
+            batch.add(triple, graph=ldpr_ref)
+    else:
+        for triple in ldpr_graph.triples((ldpr_ref, None, None)):
+            batch.add(triple)
+    batch.touch(ldpr_ref)
 
     if ldpc_ref:
-        # Make the ldpc_ref a LDPC if not already one
-        ldpc_ref_is_already_a_ldpc = yield from node_has_type(container, ldpc_ref, LDP.Container)
-        if not ldpc_ref_is_already_a_ldpc:
-            store.add((ldpc_ref, RDF.type, LDP.Container))
-            store.add((ldpc_ref, RDF.type, LDP.RDFSource))
-            store.add((ldpc_ref, RDF.type, LDP.BasicContainer))
+        # Make the ldpc_ref a LDPC if not already one (no-op if it is)
+        batch.add((ldpc_ref, RDF.type, LDP.Container))
+        batch.add((ldpc_ref, RDF.type, LDP.RDFSource))
+        batch.add((ldpc_ref, RDF.type, LDP.BasicContainer))
 
         # Add this LDPR to the LDPC if specified
-        store.add((ldpc_ref, LDP.contains, ldpr_ref))
-        # FIXME: Should update "modified" field on LDPC
+        batch.add((ldpc_ref, LDP.contains, ldpr_ref))
+        batch.add((ldpr_ref, GLUTTON.containedIn, ldpc_ref))
+        bump_modified(batch, ldpc_ref, now)
         LOG.debug("Added LDPR {0} to LDPC {1}".format(ldpr_ref, ldpc_ref))
 
+    if own_batch:
+        yield from batch.commit(container)
+
     LOG.debug("Made new LDPR {0}".format(ldpr_ref))
 
     return True
 
+@metrics.timed('glutton_data_call_duration_seconds')
 @asyncio.coroutine
-def ldpr_delete(container, ldpr_ref, mark_deleted=True, remove_containement_triples=True):
+def ldpr_delete(container, ldpr_ref, mark_deleted=True, remove_containement_triples=True, batch=None):
     """
     Delete a LDPR and its containement triples
-    FIXME Should be transactional
+
+    Writes go to `batch` if given, the caller committing it; otherwise
+    they are sent at once in a single update.
     """
-    store = yield from container.engines['triplestore']
+    own_batch = batch is None
+    if own_batch:
+        batch = WriteBatch()
 
-    # Remove any containment triplet
-    if remove_containement_triples:
-        store.remove((None, LDP.contains, ldpr_ref))
-        # FIXME: Should update modified field on LDPC
+    # Its LDPCs, from the (usually cached) metadata
+    state = yield from ldpr_load_metadata(container, ldpr_ref)
+    ldpc_refs = state.containers
 
     # Remove actual LDPR
-    store.remove((ldpr_ref, None, None))
+    batch.drop(ldpr_ref)
+    batch.touch(ldpr_ref)
+
+    if remove_containement_triples:
+        now = datetime.now()
+        for ldpc_ref in ldpc_refs:
+            batch.remove((ldpc_ref, LDP.contains, ldpr_ref))
+            bump_modified(batch, ldpc_ref, now)
+    else:
+        # Still contained, keep the index
+        for ldpc_ref in ldpc_refs:
+            batch.add((ldpr_ref, GLUTTON.containedIn, ldpc_ref))
 
     if mark_deleted:
         # Mark as deleted FIXME: Not sure this is the best way to do this!
-        # FIXME: This is a possible race since we delete everything then add
-        # a triple (and we don't use transaction)
         now = datetime.now()
-        store.add((ldpr_ref, GLUTTON.deleted, Literal(now)))
+        batch.add((ldpr_ref, GLUTTON.deleted, Literal(now)))
+
+    if own_batch:
+        yield from batch.commit(container)
 
     return True
@@ -0,0 +1,93 @@
+"""
+Data migrations, run from glutton.cli
+
+migrate_to_named_graphs moves triples stored with the default layout into
+one named graph per LDPR (see engines.rdf.ldpr_graph), for the
+named-graph layout.
+
+Subjects are walked in IRI order, batch_size at a time; each batch is
+moved with a single SPARQL update, so the migration can be interrupted
+and run again. Triples about blank nodes are left in the default graph:
+the default layout never stored any outside of bulk imports, which
+skolemize them.
+"""
+import asyncio
+import logging
+import time
+
+from rdflib import Literal
+
+from ..utils import metrics
+from ..utils.namespace import LDP, GLUTTON
+from .data import WriteBatch, invalidate_ldpr
+
+LOG = logging.getLogger(__name__)
+
+@metrics.timed('glutton_data_call_duration_seconds')
+@asyncio.coroutine
+def migrate_to_named_graphs(container, batch_size=1000, report_every=10):
+    """
+    Return the number of (subjects, triples) moved
+    """
+    store = yield from container.engines['triplestore']
+
+    subjects_moved = triples_moved = 0
+    last_subject = None
+    last_report = time.time()
+    while True:
+        after = ""
+        if last_subject is not None:
+            after = "FILTER(STR(?s) > {0})".format(Literal(str(last_subject)).n3())
+        rows = yield from store.query("""SELECT DISTINCT ?s WHERE {{ ?s ?p ?o FILTER(isIRI(?s)) {after} }}
+                                         ORDER BY STR(?s) LIMIT {limit}""".format(after=after, limit=batch_size),
+                                      primary=True)
+        if not rows:
+            break
+        subjects = [row[0] for row in rows]
+        last_subject = subjects[-1]
+
+        values = " ".join(subject.n3() for subject in subjects)
+        rows = yield from store.query("SELECT ?s ?p ?o WHERE {{ VALUES ?s {{ {0} }} ?s ?p ?o }}".format(values),
+                                      primary=True)
+
+        # The default graph copy goes first, then the triples are written
+        # to their graph, in one request
+        batch = WriteBatch()
+        for triple in rows:
+            batch.add(tuple(triple))
+        batch.touch(*subjects)
+        yield from store.update("DELETE {{ ?s ?p ?o }} WHERE {{ VALUES ?s {{ {0} }} ?s ?p ?o }} ;\n{1}".format(
+                                    values, batch.to_sparql(named_graphs=True)),
+                                touched=subjects)
+        yield from invalidate_ldpr(container, *subjects)
+
+        subjects_moved += len(subjects)
+        triples_moved += len(rows)
+        if time.time() - last_report >= report_every:
+            last_report = time.time()
+            LOG.info("Moved {0} subjects ({1} triples) to their graph, up to {2}".format(subjects_moved, triples_moved, last_subject))
+
+    LOG.info("Moved {0} subjects ({1} triples) to their graph".format(subjects_moved, triples_moved))
+
+    return subjects_moved, triples_moved
+
+@metrics.timed('glutton_data_call_duration_seconds')
+@asyncio.coroutine
+def index_containment(container):
+    """
+    Add the child -> parent index (GLUTTON.containedIn) to LDPRs created
+    before it existed. Workers cache LDPR metadata, restart them after.
+    """
+    store = yield from container.engines['triplestore']
+
+    contains = "?ldpc {0} ?ldpr".format(LDP.contains.n3())
+    contained_in = "?ldpr {0} ?ldpc".format(GLUTTON.containedIn.n3())
+    if store.named_graphs:
+        # Contained LDPRs are no hash URIs: the graph of the child is the child
+        contains = "GRAPH ?g {{ {0} }}".format(contains)
+        contained_in = "GRAPH ?ldpr {{ {0} }}".format(contained_in)
+
+    yield from store.update("INSERT {{ {0} }} WHERE {{ {1} FILTER NOT EXISTS {{ {0} }} }}".format(contained_in, contains))
+
+    rows = yield from store.query("SELECT (COUNT(*) AS ?count) WHERE {{ {0} }}".format(contained_in), primary=True)
+    return int(rows[0][0])
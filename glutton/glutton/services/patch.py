@@ -0,0 +1,201 @@
+"""
+PATCH of LDPRs with SPARQL Update (application/sparql-update)
+
+The update runs against a local copy of the LDPR, holding only the
+triples of the predicates it mentions, and what it removed and added is
+written back in one update, conditioned on the modification date the
+copy was made at. Editing one field of a big LDPR costs a few triples of
+I/O instead of a full PUT.
+
+Patterns the local copy can't answer, such as FILTER EXISTS about other
+subjects, are refused.
+"""
+import asyncio
+from datetime import datetime
+import logging
+
+from rdflib.namespace import DCTERMS
+from rdflib.paths import Path
+from rdflib.plugins.sparql.algebra import translateUpdate
+from rdflib.plugins.sparql.parser import parseUpdate
+from rdflib.plugins.sparql.parserutils import CompValue
+from rdflib.plugins.sparql.update import evalUpdate
+from rdflib.term import BNode, Literal, Node, URIRef, Variable
+
+from ..utils import metrics
+from ..utils.namespace import LDP
+from . import data
+from .data import WriteBatch, ldpr_load_predicates
+
+LOG = logging.getLogger(__name__)
+
+# Operations which only change triples
+ALLOWED_OPERATIONS = ('InsertData', 'DeleteData', 'DeleteWhere', 'Modify')
+
+# Patterns reaching outside the LDPR (or the worker)
+FORBIDDEN_PATTERNS = ('ServiceGraphPattern', 'Graph')
+
+# Patterns only about the LDPR may be nested in these
+EXISTS_PATTERNS = ('Builtin_EXISTS', 'Builtin_NOTEXISTS')
+
+# Written by Glutton only
+SERVER_MANAGED_PREDICATES = (LDP.contains,) + data.SERVER_MANAGED_PREDICATES
+
+class InvalidPatch(ValueError):
+    """
+    The patch is not a SPARQL update Glutton can apply to a LDPR
+    """
+
+class ForbiddenPatch(InvalidPatch):
+    """
+    The patch changes triples clients may not change
+    """
+
+class UnprocessablePatch(InvalidPatch):
+    """
+    The patch is valid, but depends on triples outside the LDPR
+    """
+
+class ConcurrentPatch(Exception):
+    """
+    The LDPR was modified since the patch read it
+    """
+
+def _walk(node):
+    """
+    Yield the CompValues and triple patterns of an update algebra
+    """
+    if isinstance(node, CompValue):
+        yield node
+        # Not translated to BGPs in some places (e.g. FILTER EXISTS): flat s p o lists
+        if node.name == 'TriplesBlock':
+            for triples in node.triples:
+                for index in range(0, len(triples) - 2, 3):
+                    yield tuple(triples[index:index + 3])
+            return
+    if isinstance(node, tuple) and len(node) == 3 and all(isinstance(term, (Node, Path)) for term in node):
+        yield node
+    elif isinstance(node, dict):
+        for value in node.values():
+            yield from _walk(value)
+    elif isinstance(node, (list, tuple)):
+        for value in node:
+            yield from _walk(value)
+
+def parse_patch(text, ldpr_ref):
+    """
+    Parse a SPARQL update, relative IRIs being resolved against ldpr_ref
+
+    Return (update, predicates): predicates are those the update mentions,
+    None if it may touch any (variable predicates or property paths).
+    """
+    try:
+        update = translateUpdate(parseUpdate(text), base=str(ldpr_ref))
+    except Exception as e:
+        raise InvalidPatch("Invalid SPARQL update: {0}".format(e))
+
+    predicates = set()
+    for operation in getattr(update, 'algebra', update):
+        if operation.name not in ALLOWED_OPERATIONS:
+            raise InvalidPatch("{0} is not supported in a PATCH".format(operation.name))
+        if operation.withClause or operation.using:
+            raise InvalidPatch("WITH and USING are not supported in a PATCH")
+
+        for node in _walk(operation):
+            if isinstance(node, CompValue):
+                if node.name in FORBIDDEN_PATTERNS:
+                    raise InvalidPatch("{0} is not supported in a PATCH".format(node.name))
+                if node.quads:
+                    raise InvalidPatch("GRAPH is not supported in a PATCH")
+                if node.name in EXISTS_PATTERNS:
+                    for pattern in _walk(node.graph):
+                        if isinstance(pattern, tuple) and pattern[0] != ldpr_ref:
+                            raise UnprocessablePatch("EXISTS can only test triples of {0}".format(ldpr_ref))
+                continue
+
+            subject, predicate, obj = node
+            if isinstance(subject, URIRef) and subject != ldpr_ref:
+                raise ForbiddenPatch("Only triples of {0} can be patched".format(ldpr_ref))
+            if predicates is not None:
+                if isinstance(predicate, URIRef):
+                    predicates.add(predicate)
+                else:
+                    predicates = None
+
+    return update, predicates
+
+def patch_delta(graph, update, ldpr_ref):
+    """
+    Apply update to graph (the triples it may see) and return the
+    (removed, added) triples
+    """
+    before = set(graph)
+    try:
+        evalUpdate(graph, update)
+    except Exception as e:
+        raise InvalidPatch("Could not apply the update: {0}".format(e))
+    after = set(graph)
+
+    removed, added = before - after, after - before
+    for subject, predicate, obj in removed | added:
+        if subject != ldpr_ref:
+            raise ForbiddenPatch("Only triples of {0} can be patched".format(ldpr_ref))
+        if predicate in SERVER_MANAGED_PREDICATES:
+            raise ForbiddenPatch("{0} is managed by the server".format(predicate))
+
+    for triple in removed:
+        if isinstance(triple[2], BNode):
+            raise InvalidPatch("Triples with blank nodes can't be removed by a PATCH")
+
+    return removed, added
+
+@metrics.timed('glutton_data_call_duration_seconds')
+@asyncio.coroutine
+def ldpr_patch(container, ldpr_ref, update, predicates=None, modification_date=None):
+    """
+    Apply a parsed update (see parse_patch) to a LDPR and bump its
+    modification date, unless it changed nothing. Return whether it did.
+
+    `modification_date` is the one the caller checked the etag against:
+    the write only applies if the LDPR still has it, ConcurrentPatch is
+    raised otherwise.
+    """
+    store = yield from container.engines['triplestore']
+
+    # From the primary: the copy must not be older than modification_date
+    graph = yield from ldpr_load_predicates(container, ldpr_ref, predicates, primary=True)
+
+    removed, added = patch_delta(graph, update, ldpr_ref)
+    if not removed and not added:
+        LOG.debug("Patch of {0} changed nothing".format(ldpr_ref))
+        return False
+
+    batch = WriteBatch()
+    for triple in removed:
+        batch.remove(triple)
+    for triple in added:
+        batch.add(triple)
+
+    if modification_date is not None:
+        # Every modification date goes, not only the checked one
+        old_modified = Variable('modified')
+        batch.remove((ldpr_ref, DCTERMS.modified, old_modified))
+        condition = "{0} {1} {2} . {0} {1} {3}".format(ldpr_ref.n3(), DCTERMS.modified.n3(),
+                                                      modification_date.n3(), old_modified.n3())
+    else:
+        condition = "FILTER NOT EXISTS {{ {0} {1} ?modified }}".format(ldpr_ref.n3(), DCTERMS.modified.n3())
+    new_modified = (ldpr_ref, DCTERMS.modified, Literal(datetime.now()))
+    batch.add(new_modified)
+    batch.touch(ldpr_ref)
+
+    # Invalidates what this worker knew of the LDPR, applied or not
+    yield from batch.commit(container, where=store.scoped(ldpr_ref, condition))
+
+    applied = yield from store.ask("ASK {{ {0} }}".format(store.scoped(ldpr_ref, " ".join(term.n3() for term in new_modified))),
+                                   primary=True)
+    if not applied:
+        raise ConcurrentPatch("{0} was modified meanwhile".format(ldpr_ref))
+
+    LOG.debug("Patched LDPR {0}: -{1} +{2} triples".format(ldpr_ref, len(removed), len(added)))
+
+    return True
@@ -0,0 +1,128 @@
+"""
+Slug allocation for LDPRs created by POST
+
+Slugs suggested by clients are numbered like UniqueSlugify does
+("comment", "comment-1", "comment-2"...), but instead of probing every
+candidate, the next free number is kept per LDPC and slug: in a local
+allocation table, seeded from a counter stored in the triplestore so that
+restarted workers pick up where they stopped. Counters have urn: IRIs,
+out of the LDPR space, so that clients never see them.
+
+A candidate is reserved with a conditional update that only succeeds if
+nothing uses it yet; that is atomic on the store side, hence safe across
+workers. Taking a free slug costs two round trips (the update and a
+check that it applied), three when this worker has no number for the slug
+yet and reads the stored counter first, whatever the occupation.
+"""
+import asyncio
+import logging
+from urllib.parse import quote
+import uuid
+
+from rdflib import URIRef, Literal
+from slugify import Slugify
+
+from ..utils.namespace import GLUTTON
+
+LOG = logging.getLogger(__name__)
+
+# Give up numbering after this many lost races, use an uuid instead
+MAX_ATTEMPTS = 8
+
+_slugify = Slugify(to_lower=True)
+
+def _counter_ref(ldpc_ref, slug):
+    return URIRef("urn:glutton:slug:" + quote(ldpc_ref, safe='') + ":" + slug)
+
+def _candidate(slug, number):
+    return slug if number == 0 else "{0}-{1}".format(slug, number)
+
+@asyncio.coroutine
+def _stored_next_number(container, counter_ref):
+    store = yield from container.engines['triplestore']
+    value = yield from store.value(counter_ref, GLUTTON.slugNext, primary=True)
+    return int(value) if value is not None else 0
+
+@asyncio.coroutine
+def _reserve(container, ldpr_ref, counter_ref, next_number, token):
+    """
+    Reserve ldpr_ref unless it is used (or was deleted), and move the
+    stored counter forward. Return True if the reservation is ours.
+    """
+    store = yield from container.engines['triplestore']
+
+    reservation = Literal(token)
+    next_number = Literal(next_number)
+    reserved_triple = "{0} {1} {2}".format(ldpr_ref.n3(), GLUTTON.reservedBy.n3(), reservation.n3())
+    counter_pattern = "{0} {1} ".format(counter_ref.n3(), GLUTTON.slugNext.n3())
+    yield from store.update(
+        "INSERT {{ {reserve} }} WHERE {{ FILTER NOT EXISTS {{ {ldpr} }} }} ;\n"
+        "DELETE {{ {old_counter} }} INSERT {{ {new_counter} }} "
+        "WHERE {{ OPTIONAL {{ {old_counter} }} FILTER (!BOUND(?n) || ?n < {next}) }}".format(
+            reserve=store.scoped(ldpr_ref, reserved_triple),
+            ldpr=store.scoped(ldpr_ref, "{0} ?p ?o".format(ldpr_ref.n3())),
+            old_counter=store.scoped(counter_ref, counter_pattern + "?n"),
+            new_counter=store.scoped(counter_ref, counter_pattern + next_number.n3()),
+            next=next_number.n3()),
+        touched=(ldpr_ref, counter_ref))
+
+    reserved = yield from store.ask("ASK {{ {0} }}".format(store.scoped(ldpr_ref, reserved_triple)),
+                                  primary=True)
+    return reserved
+
+@asyncio.coroutine
+def slug_reserve(container, ldpc_ref, suggested_slug=None):
+    """
+    Reserve a free LDPR reference in ldpc_ref, based on suggested_slug if
+    any. Return (ldpr_ref, token): the reservation must be claimed by the
+    write creating the LDPR (see slug_claim) or released.
+
+    Without a suggestion, the slug is an uuid which needs no reservation
+    (token is None).
+    """
+    slug = _slugify(suggested_slug) if suggested_slug else None
+    if not slug:
+        return URIRef(ldpc_ref + "/" + str(uuid.uuid4())), None
+
+    token = uuid.uuid4().hex
+
+    allocations = container.caches['slug_allocations']
+    counter_ref = _counter_ref(ldpc_ref, slug)
+    key = (ldpc_ref, slug)
+
+    for attempt in range(MAX_ATTEMPTS):
+        number = allocations.get(key)
+        if number is None or attempt > 0:
+            # Unknown here, or another worker went further
+            stored_number = yield from _stored_next_number(container, counter_ref)
+            number = max(number or 0, stored_number)
+
+        # Taken before yielding, so concurrent requests of this worker get other numbers
+        allocations.set(key, number + 1)
+
+        ldpr_ref = URIRef(ldpc_ref + "/" + _candidate(slug, number))
+        reserved = yield from _reserve(container, ldpr_ref, counter_ref, number + 1, token)
+        if reserved:
+            return ldpr_ref, token
+
+        LOG.debug("Slug {0} was taken, retrying".format(ldpr_ref))
+
+    LOG.warning("Could not number slug {0} in {1}, falling back to an uuid".format(slug, ldpc_ref))
+    return (yield from slug_reserve(container, ldpc_ref))
+
+def slug_claim(batch, ldpr_ref):
+    """
+    Drop the reservation of ldpr_ref as part of the batch creating it
+    """
+    batch.remove((ldpr_ref, GLUTTON.reservedBy, None))
+
+@asyncio.coroutine
+def slug_release(container, ldpr_ref, token):
+    """
+    Give back an unused reservation. Its number is not reused.
+    """
+    if token is None:
+        return
+
+    store = yield from container.engines['triplestore']
+    yield from store.remove((ldpr_ref, GLUTTON.reservedBy, Literal(token)))
@@ -0,0 +1,74 @@
+import hashlib
+import logging
+import math
+
+LOG = logging.getLogger(__name__)
+
+class BloomFilter(object):
+    """
+    A set of strings answering "definitely not in it" or "maybe in it".
+
+    Sized for `capacity` items at a `false_positive_rate`; past capacity it
+    keeps working with more false positives (see stats). Items can't be
+    removed. Until marked `ready`, every lookup answers "maybe", so the
+    filter can be filled while it is already in use.
+    """
+    def __init__(self, capacity=1000000, false_positive_rate=0.01):
+        self.capacity = capacity
+        self.false_positive_rate = false_positive_rate
+
+        self.bits = max(8, int(math.ceil(-capacity * math.log(false_positive_rate) / math.log(2) ** 2)))
+        self.hashes = max(1, int(round(self.bits / capacity * math.log(2))))
+        self._array = bytearray((self.bits + 7) // 8)
+
+        self.ready = False
+        self.items = 0
+        self.negatives = 0
+        self.positives = 0
+
+    def _positions(self, item):
+        # Double hashing, the 2 halves of a md5
+        digest = hashlib.md5(item.encode('utf-8')).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return [(h1 + index * h2) % self.bits for index in range(self.hashes)]
+
+    def add(self, item):
+        added = False
+        for position in self._positions(item):
+            mask = 1 << (position & 7)
+            if not self._array[position >> 3] & mask:
+                self._array[position >> 3] |= mask
+                added = True
+
+        if added:
+            self.items += 1
+            if self.items == self.capacity + 1:
+                LOG.warning("Bloom filter over its capacity of {0} items, false positives will grow".format(self.capacity))
+
+    def __contains__(self, item):
+        if not self.ready:
+            return True
+
+        for position in self._positions(item):
+            if not self._array[position >> 3] & (1 << (position & 7)):
+                self.negatives += 1
+                return False
+
+        self.positives += 1
+        return True
+
+    def estimated_false_positive_rate(self):
+        return (1 - math.exp(-self.hashes * self.items / self.bits)) ** self.hashes
+
+    def stats(self):
+        lookups = self.negatives + self.positives
+        return {'ready': int(self.ready),
+                'items': self.items,
+                'capacity': self.capacity,
+                'bytes': len(self._array),
+                'hashes': self.hashes,
+                'negatives': self.negatives,
+                'positives': self.positives,
+                'negative_ratio': self.negatives / lookups if lookups else 0.0,
+                'false_positive_rate': self.estimated_false_positive_rate()}
@@ -0,0 +1,119 @@
+from collections import OrderedDict
+import logging
+
+LOG = logging.getLogger(__name__)
+
+class LRUCache(object):
+    """
+    A bounded mapping evicting the least recently used entries first.
+
+    Each entry weighs `size` (1 by default) against `max_size`, so the
+    cache can be bounded by entry count or by bytes. Entries can be tagged
+    to be invalidated together; an entry is always tagged by its own key.
+    Counts hits and misses.
+    """
+    def __init__(self, max_size=1024):
+        self.max_size = max_size
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+
+        self._entries = OrderedDict()
+        self._tags = {}
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def get(self, key, default=None):
+        try:
+            entry = self._entries.pop(key)
+        except KeyError:
+            self.misses += 1
+            return default
+
+        # Move to the most recently used end
+        self._entries[key] = entry
+        self.hits += 1
+        return entry[0]
+
+    def set(self, key, value, size=1, tags=()):
+        self._remove(key)
+
+        # Never let one entry flush the whole cache
+        if size > self.max_size:
+            return
+
+        tags = set(tags)
+        tags.add(key)
+        self._entries[key] = (value, size, tags)
+        self.size += size
+        for tag in tags:
+            self._tags.setdefault(tag, set()).add(key)
+
+        while self.size > self.max_size:
+            oldest_key = next(iter(self._entries))
+            self._remove(oldest_key)
+
+    def invalidate(self, tag):
+        """
+        Drop every entry tagged with tag
+        """
+        for key in list(self._tags.get(tag, ())):
+            self._remove(key)
+
+    def clear(self):
+        self._entries.clear()
+        self._tags.clear()
+        self.size = 0
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {'entries': len(self._entries),
+                'size': self.size,
+                'max_size': self.max_size,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': self.hits / lookups if lookups else 0.0}
+
+    def _remove(self, key):
+        try:
+            value, size, tags = self._entries.pop(key)
+        except KeyError:
+            return
+
+        self.size -= size
+        for tag in tags:
+            keys = self._tags[tag]
+            keys.discard(key)
+            if not keys:
+                del self._tags[tag]
+
+class Generations(object):
+    """
+    Per-key counters of invalidations, for loads racing a write: read the
+    generation of a key before fetching it, and only cache the result if
+    it is the same afterwards.
+
+    Bounded to `max_size` keys: past it, every counter is reset and the
+    epoch bumped, so that all loads in flight skip caching.
+    """
+    def __init__(self, max_size=100000):
+        self.max_size = max_size
+        self.epoch = 0
+
+        self._counters = {}
+
+    def __len__(self):
+        return len(self._counters)
+
+    def get(self, key):
+        return self.epoch, self._counters.get(key, 0)
+
+    def bump(self, key):
+        if key not in self._counters and len(self._counters) >= self.max_size:
+            self._counters.clear()
+            self.epoch += 1
+        self._counters[key] = self._counters.get(key, 0) + 1
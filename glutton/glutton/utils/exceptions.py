@@ -13,3 +13,6 @@ class LDPHTTPConflict(HTTPConflict):
 
 class HTTPPreconditionRequired(HTTPClientError):
     status_code = 428
+
+class HTTPUnprocessableEntity(HTTPClientError):
+    status_code = 422
@@ -0,0 +1,169 @@
+"""
+In-process metrics, exported in the Prometheus text format at /metrics
+
+Counters and latency histograms are kept per worker in REGISTRY, keyed by
+name and labels. Recording is a couple of dict operations, cheap enough
+for the hot paths.
+"""
+import asyncio
+from contextlib import contextmanager
+import functools
+import logging
+import time
+
+from aiohttp.web import HTTPException
+
+LOG = logging.getLogger(__name__)
+
+# Seconds
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+class Histogram(object):
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[index] += 1
+                break
+
+class Registry(object):
+    def __init__(self):
+        self.counters = {}
+        self.histograms = {}
+        self.help = {}
+
+    def describe(self, name, text):
+        self.help[name] = text
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            histogram = self.histograms[key] = Histogram()
+        histogram.observe(value)
+
+    def render(self, gauges=()):
+        """
+        Prometheus text exposition of everything recorded, plus gauges:
+        (name, labels, value) tuples computed by the caller.
+        """
+        lines = []
+        described = set()
+
+        def header(name, metric_type):
+            if name not in described:
+                described.add(name)
+                if name in self.help:
+                    lines.append("# HELP {0} {1}".format(name, self.help[name]))
+                lines.append("# TYPE {0} {1}".format(name, metric_type))
+
+        for (name, labels), value in sorted(self.counters.items()):
+            header(name, 'counter')
+            lines.append("{0}{1} {2}".format(name, _labels(labels), value))
+
+        for (name, labels), histogram in sorted(self.histograms.items(), key=lambda item: item[0]):
+            header(name, 'histogram')
+            cumulated = 0
+            for bound, count in zip(histogram.buckets, histogram.counts):
+                cumulated += count
+                lines.append("{0}_bucket{1} {2}".format(name, _labels(labels + (('le', repr(float(bound))),)), cumulated))
+            lines.append("{0}_bucket{1} {2}".format(name, _labels(labels + (('le', '+Inf'),)), histogram.count))
+            lines.append("{0}_sum{1} {2!r}".format(name, _labels(labels), histogram.sum))
+            lines.append("{0}_count{1} {2}".format(name, _labels(labels), histogram.count))
+
+        for name, labels, value in gauges:
+            header(name, 'gauge')
+            lines.append("{0}{1} {2!r}".format(name, _labels(tuple(sorted(labels.items()))), value))
+
+        return "\n".join(lines) + "\n"
+
+def _labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join('{0}="{1}"'.format(key, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                          for key, value in labels) + "}"
+
+REGISTRY = Registry()
+REGISTRY.describe('glutton_http_request_duration_seconds', "Time to compute HTTP responses, per endpoint")
+REGISTRY.describe('glutton_data_call_duration_seconds', "Duration of data service calls")
+REGISTRY.describe('glutton_triplestore_call_duration_seconds', "Duration of triplestore round trips, waiting for a connection included")
+REGISTRY.describe('glutton_serialize_duration_seconds', "Time spent serializing representations")
+REGISTRY.describe('glutton_parse_duration_seconds', "Time spent parsing request bodies")
+REGISTRY.describe('glutton_conditional_requests_total', "Requests with If-Match or If-None-Match, per outcome")
+REGISTRY.describe('glutton_coalesced_calls_total', "Coalesced reads, running the backend call (leader) or sharing it (follower)")
+REGISTRY.describe('glutton_coalesced_call_timeouts_total', "Coalesced reads given up on after the timeout")
+
+@contextmanager
+def timer(name, **labels):
+    """
+    Record the duration of the with block in the name histogram
+    """
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        REGISTRY.observe(name, time.perf_counter() - started, **labels)
+
+def timed(name, **labels):
+    """
+    Decorate a coroutine function to record the duration of its calls,
+    labelled with its name
+    """
+    def decorator(func):
+        call_labels = dict(labels, call=func.__name__)
+
+        @functools.wraps(func)
+        @asyncio.coroutine
+        def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                result = yield from func(*args, **kwargs)
+            finally:
+                REGISTRY.observe(name, time.perf_counter() - started, **call_labels)
+            return result
+
+        return wrapper
+    return decorator
+
+def cache_gauges(caches):
+    # Grouped by family: the exposition format wants the samples of a metric together
+    stats = [(cache_name, cache.stats()) for cache_name, cache in sorted(caches.items())]
+    for stat in ('entries', 'size', 'max_size', 'hits', 'misses', 'hit_ratio'):
+        for cache_name, cache_stats in stats:
+            yield ('glutton_cache_' + stat, {'cache': cache_name}, cache_stats[stat])
+
+@asyncio.coroutine
+def middleware(app, handler):
+    """
+    aiohttp middleware recording the latency and status of every request
+    """
+    owner = getattr(handler, '__self__', None)
+    endpoint = type(owner).__name__ if owner is not None else handler.__name__
+
+    @asyncio.coroutine
+    def timed_handler(request):
+        started = time.perf_counter()
+        status = 500
+        try:
+            response = yield from handler(request)
+            status = response.status
+            return response
+        except HTTPException as e:
+            status = e.status
+            raise
+        finally:
+            REGISTRY.observe('glutton_http_request_duration_seconds', time.perf_counter() - started,
+                             endpoint=endpoint, method=request.method, status=status)
+
+    return timed_handler
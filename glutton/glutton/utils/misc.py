@@ -1,42 +1,77 @@
+import asyncio
+import io
+import logging
 from urllib.parse import urljoin
 
-from aiohttp.web import HTTPUnsupportedMediaType, HTTPNotAcceptable
-from hashids import Hashids
+from aiohttp.web import HTTPUnsupportedMediaType, HTTPNotAcceptable, HTTPBadRequest, HTTPRequestEntityTooLarge
+from aiohttp.web import HTTPGatewayTimeout, HTTPException
 from rdflib.term import URIRef
-from webob.acceptparse import Accept
 
+from ..services.data import ldpr_load, ldpr_load_metadata, weak_etag
 from .namespace import LDP
+from . import metrics, negotiation, nodeids
+from .streams import RequestBodyReader, CHUNK_SIZE
+
+LOG = logging.getLogger(__name__)
 
 ### HASHING
 def get_hashid_for_node(node):
     """
     Given a Node, return a string hash
     """
-    hashids = Hashids(salt="xx") # FIXME
-    byte_array = list(bytearray(node, 'utf-8'))
-    return hashids.encode(*byte_array)
+    return nodeids.encode(node)
 
 def get_node_by_hashid(hashid):
     """
     Resolve a hash to a RDF Node
     """
-    hashids = Hashids(salt="xx") # FIXME
-    decoded_array = hashids.decode(hashid)
-    return URIRef(bytes(decoded_array).decode('utf-8'))
+    return nodeids.decode(hashid)
 
 ### Graph reading
+@asyncio.coroutine
 def feed_graph_from_request(ldpr_ref, graph, request):
+    """
+    Parse the request body into graph, chunk by chunk as it is received.
+
+    Parsing runs in a worker thread so the event loop keeps serving other
+    requests; bodies larger than the configured limit end with a 413.
+    """
+    container = request.app['ah_container']
+    loop = container.loop
+
     # Use ldpr_ref as publicID so the "null relative URI" matches the future ldpr reference
     requested_content_types = request.headers.get('Content-type', None)
     selected_content_type, selected_format = resolve_accept_header_to_rdflib_format(requested_content_types, fallback=False)
     if not selected_format:
         raise HTTPUnsupportedMediaType(reason="Unknown file format: {0}. Check your Content-type header.".format(requested_content_types))
 
-    data = yield from request.text()
-    print("====")
-    print(data)
-    print("====")
-    graph.parse(data=data, publicID=ldpr_ref, format=selected_format)
+    uploads_config = container.config.get('uploads', {})
+    max_size = uploads_config.get('max_body_size', None)
+    if max_size is not None and (request.content_length or 0) > max_size:
+        raise HTTPRequestEntityTooLarge(reason="Request body is larger than {0} bytes".format(max_size))
+
+    body = RequestBodyReader(timeout=uploads_config.get('read_timeout', 60))
+    pump = loop.create_task(body.pump(request.content, loop, max_size=max_size))
+    parse_error = None
+    try:
+        # Receiving included, parsing goes along
+        with metrics.timer('glutton_parse_duration_seconds', content_type=selected_content_type):
+            yield from loop.run_in_executor(container.parsers,
+                                            lambda: graph.parse(io.BufferedReader(body), publicID=ldpr_ref, format=selected_format))
+    except asyncio.CancelledError:
+        pump.cancel()
+        raise
+    except Exception as e:
+        parse_error = e
+    finally:
+        body.discard()
+
+    # Raises a 413 if the body was cut
+    yield from pump
+
+    if parse_error is not None:
+        LOG.debug("Could not parse body for {0}: {1}".format(ldpr_ref, parse_error))
+        raise HTTPBadRequest(reason="Invalid {0} document".format(selected_content_type))
 
     if not (ldpr_ref, None, None) in graph:
         raise HTTPNotAcceptable(reason="Document does not contains data for this LDPR") # FIXME Is that the correct HTTP error?
@@ -44,32 +79,179 @@ def feed_graph_from_request(ldpr_ref, graph, request):
     return graph
 
 
+@asyncio.coroutine
+def read_body_from_request(request):
+    """
+    Read a small request body (e.g. a patch) at once, within the
+    configured size limit
+    """
+    container = request.app['ah_container']
+
+    max_size = container.config.get('uploads', {}).get('max_body_size', None)
+    if max_size is not None and (request.content_length or 0) > max_size:
+        raise HTTPRequestEntityTooLarge(reason="Request body is larger than {0} bytes".format(max_size))
+
+    chunks = []
+    size = 0
+    while True:
+        chunk = yield from request.content.read(CHUNK_SIZE)
+        if not chunk:
+            break
+        size += len(chunk)
+        if max_size is not None and size > max_size:
+            raise HTTPRequestEntityTooLarge(reason="Request body is larger than {0} bytes".format(max_size))
+        chunks.append(chunk)
+
+    return b''.join(chunks)
+
+
 ### HTTP
 def get_ldpr_from_request(request):
     return URIRef(urljoin("http://" + request.host, request.path).rstrip("/")) # HTTP Hardcoded, what about ssl?
 
-### RDFLIB
-def resolve_accept_header_to_rdflib_format(accept_header, fallback=True, fallback_format=('text/turtle', 'n3')):
+def get_preferred_page_size(request):
     """
-    Given an HTTP Accept: header, return an RDFLib acceptable format for serializing
+    Read the LDP Paging hint of a "Prefer: return=representation;
+    max-member-count=N" header, None if there is none.
+    """
+    for preference in request.headers.getall('Prefer', ()):
+        for parameter in preference.split(';'):
+            name, _, value = parameter.strip().partition('=')
+            if name.strip().lower() == 'max-member-count':
+                try:
+                    return int(value.strip().strip('"'))
+                except ValueError:
+                    return None
+    return None
+
+def get_page_request(request, state):
+    """
+    Return the (cursor, page size) of a GET of a LDPC page (W3C LDP
+    Paging), None if the whole LDPR is requested
+    """
+    if request.method != 'GET' or not state.has_type(LDP.Container):
+        return None
+
+    page_size = get_preferred_page_size(request)
+    if page_size is None and 'page' not in request.GET:
+        return None
+
+    paging_config = request.app['ah_container'].config.get('paging', {})
+    if page_size is None or page_size <= 0:
+        page_size = paging_config.get('page_size', 50)
+    page_size = min(page_size, paging_config.get('max_page_size', 1000))
+
+    return request.GET.get('page', ''), page_size
+
+def get_etag(request, state):
+    """
+    Etag of what the request gets: the LDPR's, or for a page, one derived
+    from it and the page bounds
     """
-    content_type_mapping = {
-        'application/ld+json': 'json-ld',
-        'text/turtle': 'n3'
-    }
+    etag = state.etag
+    page = get_page_request(request, state)
+    if etag is None or page is None:
+        return etag
+    return weak_etag("{0} {1} {2}".format(etag, *page))
 
-    server_offer = (
-        ('text/turtle', 1),
-        ('application/ld+json', 0.8)
-    )
+def metadata_is_enough(request):
+    """
+    Tell if a request can be answered from the LDPR metadata only: HEAD,
+    OPTIONS, DELETE, conditional GETs that may end in a 304, paged GETs
+    (the page is fetched on its own) and GETs whose representation may be
+    cached.
+    """
+    if request.method in ('HEAD', 'OPTIONS', 'DELETE', 'PATCH'):
+        return True
+    if request.method != 'GET':
+        return False
+
+    if get_preferred_page_size(request) is not None or 'page' in request.GET:
+        return True
+
+    ldpr_ref = get_ldpr_from_request(request)
+    return ('If-None-Match' in request.headers or
+            ldpr_ref in request.app['ah_container'].caches['ldpr_metadata'])
+
+@asyncio.coroutine
+def get_ldpr_state(request, metadata_only=None):
+    """
+    Load the requested LDPR once and keep it along the request so that
+    decorators and views share the same backend round trip.
+
+    If metadata_only is None, guess it from the request. LDPRs too big
+    for GET to load at once come truncated, to be streamed.
+    """
+    if metadata_only is None:
+        metadata_only = metadata_is_enough(request)
+
+    state = request.get('ldpr_state')
+    if state is None or not (state.complete or state.truncated or metadata_only):
+        container = request.app['ah_container']
+        ldpr_ref = get_ldpr_from_request(request)
+        if metadata_only:
+            load = lambda: ldpr_load_metadata(container, ldpr_ref)
+        elif request.method == 'GET':
+            limit = container.config.get('streaming', {}).get('threshold', None)
+            load = lambda: ldpr_load(container, ldpr_ref, limit=limit)
+        else:
+            load = lambda: ldpr_load(container, ldpr_ref)
+
+        # Writes must see what was committed before them, not join an older read
+        if request.method in ('GET', 'HEAD'):
+            state = yield from coalesce(request, ('state', ldpr_ref, metadata_only), load)
+        else:
+            state = yield from load()
+        request['ldpr_state'] = state
+
+    return state
+
+@asyncio.coroutine
+def coalesce(request, key, coroutine_factory):
+    """
+    Share the result of coroutine_factory() with concurrent requests
+    asking for the same key (see utils.singleflight), tagged with the
+    requested LDPR
+    """
+    container = request.app['ah_container']
+    try:
+        result = yield from container.reads.do(key, coroutine_factory, tags=(get_ldpr_from_request(request),))
+    except asyncio.TimeoutError:
+        raise HTTPGatewayTimeout(reason="Timed out waiting for the triplestore")
+    except HTTPException as e:
+        # Shared by every caller, but a response can only be sent once
+        raise copy_http_exception(e)
+
+    return result
 
-    accept = Accept(accept_header)
-    content_type_match = accept.best_match(server_offer)
+def copy_http_exception(exception):
+    """
+    Return a new HTTP exception with the status, reason, headers and body
+    of the given one
+    """
+    copy = HTTPException.__new__(type(exception))
+    HTTPException.__init__(copy, headers=exception.headers, reason=exception.reason, body=exception.body)
+    return copy
+
+def forget_ldpr_state(request):
+    """
+    Drop the loaded LDPR, e.g. after it was modified
+    """
+    request.pop('ldpr_state', None)
+
+### RDFLIB
+def resolve_accept_header_to_rdflib_format(accept_header, fallback=True, fallback_format=None):
+    """
+    Given an HTTP Accept: header, return an RDFLib acceptable format for serializing
+
+    Falls back to fallback_format, or the preferred format of the server.
+    """
+    content_type_match, rdflib_format = negotiation.resolve(accept_header)
 
     if content_type_match:
-        return (content_type_match, content_type_mapping[content_type_match])
+        return (content_type_match, rdflib_format)
     else:
         if fallback:
-            return fallback_format
+            return fallback_format or negotiation.default_format()
 
     return (None, None)
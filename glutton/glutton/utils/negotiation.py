@@ -0,0 +1,74 @@
+"""
+Content negotiation between HTTP content types and rdflib formats
+
+The formats offered to clients come from the "formats" configuration.
+Clients send few distinct Accept (or Content-type) headers, so their
+resolution is memoized in a bounded LRU cache.
+"""
+import logging
+
+from webob.acceptparse import Accept
+
+from .cache import LRUCache
+
+LOG = logging.getLogger(__name__)
+
+# (content type, quality, rdflib format), preferred first
+DEFAULT_OFFER = (
+    ('text/turtle', 1, 'n3'),
+    ('application/ld+json', 0.8, 'json-ld'),
+    ('application/n-triples', 0.5, 'nt'),
+)
+
+class Negotiator(object):
+    def __init__(self, offer=DEFAULT_OFFER, cache_size=1024):
+        self.server_offer = tuple((content_type, quality) for content_type, quality, rdflib_format in offer)
+        self.content_type_mapping = dict((content_type, rdflib_format) for content_type, quality, rdflib_format in offer)
+        self.default = (offer[0][0], offer[0][2])
+
+        self._resolved = LRUCache(max_size=cache_size)
+
+    def resolve(self, header):
+        """
+        Return the (content type, rdflib format) best matching header,
+        (None, None) if there is none.
+        """
+        resolved = self._resolved.get(header)
+        if resolved is None:
+            content_type_match = Accept(header).best_match(self.server_offer)
+            if content_type_match:
+                resolved = (content_type_match, self.content_type_mapping[content_type_match])
+            else:
+                resolved = (None, None)
+            self._resolved.set(header, resolved)
+        return resolved
+
+_negotiator = Negotiator()
+
+def configure(config):
+    """
+    Build the negotiator from the "formats" configuration: {'offer': [{'content_type': ...,
+    'quality': ..., 'rdflib_format': ...}, ...], 'cache_size': ...}
+    """
+    global _negotiator
+    offer = tuple((entry['content_type'], entry.get('quality', 1), entry['rdflib_format'])
+                  for entry in config.get('offer', ())) or DEFAULT_OFFER
+    _negotiator = Negotiator(offer, cache_size=config.get('cache_size', 1024))
+
+def resolve(header):
+    return _negotiator.resolve(header)
+
+def default_format():
+    return _negotiator.default
+
+def content_types():
+    """
+    Offered content types, preferred first
+    """
+    return tuple(content_type for content_type, quality in _negotiator.server_offer)
+
+def formats():
+    """
+    Map the offered content types to their rdflib format
+    """
+    return dict(_negotiator.content_type_mapping)
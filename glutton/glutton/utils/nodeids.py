@@ -0,0 +1,75 @@
+"""
+Opaque, URL safe ids for RDF nodes (e.g. LDP Paging cursors)
+
+A node is packed into a single big integer, its UTF-8 bytes behind a
+0x01 marker byte, so that its id is about as long as the URI itself.
+The Hashids instance is built once, by configure(), and the last
+encoded/decoded nodes are kept in LRU caches.
+
+Ids made by the former encoding (one integer per byte) still decode.
+"""
+import logging
+
+from hashids import Hashids
+from rdflib.term import URIRef
+
+from .cache import LRUCache
+
+LOG = logging.getLogger(__name__)
+
+class NodeIdCodec(object):
+    def __init__(self, salt="xx", min_length=0, cache_size=10000):
+        self._hashids = Hashids(salt=salt, min_length=min_length)
+        self._encoded = LRUCache(max_size=cache_size)
+        self._decoded = LRUCache(max_size=cache_size)
+
+    def encode(self, node):
+        hashid = self._encoded.get(node)
+        if hashid is None:
+            number = int.from_bytes(b'\x01' + str(node).encode('utf-8'), 'big')
+            hashid = self._hashids.encode(number)
+            self._encoded.set(node, hashid)
+        return hashid
+
+    def decode(self, hashid):
+        """
+        Resolve an id to a URIRef. Raise ValueError if it is not valid.
+        """
+        node = self._decoded.get(hashid)
+        if node is not None:
+            return node
+
+        numbers = self._hashids.decode(hashid)
+        if not numbers:
+            raise ValueError("Invalid node id {0}".format(hashid))
+
+        if len(numbers) == 1 and numbers[0] > 0xff:
+            data = numbers[0].to_bytes((numbers[0].bit_length() + 7) // 8, 'big')
+            if data[0] != 1:
+                raise ValueError("Invalid node id {0}".format(hashid))
+            data = data[1:]
+        else:
+            # Former encoding: one number per byte
+            data = bytes(numbers)
+
+        node = URIRef(data.decode('utf-8'))
+        self._decoded.set(hashid, node)
+        return node
+
+_codec = NodeIdCodec()
+
+def configure(config):
+    """
+    Build the codec from the "node_ids" configuration:
+    {'salt': ..., 'min_length': ..., 'cache_size': ...}
+    """
+    global _codec
+    _codec = NodeIdCodec(salt=config.get('salt', "xx"),
+                         min_length=config.get('min_length', 0),
+                         cache_size=config.get('cache_size', 10000))
+
+def encode(node):
+    return _codec.encode(node)
+
+def decode(hashid):
+    return _codec.decode(hashid)
@@ -0,0 +1,204 @@
+"""
+Fast serializers for flat graphs, i.e. a LDPR and its direct triples.
+
+rdflib's generic serializers walk the graph several times to pretty print
+nested structures we never produce. These write the triples straight to
+bytes, in the order they come; the stream writers do so batch by batch
+for LDPRs too big to be held in memory.
+"""
+import logging
+
+from rdflib import Graph
+from rdflib.namespace import RDF
+from rdflib.plugins.serializers.nt import _nt_row
+from rdflib.term import BNode, Literal
+import ujson
+
+from . import metrics
+from .namespace import GLUTTON
+
+LOG = logging.getLogger(__name__)
+
+# Content types served by the fast serializers rather than rdflib's
+_fast_content_types = set(('text/turtle', 'application/ld+json', 'application/n-triples'))
+
+def configure(config):
+    """
+    Pick "fast" or "rdflib" serialization per content type, e.g.
+    {'text/turtle': 'fast', 'application/ld+json': 'rdflib'}
+    """
+    for content_type, serializer in config.items():
+        if serializer == 'fast':
+            _fast_content_types.add(content_type)
+        elif serializer == 'rdflib':
+            _fast_content_types.discard(content_type)
+        else:
+            raise ValueError("Unknown serializer {0} for {1}".format(serializer, content_type))
+
+def client_triples(triples):
+    """
+    Drop the triples Glutton keeps for itself (GLUTTON predicates, such
+    as the containedIn index) from what clients get
+    """
+    return (triple for triple in triples if not triple[1].startswith(GLUTTON))
+
+### Turtle
+class TurtleStream(object):
+    """
+    Turtle writer fed with batches of triples, in any order.
+    Consecutive triples sharing subject (and predicate) are grouped.
+    """
+    def __init__(self):
+        self._subject = None
+        self._predicate = None
+
+    def feed(self, triples):
+        chunks = []
+        for s, p, o in triples:
+            if s == self._subject and p == self._predicate:
+                chunks.append(", " + o.n3())
+            elif s == self._subject:
+                chunks.append(" ;\n    " + p.n3() + " " + o.n3())
+            else:
+                if self._subject is not None:
+                    chunks.append(" .\n\n")
+                chunks.append(s.n3() + " " + p.n3() + " " + o.n3())
+            self._subject, self._predicate = s, p
+
+        return "".join(chunks).encode('utf-8')
+
+    def close(self):
+        if self._subject is None:
+            return b""
+        return b" .\n"
+
+def serialize_turtle(triples):
+    stream = TurtleStream()
+    return stream.feed(triples) + stream.close()
+
+### N-Triples
+class NTriplesStream(object):
+    """
+    N-Triples writer fed with batches of triples, one line each
+    """
+    def feed(self, triples):
+        return "".join(_nt_row(triple) for triple in triples).encode('utf-8')
+
+    def close(self):
+        return b""
+
+def serialize_ntriples(triples):
+    return NTriplesStream().feed(triples)
+
+### JSON-LD
+def _jsonld_id(node):
+    if isinstance(node, BNode):
+        return "_:" + node
+    return str(node)
+
+def _jsonld_object(node):
+    if not isinstance(node, Literal):
+        return {"@id": _jsonld_id(node)}
+
+    value = {"@value": str(node)}
+    if node.language:
+        value["@language"] = node.language
+    elif node.datatype:
+        value["@type"] = str(node.datatype)
+    return value
+
+def _dumps(obj):
+    return ujson.dumps(obj, ensure_ascii=False, escape_forward_slashes=False)
+
+def serialize_jsonld(triples):
+    """
+    Expanded JSON-LD: one node object per subject
+    """
+    nodes = {}
+    for s, p, o in triples:
+        node = nodes.get(s)
+        if node is None:
+            node = nodes[s] = {"@id": _jsonld_id(s)}
+
+        if p == RDF.type and not isinstance(o, Literal):
+            node.setdefault("@type", []).append(_jsonld_id(o))
+        else:
+            node.setdefault(str(p), []).append(_jsonld_object(o))
+
+    return _dumps(list(nodes.values())).encode('utf-8')
+
+class JsonLDStream(object):
+    """
+    Expanded JSON-LD writer fed with batches of triples, one node object
+    per subject. Triples must come grouped by subject, ordered by predicate.
+    """
+    def __init__(self):
+        self._subject = None
+        self._predicate = None
+        self._started = False
+
+    def feed(self, triples):
+        chunks = []
+        if not self._started:
+            chunks.append("[")
+            self._started = True
+
+        for s, p, o in triples:
+            if s != self._subject:
+                if self._subject is not None:
+                    chunks.append("]},")
+                chunks.append('{"@id":' + _dumps(_jsonld_id(s)))
+                self._subject, self._predicate = s, None
+
+            if p == RDF.type and not isinstance(o, Literal):
+                key, value = "@type", _dumps(_jsonld_id(o))
+            else:
+                key, value = str(p), _dumps(_jsonld_object(o))
+
+            if key == self._predicate:
+                chunks.append("," + value)
+            else:
+                if self._predicate is not None:
+                    chunks.append("]")
+                chunks.append("," + _dumps(key) + ":[" + value)
+                self._predicate = key
+
+        return "".join(chunks).encode('utf-8')
+
+    def close(self):
+        chunks = self.feed(())
+        if self._subject is not None:
+            chunks += b"]}"
+        return chunks + b"]"
+
+SERIALIZERS = {
+    'text/turtle': serialize_turtle,
+    'application/ld+json': serialize_jsonld,
+    'application/n-triples': serialize_ntriples,
+}
+
+# Incremental writers for streamed LDPRs
+STREAM_WRITERS = {
+    'text/turtle': TurtleStream,
+    'application/ld+json': JsonLDStream,
+    'application/n-triples': NTriplesStream,
+}
+
+def serialize(graph, content_type, rdflib_format):
+    """
+    Serialize graph using the fast serializer if enabled for content_type,
+    rdflib otherwise.
+    """
+    if content_type in _fast_content_types and content_type in SERIALIZERS:
+        with metrics.timer('glutton_serialize_duration_seconds', content_type=content_type, serializer='fast'):
+            return SERIALIZERS[content_type](client_triples(graph.triples((None, None, None))))
+
+    with metrics.timer('glutton_serialize_duration_seconds', content_type=content_type, serializer='rdflib'):
+        if any(predicate.startswith(GLUTTON) for predicate in graph.predicates()):
+            client_graph = Graph()
+            for prefix, namespace in graph.namespaces():
+                client_graph.bind(prefix, namespace)
+            for triple in client_triples(graph.triples((None, None, None))):
+                client_graph.add(triple)
+            graph = client_graph
+        return graph.serialize(format=rdflib_format)
@@ -0,0 +1,80 @@
+import asyncio
+import logging
+
+from . import metrics
+
+LOG = logging.getLogger(__name__)
+
+class SingleFlight(object):
+    """
+    Coalesce concurrent identical calls: the first caller for a key runs
+    the coroutine, the ones arriving while it is in flight await the same
+    result (or exception).
+
+    The shared call is shielded, so a caller giving up (client gone,
+    timeout) does not cancel it for the others. Each caller waits at most
+    `timeout` seconds.
+
+    Calls can be tagged; once a tag is forgotten (e.g. its LDPR was
+    modified), new callers start a new call instead of joining an older one.
+    """
+    def __init__(self, timeout=None, enabled=True, loop=None):
+        self.loop = loop or asyncio.get_event_loop()
+        self.timeout = timeout
+        self.enabled = enabled
+
+        self._calls = {}
+        self._tags = {}
+
+    def __len__(self):
+        return len(self._calls)
+
+    @asyncio.coroutine
+    def do(self, key, coroutine_factory, tags=()):
+        """
+        Return the result of coroutine_factory(), shared with concurrent
+        calls for key
+        """
+        if not self.enabled:
+            return (yield from coroutine_factory())
+
+        task = self._calls.get(key)
+        if task is None:
+            task = self.loop.create_task(coroutine_factory())
+            self._calls[key] = task
+            for tag in tags:
+                self._tags.setdefault(tag, set()).add(key)
+            task.add_done_callback(lambda done: self._done(key, done, tags))
+            metrics.REGISTRY.inc('glutton_coalesced_calls_total', role='leader')
+        else:
+            metrics.REGISTRY.inc('glutton_coalesced_calls_total', role='follower')
+
+        try:
+            result = yield from asyncio.wait_for(asyncio.shield(task, loop=self.loop), self.timeout, loop=self.loop)
+        except asyncio.TimeoutError:
+            metrics.REGISTRY.inc('glutton_coalesced_call_timeouts_total')
+            LOG.warning("Gave up waiting for {0!r} after {1}s".format(key, self.timeout))
+            raise
+
+        return result
+
+    def forget(self, tag):
+        """
+        Let the calls tagged with tag finish for their callers only
+        """
+        for key in self._tags.pop(tag, ()):
+            self._calls.pop(key, None)
+
+    def _done(self, key, task, tags):
+        if self._calls.get(key) is task:
+            del self._calls[key]
+            for tag in tags:
+                keys = self._tags.get(tag)
+                if keys is not None:
+                    keys.discard(key)
+                    if not keys:
+                        del self._tags[tag]
+
+        # Seen by the callers if any are left; don't warn about it otherwise
+        if not task.cancelled():
+            task.exception()
@@ -0,0 +1,129 @@
+import asyncio
+import io
+import logging
+import queue
+
+from aiohttp.web import HTTPRequestEntityTooLarge
+
+LOG = logging.getLogger(__name__)
+
+# Bytes read from the client at once
+CHUNK_SIZE = 64 * 1024
+
+# Seconds between checks of a parser waiting for the body
+POLL_INTERVAL = 1
+
+class RequestBodyReader(io.RawIOBase):
+    """
+    Blocking file object over a request body, for parsers running in a
+    thread. The event loop feeds it chunk by chunk (see pump); an empty
+    chunk marks the end of the body.
+
+    The parser never waits forever: it gets an IOError once the body is
+    cut (client gone, 413) or nothing came for `timeout` seconds.
+    """
+    def __init__(self, max_chunks=16, timeout=60):
+        self.timeout = timeout
+
+        self._chunks = queue.Queue(maxsize=max_chunks)
+        self._buffer = b''
+        self._eof = False
+        self._discarded = False
+
+        # Set by pump
+        self._loop = None
+        self._space = None
+        self._ended = False
+        self._failed = False
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        waited = 0
+        while not self._buffer and not self._eof:
+            try:
+                chunk = self._chunks.get(timeout=POLL_INTERVAL)
+            except queue.Empty:
+                if self._ended and self._chunks.empty():
+                    if self._failed:
+                        raise IOError("Request body was cut")
+                    chunk = b''
+                else:
+                    waited += POLL_INTERVAL
+                    if self.timeout is not None and waited >= self.timeout:
+                        raise IOError("Nothing received for {0}s".format(self.timeout))
+                    continue
+
+            self._buffer = chunk
+            self._eof = not chunk
+            self._wake_pump()
+
+        size = min(len(b), len(self._buffer))
+        b[:size] = self._buffer[:size]
+        self._buffer = self._buffer[size:]
+        return size
+
+    def _wake_pump(self):
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._space.set)
+
+    def discard(self):
+        """
+        Unblock the feeding side once the parser is done or gave up
+        """
+        self._discarded = True
+        self._eof = True
+        while True:
+            try:
+                self._chunks.get_nowait()
+            except queue.Empty:
+                break
+        if self._space is not None:
+            self._space.set()
+
+    @asyncio.coroutine
+    def _put(self, chunk):
+        """
+        Queue chunk, waiting for the parser to make room without holding
+        an executor thread
+        """
+        while not self._discarded:
+            try:
+                self._chunks.put_nowait(chunk)
+                return
+            except queue.Full:
+                # Set by readinto once it took a chunk
+                self._space.clear()
+                yield from self._space.wait()
+
+    @asyncio.coroutine
+    def pump(self, stream, loop, max_size=None):
+        """
+        Copy stream (the request content) until its end. Past max_size
+        bytes, end the body early and raise a 413.
+
+        However it ends (cancelled, client gone), the parser is told: it
+        reads an end of file, or an IOError if the body is incomplete.
+        """
+        self._loop = loop
+        self._space = asyncio.Event(loop=loop)
+
+        size = 0
+        complete = False
+        try:
+            while not self._discarded:
+                chunk = yield from stream.read(CHUNK_SIZE)
+                size += len(chunk)
+                if max_size is not None and size > max_size:
+                    raise HTTPRequestEntityTooLarge(reason="Request body is larger than {0} bytes".format(max_size))
+
+                # Waits while the parser lags behind
+                yield from self._put(chunk)
+
+                if not chunk:
+                    complete = True
+                    break
+        finally:
+            self._failed = not complete
+            self._ended = True
@@ -0,0 +1,66 @@
+"""
+What the tests of services need: an event loop and a container holding an
+embedded triple store in a temporary directory
+"""
+import asyncio
+import shutil
+import tempfile
+import unittest
+
+from glutton.engines import rdf
+from glutton.utils.cache import LRUCache, Generations
+from glutton.utils.singleflight import SingleFlight
+
+class Container(object):
+    """
+    The parts of glutton.Container services use
+    """
+    def __init__(self, store, loop):
+        self.loop = loop
+        self.config = {}
+
+        engine = asyncio.Future(loop=loop)
+        engine.set_result(store)
+        self.engines = {'triplestore': engine}
+
+        self.caches = {
+            'ldpr_metadata': LRUCache(),
+            'representations': LRUCache(),
+            'slug_allocations': LRUCache(),
+        }
+        self.generations = Generations()
+        self.reads = SingleFlight(loop=loop)
+        self.existence = None
+        self.existence_writes = None
+
+class AsyncTestCase(unittest.TestCase):
+    """
+    Run coroutines on a loop of their own
+    """
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(None)
+
+    def tearDown(self):
+        self.loop.close()
+
+    def run_coroutine(self, coroutine):
+        return self.loop.run_until_complete(coroutine)
+
+class StoreTestCase(AsyncTestCase):
+    """
+    With self.container over an empty embedded store
+    """
+    layout = 'default'
+
+    def setUp(self):
+        super().setUp()
+        self.path = tempfile.mkdtemp()
+        self.store = self.run_coroutine(rdf.connect('Embedded', self.path, pool_size=2,
+                                                    layout=self.layout, loop=self.loop))
+        self.container = Container(self.store, self.loop)
+
+    def tearDown(self):
+        self.run_coroutine(self.store.close())
+        shutil.rmtree(self.path)
+        super().tearDown()
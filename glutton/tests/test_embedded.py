@@ -0,0 +1,143 @@
+"""
+The embedded store must find what was written, through any index, and
+keep it across merges and restarts
+"""
+import os
+import shutil
+import tempfile
+import unittest
+
+from rdflib import Dataset, URIRef, Literal
+from rdflib.namespace import RDF, DCTERMS
+
+from glutton.engines import embedded, rdf
+
+EX = "http://example.org/"
+
+def ref(name):
+    return URIRef(EX + name)
+
+class EmbeddedStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.dataset = self.open()
+
+    def tearDown(self):
+        self.dataset.close()
+        shutil.rmtree(self.path)
+
+    def open(self):
+        return rdf.open_dataset('Embedded', self.path)
+
+    def reopen(self):
+        self.dataset.close()
+        self.dataset = self.open()
+
+    def fill(self):
+        def write(dataset):
+            for index in range(10):
+                graph = dataset.get_context(ref("r{0}".format(index)))
+                graph.add((ref("r{0}".format(index)), RDF.type, ref("Thing")))
+                graph.add((ref("r{0}".format(index)), DCTERMS.title, Literal("R{0}".format(index))))
+                graph.add((ref("r{0}".format(index)), DCTERMS.isPartOf, ref("r{0}".format(index % 3))))
+        rdf.call(write, self.dataset)
+
+    def check_lookups(self):
+        dataset = self.dataset
+        # SPO, POS, OSP
+        self.assertEqual(set(dataset.objects(ref("r4"), DCTERMS.title)), {Literal("R4")})
+        self.assertEqual(len(set(dataset.subjects(RDF.type, ref("Thing")))), 10)
+        self.assertEqual(set(dataset.subjects(None, ref("r1"))), {ref("r1"), ref("r4"), ref("r7")})
+        self.assertEqual(set(dataset.predicates(ref("r2"), Literal("R2"))), {DCTERMS.title})
+        # GSPO
+        graph = dataset.get_context(ref("r5"))
+        self.assertEqual(len(graph), 3)
+        self.assertEqual(set(graph.objects(ref("r5"), DCTERMS.isPartOf)), {ref("r2")})
+        self.assertEqual(len(dataset.get_context(ref("missing"))), 0)
+        contexts = set(context.identifier for context in dataset.contexts())
+        self.assertTrue(contexts.issuperset(ref("r{0}".format(index)) for index in range(10)))
+
+    def test_lookups(self):
+        self.fill()
+        self.check_lookups()
+
+    def test_sparql(self):
+        self.fill()
+        rdf.call(lambda dataset: dataset.update("DELETE WHERE {{ GRAPH {0} {{ {0} {1} ?o }} }}".format(ref("r3").n3(), DCTERMS.title.n3())), self.dataset)
+        rows = rdf.call(lambda dataset: list(dataset.query("SELECT ?s WHERE {{ GRAPH ?g {{ ?s {0} ?o }} }}".format(DCTERMS.title.n3()))), self.dataset)
+        self.assertEqual(len(rows), 9)
+        self.assertNotIn(ref("r3"), [row[0] for row in rows])
+
+    def test_merge(self):
+        self.fill()
+        database = self.dataset.store._database
+        with database.lock:
+            database.merge()
+        self.assertEqual(database._indexes['spo'].count, 30)
+        self.check_lookups()
+
+        # Removals through the delta hide merged quads, until merged too
+        rdf.call(lambda dataset: dataset.get_context(ref("r4")).remove((ref("r4"), None, None)), self.dataset)
+        self.assertEqual(len(self.dataset.get_context(ref("r4"))), 0)
+        with database.lock:
+            database.merge()
+        self.assertEqual(database._indexes['spo'].count, 27)
+
+        self.reopen()
+        self.assertEqual(len(self.dataset.get_context(ref("r4"))), 0)
+        self.assertEqual(len(self.dataset.get_context(ref("r5"))), 3)
+
+    def test_replay(self):
+        self.fill()
+        self.reopen()
+        self.check_lookups()
+
+    def test_replay_after_crash(self):
+        self.fill()
+        log_path = os.path.join(self.path, 'log')
+        self.dataset.close()
+
+        # A commit cut by a crash: some of its records, no commit record
+        terms = embedded._TermDictionary(os.path.join(self.path, 'terms'))
+        quad = (terms.intern(ref("r0")), terms.intern(RDF.type), terms.intern(ref("Other")), terms.intern(ref("r0")))
+        terms.sync()
+        terms.close()
+        with open(log_path, 'ab') as log:
+            log.write(embedded.LOG_RECORD.pack(b'+', *quad))
+            log.write(embedded.LOG_RECORD.pack(b'-', *quad)[:10])
+        size = os.path.getsize(log_path)
+
+        self.dataset = self.open()
+        self.check_lookups()
+        self.assertNotIn(ref("Other"), set(self.dataset.objects(ref("r0"), RDF.type)))
+        self.assertLess(os.path.getsize(log_path), size)
+
+    def test_rollback(self):
+        self.fill()
+
+        def failing(dataset):
+            dataset.get_context(ref("r1")).remove((ref("r1"), None, None))
+            dataset.get_context(ref("new")).add((ref("new"), RDF.type, ref("Thing")))
+            raise RuntimeError("Failed halfway")
+
+        with self.assertRaises(RuntimeError):
+            rdf.call(failing, self.dataset)
+        self.assertEqual(len(self.dataset.get_context(ref("r1"))), 3)
+        self.assertEqual(len(self.dataset.get_context(ref("new"))), 0)
+
+        # Nor was it logged
+        self.reopen()
+        self.check_lookups()
+        self.assertEqual(len(self.dataset.get_context(ref("new"))), 0)
+
+    def test_rollback_sparql(self):
+        self.fill()
+        update = """DELETE WHERE {{ GRAPH {r1} {{ {r1} ?p ?o }} }} ;
+                    INSERT DATA {{ GRAPH {r1} {{ {r1} {title} "Replaced" }} }} ;
+                    LOAD <file:///nonexistent/glutton/test>""".format(r1=ref("r1").n3(), title=DCTERMS.title.n3())
+        with self.assertRaises(Exception):
+            rdf.call(lambda dataset: dataset.update(update), self.dataset)
+        self.assertEqual(set(self.dataset.objects(ref("r1"), DCTERMS.title)), {Literal("R1")})
+
+if __name__ == '__main__':
+    unittest.main()
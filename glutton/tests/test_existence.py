@@ -0,0 +1,145 @@
+"""
+The existence filter must never answer "no" for an IRI of the store, and
+the invalidation bus must tell when it lost invalidations
+"""
+import asyncio
+import os
+import shutil
+import socket
+import tempfile
+import unittest
+
+from rdflib import Graph, URIRef, Literal
+from rdflib.namespace import DCTERMS
+
+from glutton.engines.invalidation import InvalidationBus
+from glutton.services.data import ldpr_new, ldpr_load, existence_filter_load, forget_ldpr
+from glutton.utils.bloom import BloomFilter
+
+from support import AsyncTestCase, StoreTestCase
+
+def ref(index):
+    return URIRef("http://example.org/ldpc/{0}".format(index))
+
+class BloomFilterTest(unittest.TestCase):
+    def test_not_ready(self):
+        bloom = BloomFilter(capacity=100)
+        self.assertIn("anything", bloom)
+
+    def test_no_false_negative(self):
+        bloom = BloomFilter(capacity=1000, false_positive_rate=0.01)
+        for index in range(1000):
+            bloom.add(ref(index))
+        bloom.ready = True
+
+        for index in range(1000):
+            self.assertIn(ref(index), bloom)
+        false_positives = sum(1 for index in range(1000, 11000) if ref(index) in bloom)
+        self.assertLess(false_positives, 300)
+
+    def test_over_capacity(self):
+        bloom = BloomFilter(capacity=10)
+        for index in range(100):
+            bloom.add(ref(index))
+        bloom.ready = True
+        for index in range(100):
+            self.assertIn(ref(index), bloom)
+        self.assertGreater(bloom.estimated_false_positive_rate(), 0.01)
+
+class ExistenceFilterLoadTest(StoreTestCase):
+    def setUp(self):
+        super().setUp()
+        self.container.existence = BloomFilter(capacity=1000)
+        for index in range(10):
+            graph = Graph()
+            graph.add((ref(index), DCTERMS.title, Literal("LDPR {0}".format(index))))
+            self.run_coroutine(ldpr_new(self.container, ref(index), graph))
+
+    def test_load(self):
+        self.run_coroutine(existence_filter_load(self.container))
+
+        existence = self.container.existence
+        self.assertTrue(existence.ready)
+        for index in range(10):
+            self.assertIn(str(ref(index)), existence)
+
+        # Unknown: answered without the store
+        state = self.run_coroutine(ldpr_load(self.container, ref(10)))
+        self.assertFalse(state.exists)
+        self.assertGreater(existence.negatives, 0)
+
+    def test_writes_while_loading(self):
+        original_run = self.store.run
+
+        @asyncio.coroutine
+        def run(*args, **kwargs):
+            # Written by this worker while the new filter is filled
+            forget_ldpr(self.container, ref(20))
+            return (yield from original_run(*args, **kwargs))
+
+        self.store.run = run
+        self.run_coroutine(existence_filter_load(self.container))
+        self.assertIn(str(ref(20)), self.container.existence)
+        self.assertIsNone(self.container.existence_writes)
+
+class InvalidationBusTest(AsyncTestCase):
+    def setUp(self):
+        super().setUp()
+        self.directory = tempfile.mkdtemp()
+        self.bus = InvalidationBus(self.directory, loop=self.loop)
+
+        self.invalidated = []
+        self.losses = []
+        self.bus.subscribe(self.invalidated.extend)
+        self.bus.subscribe_losses(lambda: self.losses.append(True))
+
+        self.peer = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.peer.bind(os.path.join(self.directory, 'worker-peer.sock'))
+
+    def tearDown(self):
+        self.peer.close()
+        self.bus.close()
+        shutil.rmtree(self.directory)
+        super().tearDown()
+
+    def send(self, sender, sequence, *ldpr_refs):
+        datagram = "#{0} {1}\n".format(sender, sequence) + "\n".join(ldpr_refs)
+        self.peer.sendto(datagram.encode('utf-8'), self.bus.path)
+        self.run_coroutine(asyncio.sleep(0.01, loop=self.loop))
+
+    def test_publish(self):
+        self.bus.publish([ref(1), ref(2)])
+        self.bus.publish([ref(3)])
+
+        first = self.peer.recv(8192).decode('utf-8').split('\n')
+        second = self.peer.recv(8192).decode('utf-8').split('\n')
+        self.assertEqual(first[1:], [str(ref(1)), str(ref(2))])
+        self.assertEqual(second[1:], [str(ref(3))])
+        # Numbered per sender
+        self.assertEqual(first[0], "#{0} 1".format(os.getpid()))
+        self.assertEqual(second[0], "#{0} 2".format(os.getpid()))
+
+    def test_receive(self):
+        self.send(1234, 1, str(ref(1)))
+        self.send(1234, 2, str(ref(2)), str(ref(3)))
+        self.assertEqual(self.invalidated, [str(ref(1)), str(ref(2)), str(ref(3))])
+        self.assertEqual(self.losses, [])
+
+    def test_gap(self):
+        self.send(1234, 1, str(ref(1)))
+        self.send(5678, 7, str(ref(2)))
+        self.assertEqual(self.losses, [])
+
+        # 2 never came
+        self.send(1234, 3, str(ref(3)))
+        self.assertEqual(self.losses, [True])
+        self.assertIn(str(ref(3)), self.invalidated)
+
+    def test_dead_peer(self):
+        self.peer.close()
+        self.bus.publish([ref(1)])
+        self.assertEqual(os.listdir(self.directory), [os.path.basename(self.bus.path)])
+        self.peer = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,118 @@
+"""
+PATCH must only change the triples of its LDPR, refuse what it can't
+evaluate locally, and only apply over the version it was checked against
+"""
+import unittest
+
+from rdflib import Graph, URIRef, Literal
+from rdflib.namespace import RDF, DCTERMS
+
+from glutton.services import patch
+from glutton.services.data import ldpr_new, ldpr_load
+from glutton.utils.namespace import LDP
+
+from support import StoreTestCase
+
+LDPR = URIRef("http://example.org/ldpc/ldpr")
+OTHER = URIRef("http://example.org/ldpc/other")
+
+class ParseTest(unittest.TestCase):
+    def parse(self, text):
+        return patch.parse_patch(text, LDPR)
+
+    def test_predicates(self):
+        update, predicates = self.parse("""PREFIX dcterms: <http://purl.org/dc/terms/>
+                                           DELETE { <> dcterms:title ?title } INSERT { <> dcterms:title "New" }
+                                           WHERE { <> dcterms:title ?title }""")
+        self.assertEqual(predicates, {DCTERMS.title})
+
+    def test_any_predicate(self):
+        update, predicates = self.parse("DELETE WHERE { <> ?p ?o }")
+        self.assertIsNone(predicates)
+
+    def test_other_subject(self):
+        with self.assertRaises(patch.ForbiddenPatch):
+            self.parse("INSERT DATA {{ {0} <http://purl.org/dc/terms/title> \"Other\" }}".format(OTHER.n3()))
+
+    def test_exists_other_subject(self):
+        with self.assertRaises(patch.UnprocessablePatch):
+            self.parse("""INSERT {{ <> <http://purl.org/dc/terms/title> "New" }}
+                          WHERE {{ FILTER EXISTS {{ {0} ?p ?o }} }}""".format(OTHER.n3()))
+
+    def test_exists_own_subject(self):
+        update, predicates = self.parse("""INSERT { <> <http://purl.org/dc/terms/title> "New" }
+                                           WHERE { FILTER NOT EXISTS { <> <http://purl.org/dc/terms/title> ?title } }""")
+        self.assertEqual(predicates, {DCTERMS.title})
+
+    def test_unsupported(self):
+        for text in ("LOAD <http://example.org/dump>",
+                     "CLEAR ALL",
+                     "INSERT DATA { GRAPH <http://example.org/g> { <> <http://purl.org/dc/terms/title> \"New\" } }",
+                     "WITH <http://example.org/g> DELETE { <> ?p ?o } WHERE { <> ?p ?o }",
+                     "not sparql"):
+            with self.assertRaises(patch.InvalidPatch):
+                self.parse(text)
+
+class PatchTest(StoreTestCase):
+    def setUp(self):
+        super().setUp()
+        graph = Graph()
+        graph.add((LDPR, DCTERMS.title, Literal("Old")))
+        graph.add((LDPR, DCTERMS.description, Literal("Kept")))
+        # Server-managed, dropped
+        graph.add((LDPR, DCTERMS.modified, Literal("1999-01-01T00:00:00")))
+        self.run_coroutine(ldpr_new(self.container, LDPR, graph))
+
+    def load(self):
+        return self.run_coroutine(ldpr_load(self.container, LDPR))
+
+    def apply(self, text, modification_date=None):
+        update, predicates = patch.parse_patch(text, LDPR)
+        return self.run_coroutine(patch.ldpr_patch(self.container, LDPR, update, predicates,
+                                                   modification_date=modification_date))
+
+    def test_patch(self):
+        before = self.load()
+        self.assertEqual(len(set(before.graph.objects(LDPR, DCTERMS.modified))), 1)
+
+        changed = self.apply("""PREFIX dcterms: <http://purl.org/dc/terms/>
+                                DELETE { <> dcterms:title ?title } INSERT { <> dcterms:title "New" }
+                                WHERE { <> dcterms:title ?title }""", before.modification_date)
+        self.assertTrue(changed)
+
+        after = self.load()
+        self.assertEqual(set(after.graph.objects(LDPR, DCTERMS.title)), {Literal("New")})
+        self.assertEqual(set(after.graph.objects(LDPR, DCTERMS.description)), {Literal("Kept")})
+        self.assertIn((LDPR, RDF.type, LDP.RDFSource), after.graph)
+        # A single, new modification date, hence a new etag
+        self.assertEqual(len(set(after.graph.objects(LDPR, DCTERMS.modified))), 1)
+        self.assertNotEqual(after.etag, before.etag)
+
+    def test_no_change(self):
+        before = self.load()
+        self.assertFalse(self.apply("DELETE DATA { <> <http://purl.org/dc/terms/title> \"Missing\" }",
+                                    before.modification_date))
+        self.assertEqual(self.load().etag, before.etag)
+
+    def test_concurrent(self):
+        before = self.load()
+        self.apply("INSERT DATA { <> <http://purl.org/dc/terms/subject> \"First\" }", before.modification_date)
+
+        # Checked against the etag before the first patch
+        with self.assertRaises(patch.ConcurrentPatch):
+            self.apply("INSERT DATA { <> <http://purl.org/dc/terms/subject> \"Second\" }", before.modification_date)
+        self.assertEqual(set(self.load().graph.objects(LDPR, DCTERMS.subject)), {Literal("First")})
+
+    def test_server_managed(self):
+        before = self.load()
+        with self.assertRaises(patch.ForbiddenPatch):
+            self.apply("INSERT DATA {{ <> <http://www.w3.org/ns/ldp#contains> {0} }}".format(OTHER.n3()),
+                       before.modification_date)
+        with self.assertRaises(patch.ForbiddenPatch):
+            self.apply("DELETE WHERE { <> <http://purl.org/dc/terms/modified> ?date }", before.modification_date)
+
+class NamedGraphPatchTest(PatchTest):
+    layout = 'named-graphs'
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,152 @@
+"""
+The fast serializers must produce the same graphs as rdflib
+"""
+import unittest
+
+from rdflib import Graph, URIRef, BNode, Literal
+from rdflib.compare import isomorphic
+from rdflib.namespace import RDF, XSD, DCTERMS
+
+from glutton.utils import serializers
+from glutton.utils.namespace import LDP, GLUTTON
+
+LDPC = URIRef("http://example.org/ldpc/")
+
+def sample_graph():
+    graph = Graph()
+    graph.add((LDPC, RDF.type, LDP.BasicContainer))
+    graph.add((LDPC, RDF.type, LDP.Container))
+    graph.add((LDPC, DCTERMS.modified, Literal("2015-05-01T12:00:00", datatype=XSD.dateTime)))
+    graph.add((LDPC, DCTERMS.title, Literal("A \"quoted\"\ntitle\\", lang="en")))
+    graph.add((LDPC, DCTERMS.description, Literal("Ünïcode / slashes")))
+    graph.add((LDPC, DCTERMS.extent, Literal(42)))
+    for index in range(50):
+        graph.add((LDPC, LDP.contains, URIRef("http://example.org/ldpc/{0}".format(index))))
+
+    author = BNode()
+    graph.add((LDPC, DCTERMS.creator, author))
+    graph.add((author, DCTERMS.title, Literal("Someone")))
+    graph.add((URIRef("http://example.org/ldpc/#hash"), RDF.type, Literal("not an IRI")))
+
+    return graph
+
+def ordered(graph, subject):
+    return sorted(graph.triples((subject, None, None)), key=lambda triple: (triple[1], triple[2]))
+
+def parse(data, rdflib_format):
+    # rdflib serializes to bytes (4.x) or str (6.x)
+    if isinstance(data, bytes):
+        data = data.decode('utf-8')
+    graph = Graph()
+    graph.parse(data=data, format=rdflib_format)
+    return graph
+
+class TurtleTest(unittest.TestCase):
+    def test_serialize(self):
+        graph = sample_graph()
+        data = serializers.serialize_turtle(graph.triples((None, None, None)))
+        self.assertTrue(isomorphic(parse(data, 'turtle'), graph))
+
+    def test_same_as_rdflib(self):
+        graph = sample_graph()
+        data = serializers.serialize_turtle(graph.triples((None, None, None)))
+        self.assertTrue(isomorphic(parse(data, 'turtle'), parse(graph.serialize(format='turtle'), 'turtle')))
+
+    def test_empty(self):
+        self.assertEqual(serializers.serialize_turtle(()), b"")
+
+    def test_stream(self):
+        graph = sample_graph()
+        triples = list(graph.triples((None, None, None)))
+        stream = serializers.TurtleStream()
+        data = b"".join(stream.feed(triples[start:start + 7]) for start in range(0, len(triples), 7)) + stream.close()
+        self.assertTrue(isomorphic(parse(data, 'turtle'), graph))
+
+class JsonLDTest(unittest.TestCase):
+    def test_serialize(self):
+        graph = sample_graph()
+        data = serializers.serialize_jsonld(graph.triples((None, None, None)))
+        self.assertTrue(isomorphic(parse(data, 'json-ld'), graph))
+
+    def test_same_as_rdflib(self):
+        graph = sample_graph()
+        data = serializers.serialize_jsonld(graph.triples((None, None, None)))
+        self.assertTrue(isomorphic(parse(data, 'json-ld'), parse(graph.serialize(format='json-ld'), 'json-ld')))
+
+    def test_stream(self):
+        graph = sample_graph()
+        triples = ordered(graph, LDPC)
+        stream = serializers.JsonLDStream()
+        data = b"".join(stream.feed(triples[start:start + 7]) for start in range(0, len(triples), 7)) + stream.close()
+
+        expected = Graph()
+        for triple in triples:
+            expected.add(triple)
+        self.assertTrue(isomorphic(parse(data, 'json-ld'), expected))
+
+    def test_stream_subjects(self):
+        # Hash URIs and blank nodes of the LDPR's graph come along
+        graph = sample_graph()
+        triples = [triple for subject in sorted(graph.subjects(), key=str) for triple in ordered(graph, subject)]
+        stream = serializers.JsonLDStream()
+        data = b"".join(stream.feed(triples[start:start + 7]) for start in range(0, len(triples), 7)) + stream.close()
+        self.assertTrue(isomorphic(parse(data, 'json-ld'), graph))
+
+    def test_stream_empty(self):
+        stream = serializers.JsonLDStream()
+        self.assertEqual(parse(stream.close(), 'json-ld').value(LDPC, RDF.type), None)
+
+class NTriplesTest(unittest.TestCase):
+    def test_serialize(self):
+        graph = sample_graph()
+        data = serializers.serialize_ntriples(graph.triples((None, None, None)))
+        self.assertTrue(isomorphic(parse(data, 'nt'), graph))
+
+    def test_stream(self):
+        graph = sample_graph()
+        triples = list(graph.triples((None, None, None)))
+        stream = serializers.NTriplesStream()
+        data = b"".join(stream.feed(triples[start:start + 7]) for start in range(0, len(triples), 7)) + stream.close()
+        self.assertTrue(isomorphic(parse(data, 'nt'), graph))
+
+    def test_writers(self):
+        # Whatever is offered by default can be streamed
+        for content_type in ('text/turtle', 'application/ld+json', 'application/n-triples'):
+            self.assertIn(content_type, serializers.STREAM_WRITERS)
+
+class SerializeTest(unittest.TestCase):
+    def test_configure(self):
+        graph = sample_graph()
+        try:
+            serializers.configure({'text/turtle': 'rdflib'})
+            data = serializers.serialize(graph, 'text/turtle', 'turtle')
+            self.assertTrue(isomorphic(parse(data, 'turtle'), graph))
+        finally:
+            serializers.configure({'text/turtle': 'fast'})
+
+        data = serializers.serialize(graph, 'text/turtle', 'turtle')
+        self.assertEqual(data, serializers.serialize_turtle(graph.triples((None, None, None))))
+
+    def test_internal_triples_dropped(self):
+        graph = sample_graph()
+        internal = Graph()
+        for triple in graph:
+            internal.add(triple)
+        internal.add((LDPC, GLUTTON.containedIn, URIRef("http://example.org/")))
+
+        for content_type, rdflib_format, serializer in (('text/turtle', 'turtle', 'fast'),
+                                                        ('text/turtle', 'turtle', 'rdflib'),
+                                                        ('application/ld+json', 'json-ld', 'fast')):
+            try:
+                serializers.configure({content_type: serializer})
+                data = serializers.serialize(internal, content_type, rdflib_format)
+            finally:
+                serializers.configure({content_type: 'fast'})
+            self.assertTrue(isomorphic(parse(data, rdflib_format), graph))
+
+    def test_configure_unknown(self):
+        with self.assertRaises(ValueError):
+            serializers.configure({'text/turtle': 'fastest'})
+
+if __name__ == '__main__':
+    unittest.main()
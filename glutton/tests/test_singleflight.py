@@ -0,0 +1,144 @@
+"""
+Concurrent identical calls must share one run, each caller getting its
+result, or an exception it can raise on its own
+"""
+import asyncio
+import unittest
+
+from aiohttp.web import HTTPServiceUnavailable
+
+from glutton.utils.misc import coalesce
+from glutton.utils.singleflight import SingleFlight
+
+from support import AsyncTestCase
+
+class Calls(object):
+    """
+    Coroutine factory counting its runs, each blocked until released
+    """
+    def __init__(self, loop, result='result'):
+        self.loop = loop
+        self.result = result
+        self.count = 0
+        self.release = asyncio.Event(loop=loop)
+
+    @asyncio.coroutine
+    def call(self):
+        self.count += 1
+        yield from self.release.wait()
+        if isinstance(self.result, Exception):
+            raise self.result
+        return self.result
+
+class Request(dict):
+    def __init__(self, container):
+        super().__init__()
+        self.app = {'ah_container': container}
+        self.host = 'example.org'
+        self.path = '/ldpr'
+
+class SingleFlightTest(AsyncTestCase):
+    def gather(self, flight, calls, key='key', count=5):
+        @asyncio.coroutine
+        def run():
+            tasks = [self.loop.create_task(flight.do(key, calls.call, tags=('tag',))) for index in range(count)]
+            yield from asyncio.sleep(0, loop=self.loop)
+            calls.release.set()
+            return (yield from asyncio.gather(*tasks, loop=self.loop, return_exceptions=True))
+        return self.run_coroutine(run())
+
+    def test_shared(self):
+        flight = SingleFlight(loop=self.loop)
+        calls = Calls(self.loop)
+        self.assertEqual(self.gather(flight, calls), ['result'] * 5)
+        self.assertEqual(calls.count, 1)
+        self.assertEqual(len(flight), 0)
+
+    def test_exception_shared(self):
+        flight = SingleFlight(loop=self.loop)
+        calls = Calls(self.loop, ValueError("failed"))
+        results = self.gather(flight, calls)
+        self.assertTrue(all(isinstance(result, ValueError) for result in results))
+        self.assertEqual(calls.count, 1)
+
+    def test_disabled(self):
+        flight = SingleFlight(enabled=False, loop=self.loop)
+        calls = Calls(self.loop)
+        self.assertEqual(self.gather(flight, calls), ['result'] * 5)
+        self.assertEqual(calls.count, 5)
+
+    def test_forget(self):
+        flight = SingleFlight(loop=self.loop)
+        calls = Calls(self.loop)
+
+        @asyncio.coroutine
+        def run():
+            first = self.loop.create_task(flight.do('key', calls.call, tags=('tag',)))
+            yield from asyncio.sleep(0, loop=self.loop)
+            # Modified meanwhile: new callers don't join the older call
+            flight.forget('tag')
+            second = self.loop.create_task(flight.do('key', calls.call, tags=('tag',)))
+            yield from asyncio.sleep(0, loop=self.loop)
+            calls.release.set()
+            return (yield from asyncio.gather(first, second, loop=self.loop))
+
+        self.assertEqual(self.run_coroutine(run()), ['result', 'result'])
+        self.assertEqual(calls.count, 2)
+
+    def test_timeout(self):
+        flight = SingleFlight(timeout=0.01, loop=self.loop)
+        calls = Calls(self.loop)
+
+        with self.assertRaises(asyncio.TimeoutError):
+            self.run_coroutine(flight.do('key', calls.call))
+
+        # The shared call goes on for the others
+        @asyncio.coroutine
+        def run():
+            task = self.loop.create_task(flight.do('key', calls.call))
+            calls.release.set()
+            return (yield from task)
+        self.assertEqual(self.run_coroutine(run()), 'result')
+        self.assertEqual(calls.count, 1)
+
+    def test_cancelled_caller(self):
+        flight = SingleFlight(loop=self.loop)
+        calls = Calls(self.loop)
+
+        @asyncio.coroutine
+        def run():
+            first = self.loop.create_task(flight.do('key', calls.call))
+            second = self.loop.create_task(flight.do('key', calls.call))
+            yield from asyncio.sleep(0, loop=self.loop)
+            first.cancel()
+            yield from asyncio.sleep(0, loop=self.loop)
+            calls.release.set()
+            return (yield from second)
+
+        self.assertEqual(self.run_coroutine(run()), 'result')
+        self.assertEqual(calls.count, 1)
+
+class CoalesceTest(AsyncTestCase):
+    def test_http_exception_per_caller(self):
+        # A response can only be sent once: each caller needs its own
+        container = type('Container', (object,), {})()
+        container.reads = SingleFlight(loop=self.loop)
+        calls = Calls(self.loop, HTTPServiceUnavailable(reason="Triplestore is overloaded"))
+
+        @asyncio.coroutine
+        def run():
+            tasks = [self.loop.create_task(coalesce(Request(container), 'key', calls.call)) for index in range(3)]
+            yield from asyncio.sleep(0, loop=self.loop)
+            calls.release.set()
+            return (yield from asyncio.gather(*tasks, loop=self.loop, return_exceptions=True))
+
+        errors = self.run_coroutine(run())
+        self.assertEqual(calls.count, 1)
+        self.assertEqual(len(set(id(error) for error in errors)), 3)
+        for error in errors:
+            self.assertIsInstance(error, HTTPServiceUnavailable)
+            self.assertEqual(error.status, 503)
+            self.assertEqual(error.reason, "Triplestore is overloaded")
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,84 @@
+"""
+POST slugs must be numbered in sequence, never handed out twice, and
+their counters kept out of the LDPR space
+"""
+import asyncio
+import unittest
+
+from rdflib import URIRef, Literal
+from rdflib.namespace import RDF
+
+from glutton.services import slugs
+from glutton.services.data import WriteBatch
+from glutton.utils.cache import LRUCache
+from glutton.utils.namespace import LDP, GLUTTON
+
+from support import StoreTestCase
+
+LDPC = URIRef("http://example.org/ldpc")
+
+class SlugTest(StoreTestCase):
+    def reserve(self, slug):
+        return self.run_coroutine(slugs.slug_reserve(self.container, LDPC, slug))
+
+    def create(self, ldpr_ref, token=None):
+        batch = WriteBatch()
+        if token is not None:
+            slugs.slug_claim(batch, ldpr_ref)
+        batch.add((ldpr_ref, RDF.type, LDP.RDFSource))
+        self.run_coroutine(batch.commit(self.container))
+
+    def test_numbered(self):
+        refs = [self.reserve("A Comment")[0] for index in range(3)]
+        self.assertEqual(refs, [URIRef(LDPC + "/a-comment"), URIRef(LDPC + "/a-comment-1"), URIRef(LDPC + "/a-comment-2")])
+
+    def test_taken(self):
+        self.create(URIRef(LDPC + "/comment"))
+        self.create(URIRef(LDPC + "/comment-1"))
+        self.assertEqual(self.reserve("comment")[0], URIRef(LDPC + "/comment-2"))
+
+    def test_other_worker(self):
+        self.reserve("comment")
+        # Another worker (or a restarted one) starts from the stored counter
+        self.container.caches['slug_allocations'] = LRUCache()
+        self.assertEqual(self.reserve("comment")[0], URIRef(LDPC + "/comment-1"))
+
+    def test_concurrent(self):
+        @asyncio.coroutine
+        def run():
+            return (yield from asyncio.gather(*[slugs.slug_reserve(self.container, LDPC, "comment") for index in range(5)],
+                                              loop=self.loop))
+        refs = [ldpr_ref for ldpr_ref, token in self.run_coroutine(run())]
+        self.assertEqual(len(set(refs)), 5)
+
+    def test_no_suggestion(self):
+        ldpr_ref, token = self.reserve(None)
+        self.assertTrue(ldpr_ref.startswith(LDPC + "/"))
+        self.assertIsNone(token)
+
+    def test_claim(self):
+        ldpr_ref, token = self.reserve("comment")
+        self.create(ldpr_ref, token)
+        reservations = self.run_coroutine(self.store.objects(ldpr_ref, GLUTTON.reservedBy))
+        self.assertEqual(set(reservations), set())
+
+    def test_release(self):
+        ldpr_ref, token = self.reserve("comment")
+        self.assertTrue(self.run_coroutine(self.store.contains((ldpr_ref, GLUTTON.reservedBy, Literal(token)))))
+
+        self.run_coroutine(slugs.slug_release(self.container, ldpr_ref, token))
+        self.assertFalse(self.run_coroutine(self.store.contains((ldpr_ref, None, None))))
+        # Its number is not reused
+        self.assertEqual(self.reserve("comment")[0], URIRef(LDPC + "/comment-1"))
+
+    def test_counters_hidden(self):
+        self.reserve("comment")
+        subjects = self.run_coroutine(self.store.subjects(GLUTTON.slugNext, None))
+        for subject in subjects:
+            self.assertFalse(subject.startswith(LDPC))
+
+class NamedGraphSlugTest(SlugTest):
+    layout = 'named-graphs'
+
+if __name__ == '__main__':
+    unittest.main()